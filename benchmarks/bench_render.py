@@ -0,0 +1,332 @@
+"""Benchmark the board image pipeline: rendering (SVG generation and
+rasterising) into the render cache and serving it from board_image.
+
+Each image is timed in stages: the cache lookup, on a miss rasterising the
+board and writing it to the cache tiers, and serving it. Rasterise and
+write are averaged over the misses only, and the bytes written to the disk
+tier are reported next to the bytes served.
+
+Runs over a corpus of positions from random games, in every size and both
+orientations, once per scenario of backend and cache mode. Each scenario
+runs in a fresh process so that its peak RSS and caches are its own. The
+corpus is played `--passes` times, as shown boards are fetched again, which
+is what the caches are for. The sprite layers of every size are rasterised
+before the timed passes, as a worker does at startup, and their cost is
+reported on its own as warmup.
+
+Usage: python -m benchmarks.bench_render [--games N] [--sizes PX,...]
+    [--backends svg,sprite] [--caches none,memory,disk] [--passes N]
+    [--output FILE] [--baseline FILE] [--tolerance FRACTION]
+
+With --baseline, a results file written by --output earlier, the exit status
+is 1 if a scenario got slower than in the baseline by more than the
+tolerance, in images/s or p99 latency.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import chess
+
+from chess_server.render import BoardSpec
+
+# Render cache limits of each cache mode, memory and disk bytes
+CACHE_MODES = {
+    "none": (0, 0),
+    "memory": (64 * 1024 * 1024, 0),
+    "disk": (0, 512 * 1024 * 1024),
+}
+STAGES = ("lookup", "rasterise", "write", "serve")
+
+
+def get_positions(games: int, seed: int = 0) -> List[BoardSpec]:
+    """Positions from random games, as seen after each move"""
+    rng = random.Random(seed)
+    specs = []
+
+    for _ in range(games):
+        board = chess.Board()
+        while not board.is_game_over() and len(board.move_stack) < 80:
+            board.push(rng.choice(list(board.legal_moves)))
+            specs.append(BoardSpec.from_board(board))
+
+    return specs
+
+
+def get_corpus(
+    games: int, sizes: List[Optional[int]], seed: int = 0
+) -> List[BoardSpec]:
+    """Every position in every size and both orientations"""
+    return [
+        spec._replace(size=size, flipped=flipped)
+        for spec in get_positions(games, seed)
+        for size in sizes
+        for flipped in (False, True)
+    ]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest rank percentile, q in [0, 100]"""
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, round(q / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def bench_svg(specs: List[BoardSpec]) -> float:
+    """Seconds per image spent in chess.svg.board, which the svg backend
+    pays on every render"""
+    start = time.perf_counter()
+    for spec in specs:
+        spec.to_svg()
+
+    return (time.perf_counter() - start) / len(specs)
+
+
+def run_scenario(
+    backend: str, cache: str, specs: List[BoardSpec], passes: int
+) -> Dict[str, Any]:
+    """Render and serve every image of the corpus with an app set up for
+    the scenario. Run in a process of its own."""
+    from chess_server import create_app
+    from chess_server.render import (
+        cache_lookups,
+        get_sprite_renderer,
+        render_cache,
+        render_image,
+    )
+    from chess_server.utils import ImageVariant, encode_board_image_token
+
+    memory_bytes, disk_bytes = CACHE_MODES[cache]
+    img_dir = tempfile.mkdtemp(prefix="bench-render-")
+    app = create_app(
+        env="test",
+        test_config={
+            "IMG_DIR": img_dir,
+            "SQLALCHEMY_DATABASE_URI": "sqlite://",
+            "BOARD_RENDERER": backend,
+            "RENDER_CACHE_MEMORY_BYTES": memory_bytes,
+            "RENDER_CACHE_DISK_BYTES": disk_bytes,
+            "RENDER_WORKERS": 0,
+            # A variant per size, for the positions in the URLs
+            "IMAGE_SIZES": {str(spec.size): spec.size for spec in specs},
+        },
+    )
+    client = app.test_client()
+
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    bytes_served = bytes_written = 0
+
+    try:
+        with app.test_request_context():
+            start = time.perf_counter()
+            if backend == "sprite":
+                for size, style in {(spec.size, spec.style) for spec in specs}:
+                    get_sprite_renderer(size, style)
+            warmup = time.perf_counter() - start
+
+            urls = [
+                f"/webhook/images/boards/{spec.key}.{spec.extension}"
+                "?position="
+                + encode_board_image_token(
+                    spec, ImageVariant(str(spec.size), spec.format)
+                )
+                for spec in specs
+            ]
+
+            for _ in range(passes):
+                for spec, url in zip(specs, urls):
+                    # The steps of render_cache.get_image, timed apart
+                    start = time.perf_counter()
+                    image = render_cache.lookup(spec)
+                    looked_up = rendered = time.perf_counter()
+
+                    if image is None:
+                        image = render_image(spec, backend)
+                        rasterised = time.perf_counter()
+                        render_cache.put(spec, image)
+                        rendered = time.perf_counter()
+
+                        timings["rasterise"].append(rasterised - looked_up)
+                        timings["write"].append(rendered - rasterised)
+                        if render_cache.disk_limit:
+                            bytes_written += len(image)
+
+                    response = client.get(url)
+                    image = response.get_data()
+                    served = time.perf_counter()
+
+                    if response.status_code != 200:
+                        raise RuntimeError(
+                            f"board_image returned {response.status_code}"
+                        )
+
+                    timings["lookup"].append(looked_up - start)
+                    timings["serve"].append(served - rendered)
+                    totals.append(served - start)
+                    bytes_served += len(image)
+    finally:
+        shutil.rmtree(img_dir, ignore_errors=True)
+
+    hits = sum(cache_lookups.get(tier=tier) for tier in ("memory", "disk"))
+    lookups = hits + cache_lookups.get(tier="miss")
+
+    return {
+        "backend": backend,
+        "cache": cache,
+        "images": len(totals),
+        "images_per_sec": len(totals) / sum(totals),
+        "p50_ms": percentile(totals, 50) * 1000,
+        "p99_ms": percentile(totals, 99) * 1000,
+        "stages_ms": {
+            stage: statistics.mean(values) * 1000 if values else 0.0
+            for stage, values in timings.items()
+        },
+        "cache_hit_rate": hits / lookups,
+        "warmup_ms": warmup * 1000,
+        "bytes_served": bytes_served,
+        "bytes_written": bytes_written,
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / 1024,
+    }
+
+
+def run_isolated(*args) -> Dict[str, Any]:
+    """Run a scenario in a freshly spawned process"""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_scenario, *args).result()
+
+
+def find_regressions(
+    results: List[Dict[str, Any]],
+    baseline: List[Dict[str, Any]],
+    tolerance: float,
+) -> List[str]:
+    """Scenarios slower than in the baseline by more than the tolerance"""
+    previous = {(r["backend"], r["cache"]): r for r in baseline}
+    regressions = []
+
+    for result in results:
+        name = f"{result['backend']}/{result['cache']}"
+        before = previous.get((result["backend"], result["cache"]))
+
+        if before is None:
+            continue
+
+        if result["images_per_sec"] < before["images_per_sec"] * (
+            1 - tolerance
+        ):
+            regressions.append(
+                f"{name}: {result['images_per_sec']:.0f} images/s, "
+                f"was {before['images_per_sec']:.0f}"
+            )
+
+        if result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p99 {result['p99_ms']:.2f} ms, "
+                f"was {before['p99_ms']:.2f} ms"
+            )
+
+    return regressions
+
+
+def print_results(results: List[Dict[str, Any]]):
+    print(
+        f"{'scenario':>14} {'images/s':>9} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'lookup':>8} {'raster':>8} {'write':>8} {'serve':>8} "
+        f"{'hits':>5} {'served':>9} {'written':>9} {'rss MB':>7} "
+        f"{'warmup ms':>9}"
+    )
+
+    for r in results:
+        stages = r["stages_ms"]
+        print(
+            f"{r['backend'] + '/' + r['cache']:>14} "
+            f"{r['images_per_sec']:>9.0f} {r['p50_ms']:>8.2f} "
+            f"{r['p99_ms']:>8.2f} {stages['lookup']:>8.2f} "
+            f"{stages['rasterise']:>8.2f} {stages['write']:>8.2f} "
+            f"{stages['serve']:>8.2f} {r['cache_hit_rate']:>5.0%} "
+            f"{r['bytes_served'] / 1024 / 1024:>7.1f}MB "
+            f"{r['bytes_written'] / 1024 / 1024:>7.1f}MB "
+            f"{r['peak_rss_mb']:>7.0f} {r['warmup_ms']:>9.1f}"
+        )
+
+    by_scenario = {(r["backend"], r["cache"]): r for r in results}
+    for cache in CACHE_MODES:
+        svg = by_scenario.get(("svg", cache))
+        sprite = by_scenario.get(("sprite", cache))
+        if svg and sprite:
+            speedup = sprite["images_per_sec"] / svg["images_per_sec"]
+            print(f"sprite speedup with {cache} cache: {speedup:.1f}x")
+
+
+def parse_list(value: str) -> List[str]:
+    return [item for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--games", type=int, default=2)
+    parser.add_argument(
+        "--sizes",
+        type=parse_list,
+        default=["240", "390"],
+        help="Comma separated pixel sizes, 0 is the default size",
+    )
+    parser.add_argument(
+        "--backends", type=parse_list, default=["svg", "sprite"]
+    )
+    parser.add_argument("--caches", type=parse_list, default=list(CACHE_MODES))
+    parser.add_argument("--passes", type=int, default=2)
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", help="Results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    sizes = [int(size) or None for size in args.sizes]
+    specs = get_corpus(args.games, sizes)
+
+    print(
+        f"{len(specs)} images ({len(specs) // len(sizes) // 2} positions, "
+        f"sizes {args.sizes}, both orientations), {args.passes} passes"
+    )
+    print(f"chess.svg.board: {bench_svg(specs) * 1000:.2f} ms/image")
+
+    results = [
+        run_isolated(backend, cache, specs, args.passes)
+        for backend in args.backends
+        for cache in args.caches
+    ]
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = find_regressions(results, baseline, args.tolerance)
+
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Benchmark building and serializing webhook responses.
+
+Compares, for each shape of response (simple, with a card, with options),
+building it by filling in a copy of get_response_template_for_google as it
+used to be done against get_response_for_google, and serializing it with
+Flask's jsonify against chess_server.responses, with the stdlib encoder and
+with orjson if it is installed.
+
+Usage: python -m benchmarks.bench_responses [--number N] [--repeat N]
+"""
+import argparse
+import shutil
+import tempfile
+import timeit
+from typing import Any, Callable, Dict, List
+
+from flask import jsonify
+
+from chess_server import responses
+from chess_server.utils import (
+    BasicCard,
+    Image,
+    get_response_for_google,
+    get_response_template_for_google,
+)
+
+
+def get_shapes() -> Dict[str, Dict[str, Any]]:
+    """Arguments of get_response_for_google for each shape of response"""
+    card = BasicCard(
+        image=Image(
+            url="https://example.com/webhook/images/boards/spam/12",
+            accessibilityText="Board",
+        ),
+        title="Board",
+    )
+    options = [
+        {
+            "optionInfo": {"key": f"option {i}"},
+            "description": f"Description {i}",
+            "title": f"Option {i}",
+        }
+        for i in range(4)
+    ]
+    text = "Knight from g1 to f3. Your move."
+
+    return {
+        "simple": {"textToSpeech": text},
+        "card": {"textToSpeech": text, "basicCard": card},
+        "options": {"textToSpeech": text, "options": options},
+    }
+
+
+def build_from_template(
+    textToSpeech,
+    displayText=None,
+    expectUserResponse=True,
+    basicCard=None,
+    options=None,
+) -> Dict[str, Any]:
+    """Response built the way get_response_for_google used to build it"""
+    template = get_response_template_for_google(options=bool(options))
+
+    template["payload"]["google"]["expectUserResponse"] = expectUserResponse
+    template["payload"]["google"]["richResponse"]["items"][0][
+        "simpleResponse"
+    ]["textToSpeech"] = textToSpeech
+
+    if displayText:
+        template["payload"]["google"]["richResponse"]["items"][0][
+            "simpleResponse"
+        ]["displayText"] = displayText
+
+    if options:
+        template["payload"]["google"]["systemIntent"]["data"]["listSelect"][
+            "items"
+        ] = options
+
+    if basicCard:
+        template["payload"]["google"]["richResponse"]["items"].append(
+            {"basicCard": basicCard.make_dict()}
+        )
+
+    return template
+
+
+def serialize_with_jsonify(res: Dict[str, Any]) -> bytes:
+    return jsonify(res).get_data()
+
+
+def serialize_with_stdlib(res: Dict[str, Any]) -> bytes:
+    orjson, responses.orjson = responses.orjson, None
+    try:
+        return responses.dumps(res)
+    finally:
+        responses.orjson = orjson
+
+
+def time_per_call(func: Callable, number: int, repeat: int) -> float:
+    """Best of `repeat` runs, in microseconds per call"""
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return best / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    from chess_server import create_app
+
+    img_dir = tempfile.mkdtemp(prefix="bench-responses-")
+    app = create_app(
+        env="test",
+        test_config={
+            "IMG_DIR": img_dir,
+            "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        },
+    )
+
+    serializers: List = [
+        ("jsonify", serialize_with_jsonify),
+        ("stdlib", serialize_with_stdlib),
+    ]
+    if responses.orjson is not None:
+        serializers.append(("orjson", responses.dumps))
+
+    print(
+        f"{'shape':>8} {'template':>9} {'builder':>8} "
+        + " ".join(f"{name:>8}" for name, _ in serializers)
+        + "  (us per response)"
+    )
+
+    with app.app_context():
+        for shape, kwargs in get_shapes().items():
+            old = time_per_call(
+                lambda: build_from_template(**kwargs), args.number, args.repeat
+            )
+            new = time_per_call(
+                lambda: get_response_for_google(**kwargs),
+                args.number,
+                args.repeat,
+            )
+            res = get_response_for_google(**kwargs)
+            timings = [
+                time_per_call(lambda: func(res), args.number, args.repeat)
+                for _, func in serializers
+            ]
+
+            print(
+                f"{shape:>8} {old:>9.2f} {new:>8.2f} "
+                + " ".join(f"{t:>8.2f}" for t in timings)
+            )
+
+    shutil.rmtree(img_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
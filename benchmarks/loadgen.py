@@ -0,0 +1,481 @@
+"""Load test the webhook with synthetic players, each playing a full game.
+
+Every session says hello with a color, then plays legal moves through a mix
+of intents like a real player would (SAN moves, two squares, castling,
+asking for the board, undoing) until the game ends or `--max-turns` is
+reached, when it resigns. Images of the cards it gets are fetched, like the
+Assistant does. Requests are built with the payload builders of the tests.
+
+The server must play with StubEngine, which picks a move from the position
+alone, so that players can follow their games without reading the replies.
+By default the app runs in-process with a test client. With --url, requests
+go over HTTP to a server started with `python -m benchmarks.loadgen serve`,
+or with gunicorn: gunicorn "benchmarks.loadgen:create_stub_app()".
+
+Usage: python -m benchmarks.loadgen [run] [--sessions N] [--concurrency N]
+    [--max-turns N] [--seed N] [--url URL] [--output FILE]
+       python -m benchmarks.loadgen serve [--host HOST] [--port PORT]
+"""
+import argparse
+import collections
+import json
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import chess
+import chess.engine
+
+from benchmarks.bench_render import percentile
+from chess_server.intents import ERROR_RESPONSES
+from tests.utils import (
+    GoogleWebhookResponse,
+    get_dummy_webhook_request_for_google,
+)
+
+# Relative weights of the intents of a turn, among those which make sense
+# in the position
+INTENT_MIX = {
+    "simply_san": 55,
+    "two_squares": 25,
+    "castle": 10,
+    "show_board": 7,
+    "undo": 3,
+}
+MAX_UNDOS = 3
+PIECE_NAMES = {
+    chess.QUEEN: "queen",
+    chess.ROOK: "rook",
+    chess.BISHOP: "bishop",
+    chess.KNIGHT: "knight",
+}
+COLOR_RE = re.compile(r"playing with the (white|black) pieces")
+REJECTED_RE = re.compile(r"not legal|not valid|ambiguous")
+
+
+def stub_move(board: chess.Board) -> chess.Move:
+    """A legal move which depends on the position only"""
+    moves = sorted(board.legal_moves, key=lambda move: move.uci())
+    return moves[zlib.crc32(board.fen().encode()) % len(moves)]
+
+
+class StubEngine:
+    """Stands in for the UCI engine, answering at once with `stub_move`"""
+
+    def play(self, board: chess.Board, limit, **kwargs):
+        return chess.engine.PlayResult(stub_move(board), None)
+
+    def quit(self):
+        pass
+
+
+def create_stub_app(env: str = "dev", test_config=None, engine=None):
+    """The app, playing with StubEngine unless given another engine"""
+    from chess_server import create_app
+    from chess_server.main import mediator
+
+    app = create_app(env=env, test_config=test_config)
+    mediator.engine = engine or StubEngine()
+
+    return app
+
+
+def is_game_over(board: chess.Board) -> bool:
+    """Whether the server ends the game in this position"""
+    return board.result(claim_draw=True) != "*"
+
+
+class Sample(NamedTuple):
+    action: str
+    seconds: float
+    error: Optional[str] = None
+
+
+class InProcessTransport:
+    """Posts to the app with a test client per thread"""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    @property
+    def client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+
+        return self._local.client
+
+    def post(self, req: Dict[str, Any]) -> Tuple[int, Any]:
+        response = self.client.post("/webhook", json=req)
+        return response.status_code, response.get_json(silent=True)
+
+    def get(self, path: str) -> int:
+        response = self.client.get(path)
+        response.get_data()
+        return response.status_code
+
+
+class HTTPTransport:
+    """Posts to a server over HTTP"""
+
+    def __init__(self, url: str, timeout: float = 30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, path: str, data: Optional[bytes] = None):
+        req = urllib.request.Request(
+            f"{self.url}{path}",
+            data=data,
+            headers={"Content-Type": "application/json"} if data else {},
+        )
+
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read()
+
+    def post(self, req: Dict[str, Any]) -> Tuple[int, Any]:
+        status, body = self.request("/webhook", json.dumps(req).encode())
+
+        try:
+            return status, json.loads(body)
+        except ValueError:
+            return status, None
+
+    def get(self, path: str) -> int:
+        return self.request(path)[0]
+
+
+class Player:
+    """Plays one game in a session of its own, following the position on
+    a board of its own, and records a sample per request"""
+
+    def __init__(self, transport, seed: int, max_turns: int):
+        self.transport = transport
+        self.rng = random.Random(seed)
+        self.max_turns = max_turns
+        self.session_id = uuid.UUID(int=self.rng.getrandbits(128)).hex
+        self.board = chess.Board()
+        self.color = chess.WHITE
+        self.contexts: List[Dict[str, Any]] = []
+        self.undos = 0
+        self.samples: List[Sample] = []
+
+    def send(
+        self, action: str, queryText: str = "", **parameters
+    ) -> Optional[GoogleWebhookResponse]:
+        """Post an intent, record how it went and return the response,
+        None if it failed"""
+        req = get_dummy_webhook_request_for_google(
+            session_id=self.session_id,
+            action=action,
+            queryText=queryText,
+            parameters=parameters,
+        )
+        # Every delivery is a new one to the idempotency cache
+        req["responseId"] = str(uuid.UUID(int=self.rng.getrandbits(128)))
+        # Contexts of the last response, which carry the game in
+        # STATELESS_MODE
+        req["queryResult"]["outputContexts"] = self.contexts
+
+        start = time.perf_counter()
+        try:
+            status, body = self.transport.post(req)
+        except Exception as exc:
+            self.record(action, start, type(exc).__name__)
+            return None
+
+        if status != 200 or body is None:
+            self.record(action, start, f"http_{status}")
+            return None
+
+        try:
+            response = GoogleWebhookResponse(body)
+        except (KeyError, IndexError, TypeError):
+            self.record(action, start, "bad_response")
+            return None
+
+        speech = response.simple_response.text_to_speech or ""
+        if speech in ERROR_RESPONSES.values():
+            error = next(
+                key for key, text in ERROR_RESPONSES.items() if text == speech
+            )
+        elif REJECTED_RE.search(speech):
+            error = "rejected"
+        else:
+            error = None
+
+        self.record(action, start, error)
+        self.contexts = body.get("outputContexts", self.contexts)
+        self.fetch_card_image(response)
+
+        return None if error else response
+
+    def record(self, action: str, start: float, error: Optional[str]):
+        seconds = time.perf_counter() - start
+        self.samples.append(Sample(action, seconds, error))
+
+    def fetch_card_image(self, response: GoogleWebhookResponse):
+        card = response.basic_card
+        if card is None or card.image is None:
+            return
+
+        url = urllib.parse.urlsplit(card.image.url)
+        path = f"{url.path}?{url.query}" if url.query else url.path
+
+        start = time.perf_counter()
+        try:
+            status = self.transport.get(path)
+        except Exception as exc:
+            self.record("image", start, type(exc).__name__)
+            return
+
+        error = None if status == 200 else f"http_{status}"
+        self.record("image", start, error)
+
+    def play(self) -> List[Sample]:
+        color = self.rng.choice(["white", "black", "random"])
+        response = self.send("welcome", color=color)
+        if response is None:
+            return self.samples
+
+        match = COLOR_RE.search(response.simple_response.text_to_speech)
+        self.color = chess.WHITE if match.group(1) == "white" else chess.BLACK
+
+        if self.color is chess.BLACK:
+            self.board.push(stub_move(self.board))
+
+        for _ in range(self.max_turns):
+            action = self.choose_action()
+
+            if action == "show_board":
+                response = self.send("show_board", "show board")
+            elif action == "undo":
+                response = self.undo()
+            else:
+                response = self.play_move(action)
+
+            if response is None:
+                break
+
+            if response.expect_user_response == is_game_over(self.board):
+                # The server's game went another way than this one
+                self.samples[-1] = self.samples[-1]._replace(error="desync")
+                break
+
+            if not response.expect_user_response:
+                return self.samples
+
+        self.send("resign", "resign")
+        return self.samples
+
+    def choose_action(self) -> str:
+        board = self.board
+        allowed = {
+            "castle": any(board.is_castling(m) for m in board.legal_moves),
+            "undo": board.fullmove_number > 1 and self.undos < MAX_UNDOS,
+        }
+        actions = [a for a in INTENT_MIX if allowed.get(a, True)]
+        weights = [INTENT_MIX[a] for a in actions]
+
+        return self.rng.choices(actions, weights)[0]
+
+    def undo(self) -> Optional[GoogleWebhookResponse]:
+        """Undo like undo_users_last_move does on the server"""
+        self.undos += 1
+        self.board.pop()
+        if self.board.turn is not self.color:
+            self.board.pop()
+
+        return self.send("undo", "undo")
+
+    def play_move(self, action: str) -> Optional[GoogleWebhookResponse]:
+        moves = list(self.board.legal_moves)
+
+        if action == "castle":
+            castles = [m for m in moves if self.board.is_castling(m)]
+            move = self.rng.choice(castles)
+            side = (
+                "kingside"
+                if chess.square_file(move.to_square) > 4
+                else "queenside"
+            )
+            request = ("castle", f"castle {side}", {})
+
+        else:
+            move = self.rng.choice(moves)
+
+            if action == "two_squares":
+                squares = [
+                    chess.square_name(move.from_square),
+                    chess.square_name(move.to_square),
+                ]
+                piece = PIECE_NAMES.get(move.promotion, "")
+                params = {"squares": squares, "piece": piece}
+                request = ("two_squares", " to ".join(squares), params)
+            else:
+                san = self.board.san(move)
+                request = ("simply_san", san, {"san": san})
+
+        self.board.push(move)
+        if not is_game_over(self.board):
+            self.board.push(stub_move(self.board))
+
+        action, queryText, params = request
+        return self.send(action, queryText, **params)
+
+
+def run_load(
+    transport, sessions: int, concurrency: int, max_turns: int, seed: int
+) -> Dict[str, Any]:
+    """Play `sessions` games, `concurrency` at a time, and sum them up"""
+
+    def play(i: int) -> List[Sample]:
+        return Player(transport, seed + i, max_turns).play()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        games = list(executor.map(play, range(sessions)))
+    elapsed = time.perf_counter() - start
+
+    samples = [sample for game in games for sample in game]
+    by_action = collections.defaultdict(list)
+    for sample in samples:
+        by_action[sample.action].append(sample)
+
+    actions = {}
+    for action, group in sorted(by_action.items()):
+        seconds = [s.seconds for s in group]
+        errors = collections.Counter(s.error for s in group if s.error)
+        actions[action] = {
+            "requests": len(group),
+            "p50_ms": percentile(seconds, 50) * 1000,
+            "p95_ms": percentile(seconds, 95) * 1000,
+            "p99_ms": percentile(seconds, 99) * 1000,
+            "error_rate": sum(errors.values()) / len(group),
+            "errors": dict(errors),
+        }
+
+    errors = sum(1 for s in samples if s.error)
+
+    return {
+        "sessions": sessions,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "seconds": elapsed,
+        "requests_per_sec": len(samples) / elapsed,
+        "games_per_sec": sessions / elapsed,
+        "error_rate": errors / len(samples) if samples else 0,
+        "actions": actions,
+    }
+
+
+def print_results(results: Dict[str, Any]):
+    print(
+        f"{results['sessions']} sessions, {results['concurrency']} at a "
+        f"time: {results['requests']} requests in "
+        f"{results['seconds']:.1f} s, {results['requests_per_sec']:.0f} "
+        f"requests/s, {results['games_per_sec']:.1f} games/s, "
+        f"{results['error_rate']:.2%} errors"
+    )
+    print(
+        f"{'action':>12} {'requests':>9} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'errors':>7}  by kind"
+    )
+
+    for action, r in results["actions"].items():
+        kinds = ", ".join(f"{k}: {n}" for k, n in sorted(r["errors"].items()))
+        print(
+            f"{action:>12} {r['requests']:>9} {r['p50_ms']:>8.2f} "
+            f"{r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+            f"{r['error_rate']:>7.2%}  {kinds}"
+        )
+
+
+def run(args):
+    img_dir = None
+
+    if args.url:
+        transport = HTTPTransport(args.url)
+    else:
+        img_dir = tempfile.mkdtemp(prefix="loadgen-")
+        app = create_stub_app(
+            env="test",
+            test_config={
+                "IMG_DIR": img_dir,
+                # A file, as every thread needs to see the same database
+                "SQLALCHEMY_DATABASE_URI": f"sqlite:///{img_dir}/games.db",
+            },
+        )
+        transport = InProcessTransport(app)
+
+    try:
+        results = run_load(
+            transport,
+            args.sessions,
+            args.concurrency,
+            args.max_turns,
+            args.seed,
+        )
+    finally:
+        if img_dir is not None:
+            shutil.rmtree(img_dir, ignore_errors=True)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def serve(args):
+    from werkzeug.serving import run_simple
+
+    app = create_stub_app(env=args.env)
+    # Answer on the host the players use, and link images on it
+    app.config["SERVER_NAME"] = None
+    run_simple(args.host, args.port, app, threaded=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run", help="Run the load test")
+    serve_parser = commands.add_parser(
+        "serve", help="Serve the app with StubEngine"
+    )
+
+    for p in (parser, run_parser):
+        p.add_argument("--sessions", type=int, default=1000)
+        p.add_argument("--concurrency", type=int, default=8)
+        p.add_argument("--max-turns", type=int, default=60)
+        p.add_argument("--seed", type=int, default=0)
+        p.add_argument("--url", help="Base URL of a server to load over HTTP")
+        p.add_argument("--output", help="Write the results as JSON")
+
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--env", default="dev")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
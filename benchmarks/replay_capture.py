@@ -0,0 +1,428 @@
+"""Replay captured webhook traffic and diff the responses.
+
+Plays back the files written by the traffic recorder (CAPTURE_ENABLED) at
+the pace they were captured, `--speed` times faster, or as fast as it can
+with --speed 0. Requests of a session are sent one after the other, sessions
+overlap like they did. The engine plays the moves it played in the capture,
+and `stub_move` in positions it has none for, so games go the same way.
+
+Every response is compared with the captured one, leaving out the host of
+URLs and the prompt phrases picked at random. Random colors are pinned to
+the ones given in the capture. Image URLs only match with the SECRET_KEY
+and render settings of the captured server. Latencies by action are
+reported next to the captured ones, and the exit status is 1 if any
+response differs.
+
+By default the app runs in-process with a test client. With --url, the
+capture is replayed over HTTP against a server started with
+`python -m benchmarks.replay_capture serve FILE...`.
+
+Usage: python -m benchmarks.replay_capture run FILE... [--speed N]
+    [--concurrency N] [--url URL] [--show-diffs N] [--output FILE]
+       python -m benchmarks.replay_capture serve FILE... [--host HOST]
+    [--port PORT]
+"""
+import argparse
+import collections
+import heapq
+import json
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import chess
+import chess.engine
+from flask import has_request_context, request
+
+from benchmarks.bench_render import percentile
+from benchmarks.loadgen import (
+    COLOR_RE,
+    HTTPTransport,
+    InProcessTransport,
+    create_stub_app,
+    stub_move,
+)
+from chess_server.capture import read_capture
+from chess_server.utils import PROMPT_PHRASES
+
+URL_HOST_RE = re.compile(r"https?://[^/\s\"]+")
+MISSING = "<missing>"
+
+
+def get_session_id(req: Dict[str, Any]) -> str:
+    return req["session"].split("/")[-1]
+
+
+def load_records(paths: List[str]) -> List[Dict[str, Any]]:
+    """Records of the capture files, in the order they were captured"""
+    records = [record for path in paths for record in read_capture(path)]
+    return sorted(records, key=lambda record: record["ts"])
+
+
+class ReplayEngine:
+    """Plays the moves the engine played in the capture, by session and
+    position, and `stub_move` in positions it has none for"""
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.moves: Dict[Tuple[str, str], str] = {}
+        self.fallbacks = 0
+
+        for record in records:
+            session_id = get_session_id(record["request"])
+            for fen, uci in record.get("engine_moves", []):
+                self.moves[(session_id, fen)] = uci
+
+    def play(self, board: chess.Board, limit, **kwargs):
+        session_id = None
+        if has_request_context():
+            session_id = get_session_id(request.get_json())
+
+        uci = self.moves.get((session_id, board.fen()))
+
+        if uci is None:
+            self.fallbacks += 1
+            move = stub_move(board)
+        else:
+            move = chess.Move.from_uci(uci)
+
+        return chess.engine.PlayResult(move, None)
+
+    def quit(self):
+        pass
+
+
+def normalize(value: Any) -> Any:
+    """The parts of a response which should not change between runs"""
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [normalize(item) for item in value]
+
+    if isinstance(value, str):
+        value = URL_HOST_RE.sub("", value)
+        for phrase in sorted(PROMPT_PHRASES, key=len, reverse=True):
+            value = value.replace(phrase, "<prompt>")
+
+    return value
+
+
+def diff(captured: Any, replayed: Any, path: str = "$") -> List[tuple]:
+    """Paths at which two JSON values differ, with both values"""
+    if isinstance(captured, dict) and isinstance(replayed, dict):
+        return [
+            difference
+            for key in sorted(set(captured) | set(replayed))
+            for difference in diff(
+                captured.get(key, MISSING),
+                replayed.get(key, MISSING),
+                f"{path}.{key}",
+            )
+        ]
+
+    if isinstance(captured, list) and isinstance(replayed, list):
+        differences = []
+        for i in range(max(len(captured), len(replayed))):
+            differences.extend(
+                diff(
+                    captured[i] if i < len(captured) else MISSING,
+                    replayed[i] if i < len(replayed) else MISSING,
+                    f"{path}[{i}]",
+                )
+            )
+        return differences
+
+    if captured != replayed:
+        return [(path, captured, replayed)]
+
+    return []
+
+
+def pin_random_color(req: Dict[str, Any], captured: Optional[Dict]):
+    """Ask for the color given in the capture instead of a random one"""
+    match = COLOR_RE.search(json.dumps(captured))
+    if match is None:
+        return
+
+    params = req["queryResult"].get("parameters", {})
+    if params.get("color") == "random":
+        params["color"] = match.group(1)
+
+    original = req.get("originalDetectIntentRequest", {})
+    for each in original.get("payload", {}).get("inputs", []):
+        for argument in each.get("arguments", []):
+            if argument.get("name") == "OPTION":
+                if argument.get("textValue") == "random":
+                    argument["textValue"] = match.group(1)
+
+
+class Result(NamedTuple):
+    session_id: str
+    action: str
+    seconds: float
+    captured_seconds: float
+    lag: float
+    error: Optional[str]
+    differences: List[tuple]
+
+
+def send(transport, record: Dict[str, Any], lag: float) -> Result:
+    req = json.loads(json.dumps(record["request"]))
+    pin_random_color(req, record["response"])
+    action = req["queryResult"].get("action") or "unknown"
+
+    start = time.perf_counter()
+    try:
+        status, body = transport.post(req)
+    except Exception as exc:
+        status, body, error = None, None, type(exc).__name__
+    else:
+        error = None
+    seconds = time.perf_counter() - start
+
+    differences = []
+    if error is None:
+        if status != record["status"]:
+            differences.append(("status", record["status"], status))
+        differences.extend(
+            diff(normalize(record["response"]), normalize(body))
+        )
+
+    return Result(
+        get_session_id(record["request"]),
+        action,
+        seconds,
+        record["duration"],
+        lag,
+        error,
+        differences,
+    )
+
+
+def replay(
+    records: List[Dict[str, Any]], transport, speed: float, concurrency: int
+) -> Tuple[List[Result], float]:
+    """Send every record when it is due, the next one of a session once the
+    last one is answered. Returns the results and the time taken."""
+    sessions = collections.defaultdict(list)
+    for record in records:
+        sessions[get_session_id(record["request"])].append(record)
+
+    t0 = records[0]["ts"] if records else 0
+    # Due time, order of the session, session id, index of the record
+    due = [
+        (
+            (session[0]["ts"] - t0) / speed if speed else 0,
+            i,
+            session_id,
+            0,
+        )
+        for i, (session_id, session) in enumerate(sessions.items())
+    ]
+    heapq.heapify(due)
+    results: List[Result] = []
+    cond = threading.Condition()
+    in_flight = 0
+    start = time.perf_counter()
+
+    def step(at: float, order: int, session_id: str, index: int):
+        nonlocal in_flight
+        session = sessions[session_id]
+        # How late it is sent, which is meaningless at full speed
+        lag = time.perf_counter() - start - at if speed else 0
+        result = send(transport, session[index], lag)
+
+        with cond:
+            results.append(result)
+            in_flight -= 1
+
+            if index + 1 < len(session):
+                at = (session[index + 1]["ts"] - t0) / speed if speed else 0
+                heapq.heappush(due, (at, order, session_id, index + 1))
+
+            cond.notify()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        with cond:
+            while due or in_flight:
+                if not due or (not speed and in_flight >= concurrency):
+                    cond.wait()
+                    continue
+
+                at, order, session_id, index = due[0]
+                delay = at - (time.perf_counter() - start)
+                if delay > 0:
+                    cond.wait(delay)
+                    continue
+
+                heapq.heappop(due)
+                in_flight += 1
+                executor.submit(step, at, order, session_id, index)
+
+    return results, time.perf_counter() - start
+
+
+def summarize(results: List[Result], elapsed: float) -> Dict[str, Any]:
+    by_action = collections.defaultdict(list)
+    for result in results:
+        by_action[result.action].append(result)
+
+    actions = {}
+    for action, group in sorted(by_action.items()):
+        seconds = [r.seconds for r in group]
+        captured = [r.captured_seconds for r in group]
+        actions[action] = {
+            "requests": len(group),
+            "captured_p50_ms": percentile(captured, 50) * 1000,
+            "captured_p99_ms": percentile(captured, 99) * 1000,
+            "p50_ms": percentile(seconds, 50) * 1000,
+            "p95_ms": percentile(seconds, 95) * 1000,
+            "p99_ms": percentile(seconds, 99) * 1000,
+            "errors": sum(1 for r in group if r.error),
+            "differing": sum(1 for r in group if r.differences),
+        }
+
+    return {
+        "requests": len(results),
+        "sessions": len({r.session_id for r in results}),
+        "seconds": elapsed,
+        "requests_per_sec": len(results) / elapsed if elapsed else 0,
+        "lag_p99_ms": percentile([r.lag for r in results], 99) * 1000
+        if results
+        else 0,
+        "errors": sum(1 for r in results if r.error),
+        "differing": sum(1 for r in results if r.differences),
+        "actions": actions,
+        "differences": [
+            {
+                "session": r.session_id,
+                "action": r.action,
+                "path": path,
+                "captured": captured,
+                "replayed": replayed,
+            }
+            for r in results
+            for path, captured, replayed in r.differences
+        ],
+    }
+
+
+def print_results(summary: Dict[str, Any], show_diffs: int):
+    print(
+        f"{summary['requests']} requests of {summary['sessions']} sessions "
+        f"in {summary['seconds']:.1f} s, {summary['requests_per_sec']:.0f} "
+        f"requests/s, p99 lag {summary['lag_p99_ms']:.0f} ms, "
+        f"{summary['errors']} errors, {summary['differing']} responses "
+        "differ"
+    )
+    print(
+        f"{'action':>12} {'requests':>9} {'was p50':>8} {'was p99':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} "
+        f"{'differ':>7}"
+    )
+
+    for action, r in summary["actions"].items():
+        print(
+            f"{action:>12} {r['requests']:>9} {r['captured_p50_ms']:>8.2f} "
+            f"{r['captured_p99_ms']:>8.2f} {r['p50_ms']:>8.2f} "
+            f"{r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['errors']:>7} "
+            f"{r['differing']:>7}"
+        )
+
+    for d in summary["differences"][:show_diffs]:
+        print(
+            f"DIFF {d['session']} {d['action']} {d['path']}: "
+            f"{d['captured']!r} -> {d['replayed']!r}"
+        )
+
+
+def run(args):
+    records = load_records(args.files)
+    img_dir = None
+
+    if args.url:
+        transport = HTTPTransport(args.url)
+    else:
+        img_dir = tempfile.mkdtemp(prefix="replay-")
+        app = create_stub_app(
+            env="test",
+            test_config={
+                "IMG_DIR": img_dir,
+                # A file, as every thread needs to see the same database
+                "SQLALCHEMY_DATABASE_URI": f"sqlite:///{img_dir}/games.db",
+            },
+            engine=ReplayEngine(records),
+        )
+        transport = InProcessTransport(app)
+
+    try:
+        results, elapsed = replay(
+            records, transport, args.speed, args.concurrency
+        )
+    finally:
+        if img_dir is not None:
+            shutil.rmtree(img_dir, ignore_errors=True)
+
+    summary = summarize(results, elapsed)
+    print_results(summary, args.show_diffs)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if summary["differing"]:
+        sys.exit(1)
+
+
+def serve(args):
+    from werkzeug.serving import run_simple
+
+    app = create_stub_app(
+        env=args.env, engine=ReplayEngine(load_records(args.files))
+    )
+    # Answer on the host the replay uses, and link images on it
+    app.config["SERVER_NAME"] = None
+    run_simple(args.host, args.port, app, threaded=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Replay the capture")
+    serve_parser = commands.add_parser(
+        "serve", help="Serve the app with the engine moves of the capture"
+    )
+
+    run_parser.add_argument("files", nargs="+", help="Capture files")
+    run_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1,
+        help="Times faster than captured, 0 for as fast as possible",
+    )
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--url", help="Base URL of a server to replay on")
+    run_parser.add_argument("--show-diffs", type=int, default=10)
+    run_parser.add_argument("--output", help="Write the summary as JSON")
+
+    serve_parser.add_argument("files", nargs="+", help="Capture files")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--env", default="dev")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
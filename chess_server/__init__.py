@@ -22,12 +22,40 @@ def create_app(env="dev", test_config=None):
     if not os.path.exists(app.config["IMG_DIR"]):  # pragma: no cover
         os.mkdir(app.config["IMG_DIR"])
 
+    from chess_server import dbpool, logconfig, storage
+    from chess_server.metrics import metrics_dir
+    from chess_server.profiling import profiler
+    from chess_server.tracing import tracer
+
+    logconfig.init_app(app)
+    metrics_dir.init_app(app)
+    tracer.init_app(app)
+    profiler.init_app(app)
+    dbpool.init_app(app)
+    storage.init_app(app)
     db.init_app(app)
 
     with app.app_context():
         from chess_server import routes, models  # noqa: F401
+        from chess_server.archive import archive_writer
+        from chess_server.capture import traffic_recorder
+        from chess_server.idempotency import idempotency_cache
+        from chess_server.migrations import upgrade_db_command
+        from chess_server.reaper import session_reaper
+        from chess_server.render import render_cache
+        from chess_server.renderpool import render_pool
+        from chess_server.replay import replay_recorder
+
+        archive_writer.init_app(app)
+        idempotency_cache.init_app(app)
+        session_reaper.init_app(app)
+        render_cache.init_app(app)
+        render_pool.init_app(app)
+        replay_recorder.init_app(app)
+        traffic_recorder.init_app(app)
 
         app.register_blueprint(routes.webhook_bp)
+        app.cli.add_command(upgrade_db_command)
 
         # Initialize database
         db.create_all()
@@ -0,0 +1,252 @@
+import atexit
+import logging
+import queue
+import struct
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import chess
+from flask import current_app
+
+from chess_server import db
+from chess_server.models import UserModel
+
+logger = logging.getLogger(__name__)
+
+PROMOTION_PIECES = [None, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN]
+
+# Held while a month's table is defined and created, which flushes of
+# several threads can race for
+_tables_lock = threading.Lock()
+
+
+def pack_moves(moves: List[chess.Move]) -> bytes:
+    """Pack moves into 2 bytes each: from square, to square and promotion"""
+    return b"".join(
+        struct.pack(
+            ">H",
+            move.from_square
+            | move.to_square << 6
+            | PROMOTION_PIECES.index(move.promotion) << 12,
+        )
+        for move in moves
+    )
+
+
+def unpack_moves(data: bytes) -> List[chess.Move]:
+    """Inverse of `pack_moves`"""
+    moves = []
+
+    for (value,) in struct.iter_unpack(">H", data):
+        promotion = PROMOTION_PIECES[value >> 12]
+        moves.append(chess.Move(value & 63, value >> 6 & 63, promotion))
+
+    return moves
+
+
+def get_archive_table(month: str) -> db.Table:
+    """Get the archive partition for a month given as YYYY-MM, creating it
+    on first use. Old months can be detached or dropped as whole tables.
+    """
+    name = f"game_archive_{month.replace('-', '_')}"
+
+    table = db.metadata.tables.get(name)
+    if table is not None:
+        return table
+
+    with _tables_lock:
+        table = db.metadata.tables.get(name)
+        if table is None:
+            table = define_archive_table(name)
+            table.create(db.engine, checkfirst=True)
+
+    return table
+
+
+def define_archive_table(name: str) -> db.Table:
+    return db.Table(
+        name,
+        db.metadata,
+        db.Column("id", db.Integer, primary_key=True),
+        db.Column("session_id", db.String(128), nullable=False),
+        # FEN of the starting position, NULL for the standard one
+        db.Column("start_fen", db.String(100), nullable=True),
+        db.Column("moves", db.LargeBinary, nullable=False),
+        db.Column("plies", db.Integer, nullable=False),
+        db.Column("result", db.String(7), nullable=False),
+        db.Column("color", db.Boolean, nullable=False),
+        db.Column("started_at", db.DateTime, nullable=True),
+        db.Column("ended_at", db.DateTime, nullable=False),
+    )
+
+
+def load_archived_board(row: Any) -> chess.Board:
+    """Replay an archived game row into a board"""
+    board = chess.Board(row.start_fen) if row.start_fen else chess.Board()
+
+    for move in unpack_moves(row.moves):
+        board.push(move)
+
+    return board
+
+
+class ArchiveWriter:
+    """Buffers finished games and bulk writes them to the archive tables.
+
+    A background thread flushes the buffer every ARCHIVE_FLUSH_INTERVAL
+    seconds or as soon as ARCHIVE_BATCH_SIZE games are waiting. An interval
+    of 0 disables the thread and writes synchronously instead. Games of a
+    failed write are put back and retried by the next flush, or at exit,
+    when those which still fail are logged.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.buffer = queue.Queue()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions["archive_writer"] = self
+        atexit.register(self.close)
+
+    @property
+    def interval(self) -> float:
+        return self.app.config["ARCHIVE_FLUSH_INTERVAL"]
+
+    @property
+    def batch_size(self) -> int:
+        return self.app.config["ARCHIVE_BATCH_SIZE"]
+
+    def enqueue(self, record: Dict[str, Any]):
+        self.buffer.put(record)
+
+        if not self.interval:
+            self.flush()
+            return
+
+        self._ensure_thread()
+        if self.buffer.qsize() >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """Write all buffered games, returns the number of games written"""
+        records = []
+        while True:
+            try:
+                records.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+
+        if not records:
+            return 0
+
+        by_month = {}
+        for record in records:
+            month = record["ended_at"].strftime("%Y-%m")
+            by_month.setdefault(month, []).append(record)
+
+        with self.app.app_context():
+            try:
+                with db.engine.begin() as conn:
+                    for month, rows in by_month.items():
+                        conn.execute(get_archive_table(month).insert(), rows)
+
+            except Exception as exc:
+                # The live rows are gone, keep the games for the next flush
+                for record in records:
+                    self.buffer.put(record)
+
+                logger.error(
+                    f"Unable to archive {len(records)} games, will retry:\n"
+                    f"{str(exc)}"
+                )
+                return 0
+
+        return len(records)
+
+    def close(self):
+        if self.app is None or self.buffer.empty():
+            return
+
+        self.flush()
+
+        # Games of a failed write wait for the next flush, of which there is
+        # none after this one. Log them rather than losing them silently.
+        while not self.buffer.empty():
+            record = self.buffer.get_nowait()
+            moves = " ".join(
+                move.uci() for move in unpack_moves(record["moves"])
+            )
+            logger.error(
+                f"Dropping the game of {record['session_id']}, which could "
+                f"not be archived: {record['start_fen'] or 'startpos'} "
+                f"moves {moves} result {record['result']}"
+            )
+
+    def _ensure_thread(self):
+        with self._lock:
+            # Started lazily so that each forked worker gets its own thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="archive-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+archive_writer = ArchiveWriter()
+
+
+def get_started_at(session_id: str) -> Optional[datetime]:
+    """When the game of a session was created, None once it is deleted"""
+    if current_app.config["STATELESS_MODE"]:
+        return None
+
+    row = UserModel.query.get(session_id)
+    return row.created_at if row is not None else None
+
+
+def archive_game(
+    session_id: str,
+    board: chess.Board,
+    color: chess.Color,
+    result: Optional[str] = None,
+    started_at: Optional[datetime] = None,
+):
+    """Queue a finished game for the archive.
+    Result defaults to the result of the game on the board.
+
+    Games are not archived in STATELESS_MODE, where the board only holds
+    the last STATELESS_HISTORY_PLIES plies of a game.
+    """
+    config = current_app.config
+    if not config["ARCHIVE_ENABLED"] or config["STATELESS_MODE"]:
+        return
+
+    if started_at is None:
+        started_at = get_started_at(session_id)
+
+    root = board.root()
+    start_fen = None if root.fen() == chess.STARTING_FEN else root.fen()
+
+    archive_writer.enqueue(
+        {
+            "session_id": session_id,
+            "start_fen": start_fen,
+            "moves": pack_moves(board.move_stack),
+            "plies": len(board.move_stack),
+            "result": result or board.result(claim_draw=True),
+            "color": bool(color),
+            "started_at": started_at,
+            "ended_at": datetime.utcnow(),
+        }
+    )
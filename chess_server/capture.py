@@ -0,0 +1,243 @@
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+import chess
+from flask import g, has_request_context, request
+
+from chess_server.metrics import counter
+
+logger = logging.getLogger(__name__)
+
+requests_captured = counter(
+    "webhook_requests_captured_total",
+    "Webhook requests written to the traffic capture",
+)
+captures_dropped = counter(
+    "webhook_captures_dropped_total",
+    "Captured webhook requests dropped because the capture file was full",
+)
+
+WEBHOOK_ENDPOINT = "webhook_bp.webhook"
+
+
+def record_engine_move(board: chess.Board, move: chess.Move):
+    """Note a move of the engine in the capture of the current request, for
+    a replay to play the same one"""
+    if has_request_context() and "capture" in g:
+        g.capture["engine_moves"].append([board.fen(), move.uci()])
+
+
+def read_capture(path: str) -> Iterator[Dict[str, Any]]:
+    """Records of a capture file, in the order they were written"""
+    with gzip.open(path, "rt") as f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                yield json.loads(line)
+        except EOFError:
+            pass  # The last batch was cut short, e.g. by a crash
+
+
+class TrafficRecorder:
+    """Writes webhook requests and their responses, with timing, to
+    gzipped JSON lines in CAPTURE_DIR, one file per worker and day.
+
+    Whole sessions are sampled, CAPTURE_SAMPLE_RATE of them, so that games
+    can be replayed. Session ids and responseIds are replaced by keyed
+    hashes and the Actions on Google user is left out. The moves played by
+    the engine are recorded along, for a replay to play them again.
+
+    Records are buffered and appended as a gzip member every
+    CAPTURE_FLUSH_INTERVAL seconds or as soon as CAPTURE_BATCH_SIZE are
+    waiting, 0 writes synchronously. Once a file has CAPTURE_MAX_FILE_BYTES,
+    records are dropped until the next day.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.path: Optional[str] = None
+        self.buffer = queue.Queue()
+        self._key = b""
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.path = None
+        app.extensions["traffic_recorder"] = self
+
+        if not app.config["CAPTURE_ENABLED"]:
+            return
+
+        self.path = app.config["CAPTURE_DIR"] or os.path.join(
+            app.config["IMG_DIR"], "captures"
+        )
+        os.makedirs(self.path, exist_ok=True)
+
+        secret = app.config["SECRET_KEY"]
+        if isinstance(secret, str):
+            secret = secret.encode()
+        self._key = hashlib.sha256(secret + b"capture").digest()
+
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+        atexit.register(self.close)
+
+    @property
+    def interval(self) -> float:
+        return self.app.config["CAPTURE_FLUSH_INTERVAL"]
+
+    @property
+    def batch_size(self) -> int:
+        return self.app.config["CAPTURE_BATCH_SIZE"]
+
+    def pseudonym(self, value: str) -> str:
+        """Stands for the value in captures, the same in every worker"""
+        digest = hmac.new(self._key, value.encode(), hashlib.sha256)
+        return digest.hexdigest()[:32]
+
+    def is_sampled(self, pseudonym: str) -> bool:
+        rate = self.app.config["CAPTURE_SAMPLE_RATE"]
+        return int(pseudonym[:8], 16) < rate * 2 ** 32
+
+    def start_request(self):
+        if request.endpoint != WEBHOOK_ENDPOINT:
+            return
+
+        req = request.get_json(silent=True)
+        if not isinstance(req, dict) or not req.get("session"):
+            return
+
+        session_id = str(req["session"]).split("/")[-1]
+        pseudonym = self.pseudonym(session_id)
+
+        if not self.is_sampled(pseudonym):
+            return
+
+        g.capture = {
+            "ts": time.time(),
+            "start": time.perf_counter(),
+            "session_id": session_id,
+            "pseudonym": pseudonym,
+            "engine_moves": [],
+        }
+
+    def end_request(self, response):
+        capture = g.pop("capture", None)
+        if capture is None:
+            return response
+
+        try:
+            self.enqueue(self.make_record(capture, response))
+        except Exception as exc:
+            logger.warning(f"Unable to capture request: {exc}")
+
+        return response
+
+    def make_record(self, capture: Dict[str, Any], response) -> bytes:
+        """The anonymised record of the request, as a line of JSON"""
+        # A copy, as the request's JSON is cached by Flask
+        req = json.loads(request.get_data())
+        req.get("originalDetectIntentRequest", {}).get("payload", {}).pop(
+            "user", None
+        )
+        if req.get("responseId"):
+            req["responseId"] = self.pseudonym(str(req["responseId"]))
+
+        record = {
+            "ts": capture["ts"],
+            "duration": time.perf_counter() - capture["start"],
+            "status": response.status_code,
+            "request": req,
+            "response": response.get_json(silent=True),
+            "engine_moves": capture["engine_moves"],
+        }
+        line = json.dumps(record, separators=(",", ":"))
+
+        # Also in contexts, the conversation id and image URLs
+        line = line.replace(capture["session_id"], capture["pseudonym"])
+
+        return (line + "\n").encode()
+
+    def enqueue(self, line: bytes):
+        self.buffer.put(line)
+
+        if not self.interval:
+            self.flush()
+            return
+
+        self._ensure_thread()
+        if self.buffer.qsize() >= self.batch_size:
+            self._wakeup.set()
+
+    def get_file_path(self) -> str:
+        name = f"{time.strftime('%Y%m%d')}-{os.getpid()}.jsonl.gz"
+        return os.path.join(self.path, name)
+
+    def flush(self) -> int:
+        """Append all buffered records, returns the number written"""
+        lines = []
+        while True:
+            try:
+                lines.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+
+        if not lines:
+            return 0
+
+        path = self.get_file_path()
+
+        with self._write_lock:
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                size = 0
+
+            if size >= self.app.config["CAPTURE_MAX_FILE_BYTES"]:
+                captures_dropped.inc(len(lines))
+                return 0
+
+            try:
+                with open(path, "ab") as f:
+                    f.write(gzip.compress(b"".join(lines)))
+            except OSError as exc:
+                logger.error(f"Unable to write {len(lines)} captures: {exc}")
+                return 0
+
+        requests_captured.inc(len(lines))
+        return len(lines)
+
+    def close(self):
+        if self.path is not None and not self.buffer.empty():
+            self.flush()
+
+    def _ensure_thread(self):
+        with self._lock:
+            # Started lazily so that each forked worker gets its own thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="traffic-recorder", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+traffic_recorder = TrafficRecorder()
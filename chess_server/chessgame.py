@@ -1,17 +1,32 @@
 import logging
+import threading
+import time
 from typing import Optional
 
 import chess.engine
 from flask import current_app
 
+from chess_server.capture import record_engine_move
+from chess_server.metrics import histogram
+from chess_server.tracing import span
 from chess_server.utils import get_user, update_user, lan_to_speech
 
 logger = logging.getLogger(__name__)
 
+engine_wait = histogram(
+    "engine_queue_wait_seconds",
+    "Time spent waiting for the engine to finish searches for other requests",
+)
+engine_search = histogram(
+    "engine_search_seconds", "Time taken by the engine to pick a move"
+)
+
 
 class Mediator:
     def __init__(self):
         self.engine = None
+        # The engine runs one search at a time
+        self._lock = threading.Lock()
 
     def activate_engine(self, engine_path: Optional[str] = None):
 
@@ -24,15 +39,12 @@ class Mediator:
             self.engine = chess.engine.SimpleEngine.popen_uci(engine_path)
         except Exception as exc:
             # Log and throw error
-            print(
-                f"Error while trying to set up engine from path {engine_path}."
-                " See logs for more details."
-            )
             logger.error(
                 f"Error while initializing engine from {engine_path}:\n{exc}"
             )
             raise
 
+    @span("mediator.play_engine_move")
     def play_engine_move_and_get_speech(self, session_id: str) -> str:
         """Play engine's move and return the speech conversion of the move"""
 
@@ -41,8 +53,17 @@ class Mediator:
 
         user = get_user(session_id)
 
-        # Doesn't actually play the move
-        result = self.engine.play(user.board, chess.engine.Limit(time=0.100))
+        start = time.perf_counter()
+        with self._lock:
+            engine_wait.observe(time.perf_counter() - start)
+
+            # Doesn't actually play the move
+            with engine_search.time(), span("engine.play"):
+                result = self.engine.play(
+                    user.board, chess.engine.Limit(time=0.100)
+                )
+
+        record_engine_move(user.board, result.move)
 
         # Store LAN notation and push
         lan = user.board.lan(result.move)
@@ -53,6 +74,7 @@ class Mediator:
 
         return lan_to_speech(lan)
 
+    @span("mediator.play_lan")
     def play_lan(self, session_id: str, lan: str) -> bool:
         """Play move and return bool showing if move was successful"""
 
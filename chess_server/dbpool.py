@@ -0,0 +1,160 @@
+import logging
+import time
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool, QueuePool
+
+from chess_server.metrics import counter, gauge, histogram
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this many seconds are logged, set from config
+slow_query_threshold = None
+
+checkout_wait = histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+connections_opened = counter(
+    "db_connections_opened_total", "New database connections"
+)
+connections_closed = counter(
+    "db_connections_closed_total", "Database connections closed"
+)
+connections_invalidated = counter(
+    "db_connections_invalidated_total",
+    "Database connections discarded after an error",
+)
+connections_checked_out = gauge(
+    "db_connections_checked_out", "Connections currently in use"
+)
+query_duration = histogram(
+    "db_query_duration_seconds",
+    "Latency of database statements",
+    labelnames=("statement",),
+)
+query_errors = counter(
+    "db_query_errors_total",
+    "Failed database statements, including statement timeouts",
+    labelnames=("statement",),
+)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool which records how long each checkout waited"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            checkout_wait.observe(time.perf_counter() - start)
+
+
+def get_engine_options(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Engine options for the pool sizes and timeouts in config.
+
+    Only applies to PostgreSQL, other databases keep the defaults picked by
+    Flask-SQLAlchemy (e.g. a static pool for in-memory SQLite).
+    """
+    uri = config.get("SQLALCHEMY_DATABASE_URI") or ""
+
+    if not uri.startswith("postgres"):
+        return {}
+
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": True,
+    }
+
+    if config["DB_STATEMENT_TIMEOUT"]:
+        # Enforced by the server for every statement on the connection
+        timeout = config["DB_STATEMENT_TIMEOUT"]
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={timeout}"
+        }
+
+    return options
+
+
+def get_statement_kind(statement: str) -> str:
+    """First keyword of a statement, e.g. SELECT"""
+    return statement.lstrip().split(None, 1)[0].upper() if statement else ""
+
+
+def before_cursor_execute(conn, cursor, statement, *args):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, *args):
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+
+    elapsed = time.perf_counter() - starts.pop()
+    query_duration.observe(elapsed, statement=get_statement_kind(statement))
+
+    if slow_query_threshold and elapsed > slow_query_threshold:
+        logger.warning(f"Slow query ({elapsed:.3f}s): {statement[:200]}")
+
+
+def handle_error(context):
+    if context.connection is not None:
+        starts = context.connection.info.get("query_start")
+        if starts:
+            starts.pop()
+
+    query_errors.inc(statement=get_statement_kind(context.statement))
+
+
+def on_connect(dbapi_connection, connection_record):
+    connections_opened.inc()
+
+
+def on_close(dbapi_connection, connection_record):
+    connections_closed.inc()
+
+
+def on_invalidate(dbapi_connection, connection_record, exception):
+    connections_invalidated.inc()
+
+
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    connections_checked_out.inc()
+
+
+def on_checkin(dbapi_connection, connection_record):
+    connections_checked_out.dec()
+
+
+LISTENERS = [
+    (Engine, "before_cursor_execute", before_cursor_execute),
+    (Engine, "after_cursor_execute", after_cursor_execute),
+    (Engine, "handle_error", handle_error),
+    (Pool, "connect", on_connect),
+    (Pool, "close", on_close),
+    (Pool, "invalidate", on_invalidate),
+    (Pool, "checkout", on_checkout),
+    (Pool, "checkin", on_checkin),
+]
+
+
+def init_app(app):
+    """Size the connection pool from config and hook up instrumentation"""
+    global slow_query_threshold
+
+    app.config.setdefault(
+        "SQLALCHEMY_ENGINE_OPTIONS", get_engine_options(app.config)
+    )
+    slow_query_threshold = app.config["DB_SLOW_QUERY_THRESHOLD"]
+
+    for target, name, listener in LISTENERS:
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
@@ -0,0 +1,309 @@
+import copy
+import hashlib
+import heapq
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from chess_server import db
+from chess_server.metrics import counter
+from chess_server.models import WebhookResponseModel
+
+logger = logging.getLogger(__name__)
+
+duplicate_requests = counter(
+    "webhook_duplicate_requests_total",
+    "Webhook deliveries answered with the response of an earlier delivery,"
+    " by whether it had finished, was waited for or ran in another worker",
+    labelnames=("state",),
+)
+
+Key = Tuple[str, str, str]
+
+# Seconds between reads of a response being made by another worker
+POLL_INTERVAL = 0.05
+
+
+def get_request_key(req: Dict[str, Any]) -> Optional[Key]:
+    """Identity of a webhook delivery, which Dialogflow keeps when it
+    retries. None if the request has no responseId."""
+    response_id = req.get("responseId")
+
+    if not response_id:
+        return None
+
+    query = req.get("queryResult", {}).get("queryText", "")
+    return response_id, req.get("session", ""), query
+
+
+def get_digest(key: Key) -> str:
+    """Key of a delivery in the webhook_response table"""
+    return hashlib.sha256("\0".join(key).encode()).hexdigest()
+
+
+class Entry:
+    """Response of a delivery, set once the first execution has finished"""
+
+    def __init__(self, key: Key):
+        self.key = key
+        self.done = threading.Event()
+        self.response: Optional[Dict[str, Any]] = None
+        self.expires = float("inf")
+        # Whether the first execution runs in another worker
+        self.remote = False
+
+
+class IdempotencyCache:
+    """Keeps the response to each webhook delivery for IDEMPOTENCY_TTL
+    seconds so that a retried delivery gets the same response, without
+    playing the turn again.
+
+    A duplicate arriving while the first delivery is still running waits
+    up to IDEMPOTENCY_WAIT_TIMEOUT for its response. If the first delivery
+    fails, nothing is kept and the duplicate runs the turn itself. At most
+    IDEMPOTENCY_MAX_ENTRIES responses are kept per process, the oldest
+    are dropped first. A TTL of 0 disables the cache.
+
+    With IDEMPOTENCY_STORE "memory", the default, only the retries
+    reaching the same worker process are answered. With "db" deliveries
+    are also claimed in the webhook_response table, so that a retry which
+    reaches another worker, or another node, waits for the response there
+    too, at the cost of two writes per webhook. STATELESS_MODE always keeps
+    responses in memory.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.entries: "OrderedDict[Key, Entry]" = OrderedDict()
+        # Heap of (expires, key) of the entries which have finished
+        self._expiry: List[Tuple[float, Key]] = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.entries.clear()
+        self._expiry.clear()
+        app.extensions["idempotency_cache"] = self
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.app and self.app.config["IDEMPOTENCY_TTL"])
+
+    @property
+    def shared(self) -> bool:
+        config = self.app.config
+        return (
+            config["IDEMPOTENCY_STORE"] == "db"
+            and not config["STATELESS_MODE"]
+        )
+
+    def begin(self, key: Key) -> Tuple[Entry, bool]:
+        """Entry of a delivery, and whether the caller is the first to see
+        it and so has to run it"""
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry, False
+
+            entry = self.entries[key] = Entry(key)
+            self._evict()
+
+        if self.shared and not self._claim(key):
+            entry.remote = True
+            return entry, False
+
+        return entry, True
+
+    def finish(self, entry: Entry, response: Dict[str, Any]):
+        ttl = self.app.config["IDEMPOTENCY_TTL"]
+        entry.response = copy.deepcopy(response)
+
+        if self.shared:
+            self._store(entry.key, response, ttl)
+
+        self._set_expires(entry, time.monotonic() + ttl)
+        entry.done.set()
+
+    def abandon(self, key: Key, entry: Entry):
+        """Forget a delivery which failed, waking up its duplicates"""
+        with self._lock:
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+
+        if self.shared and not entry.remote:
+            self._release(key)
+
+        entry.done.set()
+
+    def wait(self, entry: Entry) -> Optional[Dict[str, Any]]:
+        """Response of the first execution of a delivery, or None if it
+        failed or took too long"""
+        was_done = entry.done.is_set()
+
+        if entry.remote and not was_done:
+            return self._wait_remote(entry)
+
+        if not entry.done.wait(self.app.config["IDEMPOTENCY_WAIT_TIMEOUT"]):
+            return None
+
+        if entry.response is None:
+            return None
+
+        duplicate_requests.inc(state="done" if was_done else "in_flight")
+        return copy.deepcopy(entry.response)
+
+    def _wait_remote(self, entry: Entry) -> Optional[Dict[str, Any]]:
+        """Wait for the response of another worker, and keep it for the
+        duplicates in this one"""
+        response = self._poll(entry.key)
+
+        if response is None:
+            self.abandon(entry.key, entry)
+            return None
+
+        entry.response = response
+        ttl = self.app.config["IDEMPOTENCY_TTL"]
+        self._set_expires(entry, time.monotonic() + ttl)
+        entry.done.set()
+
+        duplicate_requests.inc(state="shared")
+        return copy.deepcopy(response)
+
+    def _claim(self, key: Key) -> bool:
+        """Insert the row of a delivery, False if another worker has. The
+        row of a delivery which never finished is taken over once its
+        lease has expired, as its worker may be gone."""
+        table = WebhookResponseModel.__table__
+        digest = get_digest(key)
+        now = datetime.utcnow()
+        lease = timedelta(seconds=self.app.config["IDEMPOTENCY_WAIT_TIMEOUT"])
+
+        try:
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(
+                        table.insert().values(
+                            key=digest, response=None, expires_at=now + lease
+                        )
+                    )
+            except IntegrityError:
+                with db.engine.begin() as conn:
+                    result = conn.execute(
+                        table.update()
+                        .where(table.c.key == digest)
+                        .where(table.c.expires_at <= now)
+                        .values(response=None, expires_at=now + lease)
+                    )
+                return result.rowcount == 1
+        except SQLAlchemyError as exc:
+            # Run the delivery, as without the cache
+            logger.warning(f"Unable to claim webhook delivery: {exc}")
+
+        return True
+
+    def _store(self, key: Key, response: Dict[str, Any], ttl: float):
+        table = WebhookResponseModel.__table__
+
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    table.update()
+                    .where(table.c.key == get_digest(key))
+                    .values(
+                        response=json.dumps(response),
+                        expires_at=datetime.utcnow() + timedelta(seconds=ttl),
+                    )
+                )
+        except SQLAlchemyError as exc:
+            logger.warning(f"Unable to store webhook response: {exc}")
+
+    def _release(self, key: Key):
+        table = WebhookResponseModel.__table__
+
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    table.delete().where(table.c.key == get_digest(key))
+                )
+        except SQLAlchemyError as exc:
+            logger.warning(f"Unable to release webhook delivery: {exc}")
+
+    def _poll(self, key: Key) -> Optional[Dict[str, Any]]:
+        """Response stored by the worker running a delivery, None if it
+        failed or did not finish in time"""
+        table = WebhookResponseModel.__table__
+        query = table.select().where(table.c.key == get_digest(key))
+        deadline = (
+            time.monotonic() + self.app.config["IDEMPOTENCY_WAIT_TIMEOUT"]
+        )
+
+        while True:
+            try:
+                with db.engine.connect() as conn:
+                    row = conn.execute(query).first()
+            except SQLAlchemyError as exc:
+                logger.warning(f"Unable to read webhook response: {exc}")
+                return None
+
+            if row is None:
+                return None
+
+            if row.response is not None:
+                return json.loads(row.response)
+
+            if time.monotonic() >= deadline:
+                return None
+
+            time.sleep(POLL_INTERVAL)
+
+    def _set_expires(self, entry: Entry, expires: float):
+        with self._lock:
+            entry.expires = expires
+            heapq.heappush(self._expiry, (expires, entry.key))
+
+    def _expire(self, now: float):
+        while self._expiry and self._expiry[0][0] <= now:
+            _, key = heapq.heappop(self._expiry)
+            entry = self.entries.get(key)
+
+            # The key may have been dropped and begun again since
+            if entry is not None and entry.expires <= now:
+                del self.entries[key]
+
+    def _evict(self):
+        excess = len(self.entries) - self.app.config["IDEMPOTENCY_MAX_ENTRIES"]
+
+        for key, entry in list(self.entries.items()):
+            if excess <= 0:
+                break
+
+            # Deliveries still running are needed by their duplicates
+            if entry.done.is_set():
+                del self.entries[key]
+                excess -= 1
+
+
+idempotency_cache = IdempotencyCache()
+
+
+def delete_expired_responses() -> int:
+    """Delete the rows of webhook_response which have expired, run by the
+    session reaper rather than on the request path"""
+    table = WebhookResponseModel.__table__
+
+    with db.engine.begin() as conn:
+        result = conn.execute(
+            table.delete().where(table.c.expires_at < datetime.utcnow())
+        )
+
+    return result.rowcount
@@ -0,0 +1,325 @@
+import logging
+import random
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import chess.engine
+from flask import current_app
+from werkzeug.exceptions import BadRequest
+
+from chess_server import db
+from chess_server.idempotency import get_request_key, idempotency_cache
+from chess_server.metrics import counter, histogram
+from chess_server.tracing import span
+from chess_server.utils import (
+    ConcurrentUpdateError,
+    get_output_contexts_for_game_states,
+    get_response_for_google,
+    get_session_by_req,
+    get_user_versions,
+    has_written_users,
+    is_stateless,
+    load_game_states_from_req,
+    load_image_variant_from_req,
+)
+
+logger = logging.getLogger(__name__)
+
+# What handlers can declare they need. "db" is the game state, from the
+# database or the request contexts, "engine" the chess engine and
+# "renderer" the board image variant of the request.
+RESOURCES = ("db", "engine", "renderer")
+
+ERROR_RESPONSES = {
+    "concurrent_update": "Sorry, I got two requests at once and may have"
+    " missed your last one. Please say it again, or say Show Board to see"
+    " the current position.",
+    "unavailable": "Sorry, I can't play right now. Please try again in a"
+    " little while.",
+}
+
+intent_duration = histogram(
+    "webhook_intent_duration_seconds",
+    "Time taken to handle a webhook request by action",
+    labelnames=("action",),
+)
+intent_errors = counter(
+    "webhook_intent_errors_total",
+    "Webhook requests which failed, by action and error",
+    labelnames=("action", "error"),
+)
+
+Response = Dict[str, Any]
+
+
+class ResourceUnavailableError(Exception):
+    """A resource needed by a handler could not be set up"""
+
+
+class Handler(NamedTuple):
+    """Intent handler registered for a Dialogflow action"""
+
+    action: str
+    func: Callable[["IntentCall"], Response]
+    # Parameters which must be in queryResult.parameters
+    params: Tuple[str, ...] = ()
+    needs: FrozenSet[str] = frozenset()
+    # Run after the shared middleware, closest to the handler
+    middleware: Tuple[Callable, ...] = ()
+
+
+class IntentCall:
+    """A webhook request on its way through the middleware to its handler"""
+
+    def __init__(self, handler: Handler, req: Dict[str, Any]):
+        self.handler = handler
+        self.req = req
+        self.action = handler.action
+        self.session_id = get_session_by_req(req)
+        self.params = req["queryResult"].get("parameters", {})
+
+    def needs(self, resource: str) -> bool:
+        return resource in self.handler.needs
+
+
+Middleware = Callable[[IntentCall, Callable[[IntentCall], Response]], Response]
+
+handlers: Dict[str, Handler] = {}
+providers: Dict[str, Callable[[IntentCall], None]] = {}
+turn_finishers: List[Callable[[IntentCall], Optional[Response]]] = []
+
+
+def intent(
+    action: str,
+    params: Tuple[str, ...] = (),
+    needs: Tuple[str, ...] = (),
+    middleware: Tuple[Middleware, ...] = (),
+):
+    """Register the decorated function as the handler of an action. It is
+    called with the IntentCall of the webhook request once the resources it
+    needs are ready and its params have been checked."""
+    unknown = set(needs) - set(RESOURCES)
+    if unknown:
+        raise ValueError(f"Unknown resources for {action}: {unknown}")
+
+    def decorator(func):
+        handlers[action] = Handler(
+            action=action,
+            func=func,
+            params=tuple(params),
+            needs=frozenset(needs),
+            middleware=tuple(middleware),
+        )
+        return func
+
+    return decorator
+
+
+def resource(name: str):
+    """Register the decorated function as the provider of a resource. It
+    is called before every handler needing the resource."""
+    if name not in RESOURCES:
+        raise ValueError(f"Unknown resource: {name}")
+
+    def decorator(func):
+        providers[name] = func
+        return func
+
+    return decorator
+
+
+def turn_finisher(func):
+    """Register the decorated function to finish a turn which a concurrent
+    update cut short after part of it was saved. It is called with the
+    IntentCall against the latest state and returns the response, or None
+    if there is nothing left of the turn to do."""
+    turn_finishers.append(func)
+    return func
+
+
+@resource("renderer")
+def load_image_variant(call: IntentCall):
+    load_image_variant_from_req(call.req)
+
+
+def dispatch(action: str, req: Dict[str, Any]) -> Response:
+    """Call the handler of an action through the middleware"""
+    handler = handlers.get(action)
+
+    if handler is None:
+        logger.error(
+            "Unknown intent action", extra={"action": action, "payload": req}
+        )
+        raise BadRequest(f"Unknown intent action: {action}")
+
+    chain = [*middleware, *handler.middleware]
+
+    def call_next(i: int) -> Callable[[IntentCall], Response]:
+        if i == len(chain):
+            return run_handler
+
+        return lambda call: chain[i](call, call_next(i + 1))
+
+    return call_next(0)(IntentCall(handler, req))
+
+
+def run_handler(call: IntentCall) -> Response:
+    with span("handler", action=call.action):
+        return call.handler.func(call)
+
+
+def timed(call: IntentCall, call_next) -> Response:
+    with intent_duration.time(action=call.action):
+        return call_next(call)
+
+
+def deduplicate(call: IntentCall, call_next) -> Response:
+    """Answer a delivery Dialogflow retried with the response to the first
+    one, waiting for it if it is still running"""
+    key = get_request_key(call.req)
+
+    if key is None or not idempotency_cache.enabled:
+        return call_next(call)
+
+    entry, first = idempotency_cache.begin(key)
+
+    if not first:
+        res = idempotency_cache.wait(entry)
+        if res is not None:
+            return res
+
+        # The first delivery failed or is stuck, run this one instead
+        return call_next(call)
+
+    try:
+        res = call_next(call)
+    except BaseException:
+        idempotency_cache.abandon(key, entry)
+        raise
+
+    idempotency_cache.finish(entry, res)
+
+    return res
+
+
+def validate_params(call: IntentCall, call_next) -> Response:
+    missing = [name for name in call.handler.params if name not in call.params]
+
+    if missing:
+        raise BadRequest(
+            f"Missing parameters for {call.action}: {', '.join(missing)}"
+        )
+
+    return call_next(call)
+
+
+def carry_game_states(call: IntentCall, call_next) -> Response:
+    """In STATELESS_MODE, read game states from the contexts of the request
+    and return them in the contexts of the response"""
+    if not (call.needs("db") and is_stateless()):
+        return call_next(call)
+
+    load_game_states_from_req(call.req)
+    res = call_next(call)
+    res["outputContexts"] = get_output_contexts_for_game_states(call.req)
+
+    return res
+
+
+def map_errors(call: IntentCall, call_next) -> Response:
+    """Turn errors the user can do something about into responses"""
+    try:
+        return call_next(call)
+
+    except ConcurrentUpdateError:
+        error, text = "concurrent_update", ERROR_RESPONSES["concurrent_update"]
+
+    except (ResourceUnavailableError, chess.engine.EngineError) as exc:
+        logger.error(f"Unable to handle {call.action}: {exc}")
+        error, text = "unavailable", ERROR_RESPONSES["unavailable"]
+
+    intent_errors.inc(action=call.action, error=error)
+
+    return get_response_for_google(textToSpeech=text)
+
+
+def prepare_resources(call: IntentCall, call_next) -> Response:
+    for name in RESOURCES:
+        provider = providers.get(name)
+
+        if provider is None or not call.needs(name):
+            continue
+
+        try:
+            provider(call)
+        except Exception as exc:
+            raise ResourceUnavailableError(f"{name}: {exc}") from exc
+
+    return call_next(call)
+
+
+def retry_concurrent_updates(call: IntentCall, call_next) -> Response:
+    """Replay a turn which lost a race for a game row, as long as nothing
+    of it was saved yet. Up to CONCURRENCY_MAX_RETRIES times."""
+    if not call.needs("db"):
+        return call_next(call)
+
+    retries = current_app.config["CONCURRENCY_MAX_RETRIES"]
+
+    for attempt in range(retries + 1):
+        try:
+            return call_next(call)
+
+        except ConcurrentUpdateError:
+            db.session.rollback()
+
+            if has_written_users():
+                # Part of this turn is saved, so replaying it is not safe.
+                # Finish what is left of it, like the engine's reply to a
+                # saved move, or let the user repeat it.
+                res = finish_turn(call)
+                if res is None:
+                    raise
+                return res
+
+            if attempt == retries:
+                raise
+
+            # Nothing was saved yet: replay the turn against fresh state
+            get_user_versions().clear()
+            time.sleep(
+                random.uniform(0, current_app.config["CONCURRENCY_BACKOFF"])
+            )
+
+
+def finish_turn(call: IntentCall) -> Optional[Response]:
+    """Run the turn finishers against fresh state, see `turn_finisher`"""
+    get_user_versions().clear()
+
+    for finisher in turn_finishers:
+        res = finisher(call)
+        if res is not None:
+            return res
+
+    return None
+
+
+# Shared by every action, outermost first
+middleware: List[Middleware] = [
+    timed,
+    deduplicate,
+    validate_params,
+    carry_game_states,
+    map_errors,
+    prepare_resources,
+    retry_concurrent_updates,
+]
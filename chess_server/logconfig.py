@@ -0,0 +1,185 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Iterable, List, Optional
+
+from flask.logging import default_handler
+
+from chess_server.metrics import counter
+
+records_dropped = counter(
+    "log_records_dropped_total",
+    "Log records dropped because the log queue was full",
+)
+
+# Attributes every LogRecord has, anything else was passed in `extra`
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message"}
+
+REDACTED = "[redacted]"
+
+
+def redact(value: Any, fields: Iterable[str]) -> Any:
+    """Copy of a JSON like value with the values of `fields` replaced at any
+    depth"""
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in fields else redact(item, fields)
+            for key, item in value.items()
+        }
+
+    if isinstance(value, (list, tuple)):
+        return [redact(item, fields) for item in value]
+
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, with the fields given
+    in `extra`. A `payload` field, like a webhook request, has `fields`
+    redacted and is cut to `max_payload_bytes` of JSON.
+    """
+
+    def __init__(
+        self, redact_fields: Iterable[str] = (), max_payload_bytes: int = 0
+    ):
+        super().__init__()
+        self.redact_fields = frozenset(redact_fields)
+        self.max_payload_bytes = max_payload_bytes
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec="milliseconds")
+            .replace("+00:00", "Z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+
+        if "payload" in entry:
+            entry.update(self.format_payload(entry.pop("payload")))
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+    def format_payload(self, payload: Any) -> Dict[str, Any]:
+        text = json.dumps(redact(payload, self.redact_fields), default=str)
+        limit = self.max_payload_bytes
+
+        if limit and len(text) > limit:
+            # Cut as a string, a partial object is not valid JSON
+            return {"payload": text[:limit], "payload_truncated": len(text)}
+
+        return {"payload": json.loads(text)}
+
+
+class AsyncHandler(QueueHandler):
+    """Puts records on a queue for a `QueueListener` thread to format and
+    write, so logging never waits on the output. Records are dropped when
+    the queue is full.
+
+    Payloads are kept on a fraction of records by level, given by
+    `sample_rates` (1 for levels not in it), and dropped from the rest
+    before they are queued.
+    """
+
+    def __init__(
+        self,
+        log_queue: queue.Queue,
+        sample_rates: Optional[Dict[str, float]] = None,
+    ):
+        super().__init__(log_queue)
+        self.sample_rates = sample_rates or {}
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only what needs the caller's state is done here, like merging the
+        # arguments into the message while they are unchanged
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+
+        if hasattr(record, "payload"):
+            rate = self.sample_rates.get(record.levelname, 1)
+            if rate < 1 and random.random() >= rate:
+                del record.payload
+
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            records_dropped.inc()
+
+
+_handler: Optional[AsyncHandler] = None
+_listener: Optional[QueueListener] = None
+_loggers: List[logging.Logger] = []
+
+
+def init_app(app):
+    """Send the logs of chess_server and of the app through a queue to a
+    thread writing them to stdout as JSON"""
+    global _handler, _listener
+
+    config = app.config
+
+    stop()
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(
+        JsonFormatter(
+            redact_fields=config["LOG_REDACT_FIELDS"],
+            max_payload_bytes=config["LOG_PAYLOAD_MAX_BYTES"],
+        )
+    )
+
+    log_queue = queue.Queue(maxsize=config["LOG_QUEUE_SIZE"])
+    _handler = AsyncHandler(log_queue, config["LOG_PAYLOAD_SAMPLE_RATES"])
+    _listener = QueueListener(log_queue, output)
+    _listener.start()
+
+    # Replaces Flask's handler, which writes to stderr in the request
+    app.logger.removeHandler(default_handler)
+
+    for logger in {logging.getLogger("chess_server"), app.logger}:
+        logger.addHandler(_handler)
+        logger.setLevel(config["LOG_LEVEL"])
+        _loggers.append(logger)
+
+
+def stop():
+    """Write out the queued records and detach the handler"""
+    global _handler, _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    while _loggers:
+        _loggers.pop().removeHandler(_handler)
+
+    _handler = None
+
+
+atexit.register(stop)
@@ -4,14 +4,15 @@ from typing import Any, Dict, Optional
 
 import chess
 
+from chess_server.archive import archive_game, get_started_at
 from chess_server.chessgame import Mediator
+from chess_server.intents import IntentCall, intent, resource, turn_finisher
 from chess_server.utils import (
     User,
     create_user,
     delete_user,
+    exists_in_db,
     get_user,
-    get_session_by_req,
-    get_params_by_req,
     get_piece_symbol,
     get_prompt_phrase,
     get_response_for_google,
@@ -35,14 +36,44 @@ RESPONSES = {
 
 mediator = Mediator()
 
+# Every action which plays a move can end the game and show the board
+PLAY = ("db", "engine", "renderer")
 
-def welcome(req: Dict[str, Any]) -> Dict[str, Any]:
 
-    session_id = get_session_by_req(req)
-    color = get_params_by_req(req)["color"]
+@resource("engine")
+def start_engine(call: IntentCall):
+    """Start the engine before the handler rather than halfway through it,
+    when part of the turn may already be saved"""
+    if mediator.engine is None:
+        mediator.activate_engine()
+
+
+@turn_finisher
+def finish_engine_turn(call: IntentCall) -> Optional[Dict[str, Any]]:
+    """Play the engine's reply to a move which was saved before a concurrent
+    update stopped the turn, instead of leaving the game on its turn"""
+    session_id = call.session_id
+
+    if not call.needs("engine") or not exists_in_db(session_id):
+        return None
+
+    user = get_user(session_id)
+    if user.board.turn == user.color:
+        return None
+
+    kwargs = get_response_kwargs(session_id)
+    return get_response_for_google(**kwargs)
+
+
+# The color prompt needs neither the engine nor a board image. If black is
+# given here, the engine is started for its first move.
+@intent("welcome", params=("color",), needs=("db",))
+def welcome(call: IntentCall) -> Dict[str, Any]:
+
+    color = call.params["color"]
 
     if color:
-        return start_game_and_get_response(session_id, color)
+        return start_game_and_get_response(call.session_id, color)
 
     response_text = "Howdy! Which color would you like to choose?"
     options = [
@@ -66,14 +97,12 @@ def welcome(req: Dict[str, Any]) -> Dict[str, Any]:
     return get_response_for_google(textToSpeech=response_text, options=options)
 
 
-def choose_color(req: Dict[str, Any]) -> Dict[str, Any]:
+@intent("choose_color", needs=PLAY)
+def choose_color(call: IntentCall) -> Dict[str, Any]:
     """Assign board and color to user"""
 
-    # Get session id to store user data by key
-    session_id = get_session_by_req(req)
-
     # Extract the key of chosen list item
-    arguments = req["originalDetectIntentRequest"]["payload"][
+    arguments = call.req["originalDetectIntentRequest"]["payload"][
         "inputs"
     ]  # Is a list
 
@@ -88,22 +117,20 @@ def choose_color(req: Dict[str, Any]) -> Dict[str, Any]:
             color = each["textValue"]
             break
 
-    return start_game_and_get_response(session_id, color)
+    return start_game_and_get_response(call.session_id, color)
 
 
-def two_squares(req: Dict[str, Any]) -> Dict[str, Any]:
+@intent("two_squares", params=("squares", "piece"), needs=PLAY)
+def two_squares(call: IntentCall) -> Dict[str, Any]:
     """Given two squares and a piece, play a move"""
-    params = get_params_by_req(req)
-
     # Extract params and take the lowercase of the square
-    squares = [square.lower() for square in params["squares"]]
-    piece = params["piece"]
+    squares = [square.lower() for square in call.params["squares"]]
+    piece = call.params["piece"]
 
     if len(squares) == 1:
-        return piece_and_square(req)
+        return piece_and_square(call)
 
-    # Extract board
-    session_id = get_session_by_req(req)
+    session_id = call.session_id
 
     # TODO: Handle case when `session_id not found' when migrating to db
     # Get user
@@ -125,13 +152,14 @@ def two_squares(req: Dict[str, Any]) -> Dict[str, Any]:
     return get_response_for_google(**kwargs)
 
 
-def castle(req: Dict[str, Any]) -> Dict[str, Any]:
+@intent("castle", needs=PLAY)
+def castle(call: IntentCall) -> Dict[str, Any]:
     """When asked to castle, try playing the castles move"""
 
-    session_id = get_session_by_req(req)
+    session_id = call.session_id
     user = get_user(session_id)
 
-    queryText = req["queryResult"]["queryText"]
+    queryText = call.req["queryResult"]["queryText"]
 
     # Get lan of move
     lan = process_castle_by_querytext(board=user.board, queryText=queryText)
@@ -145,13 +173,14 @@ def castle(req: Dict[str, Any]) -> Dict[str, Any]:
     return get_response_for_google(**kwargs)
 
 
-def simply_san(req: Dict[str, Any]) -> Dict[str, Any]:
+@intent("simply_san", params=("san",), needs=PLAY)
+def simply_san(call: IntentCall) -> Dict[str, Any]:
     """Intent handler for simply SAN moves
 
     Note: Accepts overspecified SAN (including LAN)
     """
-    session_id = get_session_by_req(req)
-    san = get_params_by_req(req)["san"]
+    session_id = call.session_id
+    san = call.params["san"]
 
     # Convert pawn moves like E4, D5 to lowercase i.e. e4, d5
     if re.match(r"^[A-Z][1-8]$", san):
@@ -165,10 +194,13 @@ def simply_san(req: Dict[str, Any]) -> Dict[str, Any]:
     return get_response_for_google(**kwargs)
 
 
-def piece_and_square(req: Dict[str, Any]) -> Dict[str, Any]:
+@intent(
+    "piece_and_square", params=("piece", "pawn", "square"), needs=PLAY
+)
+def piece_and_square(call: IntentCall) -> Dict[str, Any]:
     """Intent handler for when only one piece and one square are given"""
-    session_id = get_session_by_req(req)
-    params = get_params_by_req(req)
+    session_id = call.session_id
+    params = call.params
 
     piece = params["piece"].lower()
     pawn = params["pawn"].lower()
@@ -195,11 +227,16 @@ def piece_and_square(req: Dict[str, Any]) -> Dict[str, Any]:
     return get_response_for_google(**kwargs)
 
 
-def resign(req: Dict[str, Any]) -> Dict[str, Any]:
-    """Delete the player from the database and return a conclusion response"""
-    session_id = get_session_by_req(req)
-    card = save_board_as_png_and_get_image_card(session_id)
-    delete_user(session_id)
+@intent("resign", needs=("db", "renderer"))
+def resign(call: IntentCall) -> Dict[str, Any]:
+    """Archive the game, delete the player from the database and return a
+    conclusion response"""
+    session_id = call.session_id
+    card = save_board_as_png_and_get_image_card(session_id, replay=True)
+
+    user = get_user(session_id)
+    result = "0-1" if user.color == chess.WHITE else "1-0"
+    end_game(session_id, user, result=result)
 
     output = "GG! Thanks for playing."
 
@@ -208,11 +245,12 @@ def resign(req: Dict[str, Any]) -> Dict[str, Any]:
     )
 
 
-def show_board(req: Dict[str, Any]) -> Dict[str, Any]:
+@intent("show_board", needs=("db", "renderer"))
+def show_board(call: IntentCall) -> Dict[str, Any]:
     """Show the board to player as a PNG image"""
-    session_id = get_session_by_req(req)
+    session_id = call.session_id
 
-    # Save board to <IMG_DIR>/<session_id>.png
+    # Render the board into the render cache
     card = save_board_as_png_and_get_image_card(session_id)
 
     resp = get_response_for_google(
@@ -222,11 +260,10 @@ def show_board(req: Dict[str, Any]) -> Dict[str, Any]:
     return resp
 
 
-def undo(req: Dict[str, Any]) -> Dict[str, Any]:
+@intent("undo", needs=("db",))
+def undo(call: IntentCall) -> Dict[str, Any]:
     """Undo the last move of the user"""
-    session_id = get_session_by_req(req)
-
-    undone = undo_users_last_move(session_id)
+    undone = undo_users_last_move(call.session_id)
 
     if undone:
         if len(undone) == 1:
@@ -278,6 +315,21 @@ def start_game_and_get_response(session_id: str, color: str):
     return get_response_for_google(textToSpeech=output)
 
 
+def end_game(session_id: str, user: User, result: Optional[str] = None):
+    """Delete a finished game and archive it. A delete which conflicts with
+    another request raises before the game is archived, so that the retried
+    request archives it only once."""
+    started_at = get_started_at(session_id)
+    delete_user(session_id)
+    archive_game(
+        session_id,
+        user.board,
+        user.color,
+        result=result,
+        started_at=started_at,
+    )
+
+
 def get_result_comment(user: User) -> str:
     """Return a response provided that the game has ended
 
@@ -339,9 +391,8 @@ def get_response_kwargs(session_id: str, lastmove_lan: Optional[str] = None):
     game_result = get_result_comment(user=user)
 
     if game_result:
-        card = save_board_as_png_and_get_image_card(session_id)
-        # TODO: Archive the game instead of deleting
-        delete_user(session_id)
+        card = save_board_as_png_and_get_image_card(session_id, replay=True)
+        end_game(session_id, user)
         kwargs.update(
             textToSpeech=game_result, expectUserResponse=False, basicCard=card
         )
@@ -355,8 +406,10 @@ def get_response_kwargs(session_id: str, lastmove_lan: Optional[str] = None):
         game_result = get_result_comment(user=user)
         if game_result:
             output = f"{output}. {game_result}"
-            card = save_board_as_png_and_get_image_card(session_id)
-            delete_user(session_id)
+            card = save_board_as_png_and_get_image_card(
+                session_id, replay=True
+            )
+            end_game(session_id, user)
             kwargs.update(
                 textToSpeech=output, expectUserResponse=False, basicCard=card
             )
@@ -0,0 +1,498 @@
+import atexit
+import fcntl
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    """Base for process-local metrics identified by name and label values"""
+
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Metric {self.name} expects labels {self.labelnames}, "
+                f"got {tuple(labels)}"
+            )
+
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current values in a form which can be saved as JSON and merged
+        with the snapshots of other processes"""
+        with self._lock:
+            values = [[list(key), value] for key, value in self.values.items()]
+
+        return {
+            "type": self.type,
+            "documentation": self.documentation,
+            "labelnames": list(self.labelnames),
+            "values": values,
+        }
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    """Gauge, either set by the process or, with `collect`, computed when
+    the metrics are scraped. Collected gauges describe shared state, like
+    the database, so they are not added up across processes."""
+
+    type = "gauge"
+
+    def __init__(
+        self, *args, collect: Optional[Callable[[], float]] = None, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS))
+        # Per label values: [count per bucket..., +Inf count], sum
+        self.values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self.values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+
+            self.values[key] = (counts, total + value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            values = [
+                [list(key), [list(counts), total]]
+                for key, (counts, total) in self.values.items()
+            ]
+
+        snapshot = super().snapshot()
+        snapshot.update(values=values, buckets=list(self.buckets))
+        return snapshot
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self.values.get(self._key(labels), ([], 0.0))
+        return sum(counts)
+
+    def sum(self, **labels) -> float:
+        return self.values.get(self._key(labels), ([], 0.0))[1]
+
+
+registry: Dict[str, Metric] = {}
+_registry_lock = threading.Lock()
+
+
+def _get_or_create(cls, name, documentation, labelnames, **kwargs):
+    with _registry_lock:
+        metric = registry.get(name)
+
+        if metric is None:
+            metric = cls(name, documentation, tuple(labelnames), **kwargs)
+            registry[name] = metric
+
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already a {metric.type}")
+
+        return metric
+
+
+def counter(
+    name: str, documentation: str, labelnames: Tuple[str, ...] = ()
+) -> Counter:
+    """Get or register a counter"""
+    return _get_or_create(Counter, name, documentation, labelnames)
+
+
+def gauge(
+    name: str,
+    documentation: str,
+    labelnames: Tuple[str, ...] = (),
+    collect: Optional[Callable[[], float]] = None,
+) -> Gauge:
+    """Get or register a gauge. A gauge with `collect` is set to what it
+    returns when the metrics are scraped."""
+    return _get_or_create(
+        Gauge, name, documentation, labelnames, collect=collect
+    )
+
+
+def histogram(
+    name: str,
+    documentation: str,
+    labelnames: Tuple[str, ...] = (),
+    buckets: Optional[Tuple[float, ...]] = None,
+) -> Histogram:
+    """Get or register a histogram"""
+    return _get_or_create(
+        Histogram, name, documentation, labelnames, buckets=buckets
+    )
+
+
+Snapshot = Dict[str, Dict[str, Any]]
+
+
+def snapshot() -> Snapshot:
+    """Snapshot of the metrics of this process, without collected gauges"""
+    with _registry_lock:
+        metrics = list(registry.values())
+
+    return {
+        metric.name: metric.snapshot()
+        for metric in metrics
+        if getattr(metric, "collect", None) is None
+    }
+
+
+def merge_snapshots(snapshots: List[Snapshot]) -> Snapshot:
+    """Add up the snapshots of several processes, value by value"""
+    merged: Snapshot = {}
+
+    for snap in snapshots:
+        for name, metric in snap.items():
+            target = merged.setdefault(name, {**metric, "values": []})
+            values = {tuple(key): value for key, value in target["values"]}
+
+            for key, value in metric["values"]:
+                key = tuple(key)
+                if key not in values:
+                    values[key] = value
+                elif metric["type"] == "histogram":
+                    counts, total = values[key]
+                    values[key] = [
+                        [a + b for a, b in zip(counts, value[0])],
+                        total + value[1],
+                    ]
+                else:
+                    values[key] += value
+
+            target["values"] = [[list(k), v] for k, v in values.items()]
+
+    return merged
+
+
+def collect() -> Snapshot:
+    """Snapshot of the collected gauges, computed now"""
+    with _registry_lock:
+        gauges = [
+            metric
+            for metric in registry.values()
+            if getattr(metric, "collect", None) is not None
+        ]
+
+    collected = {}
+    for metric in gauges:
+        try:
+            value = metric.collect()
+        except Exception as exc:
+            logger.warning(f"Unable to collect {metric.name}: {exc}")
+            continue
+
+        collected[metric.name] = {**metric.snapshot(), "values": [[[], value]]}
+
+    return collected
+
+
+def format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: List[str], values: List[str], **extra) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ""
+
+    labels = ",".join(f'{name}="{escape_label(v)}"' for name, v in pairs)
+    return f"{{{labels}}}"
+
+
+def render_text(snap: Snapshot) -> str:
+    """Metrics in the Prometheus text exposition format"""
+    lines = []
+
+    for name in sorted(snap):
+        metric = snap[name]
+        names = metric["labelnames"]
+        documentation = metric["documentation"].replace("\n", " ")
+
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+
+        for key, value in sorted(metric["values"]):
+            if metric["type"] != "histogram":
+                labels = format_labels(names, key)
+                lines.append(f"{name}{labels} {format_value(value)}")
+                continue
+
+            counts, total = value
+            cumulative = 0
+            bounds = metric["buckets"] + [math.inf]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = format_labels(names, key, le=format_value(bound))
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+
+            labels = format_labels(names, key)
+            lines.append(f"{name}_sum{labels} {format_value(total)}")
+            lines.append(f"{name}_count{labels} {cumulative}")
+
+    return "\n".join(lines) + "\n"
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def get_start_time(pid: int) -> Optional[str]:
+    """When a process started, in clock ticks after boot, to tell it from
+    a later process given the same pid. None where /proc is missing."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The fields after the command, which can have spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+
+    return fields[19]
+
+
+def get_process_id(pid: int) -> str:
+    """Name of the snapshot of a process"""
+    start = get_start_time(pid)
+    return f"{pid}-{start}" if start else str(pid)
+
+
+def is_process_alive(process_id: str) -> bool:
+    pid, _, start = process_id.partition("-")
+
+    if not is_alive(int(pid)):
+        return False
+
+    # Without /proc, processes are told apart by their pid only
+    return get_start_time(int(pid)) in (start or None, None)
+
+
+class MetricsDir:
+    """Shares the metrics of the processes of a deployment, like gunicorn
+    workers, through snapshots in METRICS_DIR.
+
+    Every process writes its snapshot as <pid>-<start time>.json every
+    METRICS_FLUSH_INTERVAL seconds and at exit, and the one serving the
+    scrape adds them all up. The counters and histograms of processes
+    which have exited are added to dead.json and their snapshots deleted,
+    like the multiprocess mode of prometheus_client, so that totals do not
+    go down when a worker is replaced and the directory does not grow with
+    every restart. Their gauges are dropped. The start time tells a worker
+    from an exited one which had the same pid. Without METRICS_DIR, only
+    the metrics of the current process are served.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.path: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        self.stop()
+
+        self.app = app
+        self.path = app.config["METRICS_DIR"]
+        app.extensions["metrics_dir"] = self
+
+        if self.path is None:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+
+        interval = app.config["METRICS_FLUSH_INTERVAL"]
+        if interval:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(interval,), daemon=True
+            )
+            self._thread.start()
+
+        atexit.register(self.stop)
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.warning(f"Unable to write metrics snapshot: {exc}")
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.flush()
+
+    def flush(self):
+        """Write the snapshot of this process"""
+        if self.path is None:
+            return
+
+        self._write(f"{get_process_id(os.getpid())}.json", snapshot())
+
+    def read(self) -> List[Snapshot]:
+        """Snapshots of the processes alive and the aggregate of the dead,
+        after moving the ones which have exited into it"""
+        with open(os.path.join(self.path, ".lock"), "a") as lock:
+            # Only one process moves snapshots at a time
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            own = get_process_id(os.getpid())
+            dead = self._load("dead.json") or {}
+            snapshots = []
+            exited = []
+
+            for name in os.listdir(self.path):
+                process_id, ext = os.path.splitext(name)
+                if ext != ".json" or not process_id.replace("-", "").isdigit():
+                    continue
+
+                snap = self._load(name)
+                if snap is None:
+                    continue  # Removed, or unreadable
+
+                if process_id == own or is_process_alive(process_id):
+                    snapshots.append(snap)
+                    continue
+
+                kept = {
+                    name: metric
+                    for name, metric in snap.items()
+                    if metric["type"] != "gauge"
+                }
+                dead = merge_snapshots([dead, kept])
+                exited.append(name)
+
+            if exited:
+                # Written before the snapshots are removed, a crash in
+                # between counts them twice rather than not at all
+                self._write("dead.json", dead)
+                for name in exited:
+                    os.unlink(os.path.join(self.path, name))
+
+        return [dead, *snapshots] if dead else snapshots
+
+    def _load(self, name: str) -> Optional[Snapshot]:
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, name: str, snap: Snapshot):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(snap, f)
+
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+    def render(self) -> str:
+        """Metrics of all processes in the Prometheus text format"""
+        if self.path is None:
+            snapshots = [snapshot()]
+        else:
+            self.flush()
+            snapshots = self.read()
+
+        return render_text({**merge_snapshots(snapshots), **collect()})
+
+
+metrics_dir = MetricsDir()
@@ -0,0 +1,82 @@
+import logging
+from typing import List
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+
+from chess_server import db
+from chess_server.models import UserModel
+
+logger = logging.getLogger(__name__)
+
+
+def upgrade_user_table() -> List[str]:
+    """Add the columns and index which the user table got after it was
+    first created, as db.create_all never alters an existing table. Rows
+    already there get version 1 and are active as of now; their start is
+    unknown. Returns what was done, nothing when up to date.
+    """
+    table = UserModel.__table__
+    inspector = inspect(db.engine)
+
+    if table.name not in inspector.get_table_names():
+        return []
+
+    columns = {column["name"] for column in inspector.get_columns(table.name)}
+    indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+    postgres = db.engine.dialect.name == "postgresql"
+    steps = []
+
+    if "created_at" not in columns:
+        steps.append(
+            f"ALTER TABLE {table.name} ADD COLUMN created_at TIMESTAMP"
+        )
+
+    if "version" not in columns:
+        steps.append(
+            f"ALTER TABLE {table.name} "
+            "ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+        )
+
+    if "last_active_at" not in columns:
+        # SQLite can neither add a column with a default of now nor make
+        # it NOT NULL later, the model fills it in on every write there
+        steps.append(
+            f"ALTER TABLE {table.name} ADD COLUMN last_active_at TIMESTAMP"
+        )
+        steps.append(
+            f"UPDATE {table.name} SET last_active_at = CURRENT_TIMESTAMP"
+        )
+        if postgres:
+            steps.append(
+                f"ALTER TABLE {table.name} ALTER COLUMN last_active_at "
+                "SET NOT NULL"
+            )
+
+    for index in table.indexes:
+        if index.name not in indexes:
+            columns = ", ".join(column.name for column in index.columns)
+            steps.append(
+                f"CREATE INDEX {index.name} ON {table.name} ({columns})"
+            )
+
+    with db.engine.begin() as conn:
+        for step in steps:
+            logger.info(f"Upgrading schema: {step}")
+            conn.execute(step)
+
+    return steps
+
+
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    """Upgrade the tables of an existing database to the current models.
+    Run it before starting a new version of the app."""
+    steps = upgrade_user_table()
+
+    for step in steps:
+        click.echo(step)
+
+    click.echo("Upgraded the database." if steps else "Nothing to upgrade.")
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from chess_server import db
 
 
@@ -6,3 +8,29 @@ class UserModel(db.Model):
     session_id = db.Column(db.String(128), primary_key=True)
     board = db.Column(db.PickleType, nullable=False)
     color = db.Column(db.Boolean, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    # Indexed for the range scan of the session reaper
+    last_active_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        index=True,
+    )
+    # Bumped on every write; updates only apply to the version they read
+    version = db.Column(db.Integer, nullable=False)
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+class WebhookResponseModel(db.Model):
+    """Response to a webhook delivery, shared by all workers so that any of
+    them can answer a retry"""
+
+    __tablename__ = "webhook_response"
+
+    key = db.Column(db.String(64), primary_key=True)
+    # None while the first delivery is running
+    response = db.Column(db.Text, nullable=True)
+    # Indexed for deleting expired responses
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
@@ -0,0 +1,309 @@
+import atexit
+import cProfile
+import collections
+import itertools
+import marshal
+import os
+import re
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import click
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from chess_server.metrics import counter
+from chess_server.storage import atomic_write
+
+profiles_written = counter(
+    "profiles_written_total",
+    "Profiles written to the profile store, by mode",
+    labelnames=("mode",),
+)
+
+MODES = ("cprofile", "sample")
+PROFILE_NAME_RE = re.compile(r"^[\w.-]+\.(pstats|collapsed)$")
+
+
+def get_profile_token_serializer() -> URLSafeTimedSerializer:
+    return URLSafeTimedSerializer(
+        current_app.config["SECRET_KEY"], salt="profile"
+    )
+
+
+def make_profile_token(mode: str = "cprofile") -> str:
+    """Token asking to profile a request, as the X-Profile header or the
+    profile query parameter"""
+    if mode not in MODES:
+        raise ValueError(f"Unknown profiling mode: {mode}")
+
+    return get_profile_token_serializer().dumps({"mode": mode})
+
+
+def read_profile_token(token: str) -> Optional[str]:
+    """Profiling mode of a token, None unless it is valid and recent"""
+    try:
+        data = get_profile_token_serializer().loads(
+            token, max_age=current_app.config["PROFILE_TOKEN_MAX_AGE"]
+        )
+    except BadSignature:
+        return None
+
+    mode = data.get("mode") if isinstance(data, dict) else None
+    return mode if mode in MODES else None
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse_stack(frame) -> str:
+    """A stack as `root;...;leaf` for flamegraph tools"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+def format_collapsed(stacks: Dict[str, int]) -> bytes:
+    lines = (f"{stack} {count}" for stack, count in sorted(stacks.items()))
+    return ("\n".join(lines) + "\n").encode()
+
+
+class StackSampler:
+    """Samples the stacks of threads every `interval` seconds, from a
+    thread of its own, and counts them as collapsed stacks. Only the
+    thread `thread_id` is sampled if given."""
+
+    def __init__(self, interval: float, thread_id: Optional[int] = None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stacks: Dict[str, int] = collections.Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def take(self) -> Dict[str, int]:
+        """Stacks counted since the last call"""
+        with self._lock:
+            stacks, self.stacks = self.stacks, collections.Counter()
+
+        return stacks
+
+    def _run(self):
+        own = threading.get_ident()
+
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+
+            if self.thread_id is not None:
+                frames = {self.thread_id: frames.get(self.thread_id)}
+
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if frame is not None and thread_id != own:
+                        self.stacks[collapse_stack(frame)] += 1
+
+
+class ProfileStore:
+    """Profiles in a directory, of which the PROFILE_MAX_FILES newest are
+    kept"""
+
+    def __init__(self, path: str, max_files: int):
+        self.path = path
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def save(self, name: str, data: bytes) -> str:
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{name}"
+
+        with self._lock:
+            atomic_write(os.path.join(self.path, name), data)
+
+            for old in itertools.islice(self.list(), self.max_files, None):
+                try:
+                    os.remove(os.path.join(self.path, old["name"]))
+                except FileNotFoundError:
+                    pass
+
+        return name
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Profiles, newest first"""
+        profiles = []
+
+        for entry in os.scandir(self.path):
+            if not PROFILE_NAME_RE.match(entry.name):
+                continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            profiles.append(
+                {
+                    "name": entry.name,
+                    "size": stat.st_size,
+                    "created": stat.st_mtime,
+                }
+            )
+
+        return sorted(profiles, key=lambda p: p["created"], reverse=True)
+
+    def get_path(self, name: str) -> Optional[str]:
+        if not PROFILE_NAME_RE.match(name):
+            return None
+
+        path = os.path.join(self.path, name)
+        return path if os.path.exists(path) else None
+
+
+class Profiler:
+    """Profiles single requests on demand, and optionally samples the whole
+    process all the time.
+
+    A request carrying a token from `make_profile_token`, signed with
+    SECRET_KEY and at most PROFILE_TOKEN_MAX_AGE seconds old, in the
+    X-Profile header or the profile query parameter, runs under cProfile
+    (saved as pstats) or under a stack sampler taking a sample every
+    PROFILE_SAMPLE_INTERVAL seconds (saved as collapsed stacks).
+
+    With PROFILE_SAMPLER_INTERVAL, every thread of the process is sampled
+    at that low rate and the collapsed stacks are saved every
+    PROFILE_SAMPLER_FLUSH_INTERVAL seconds, ready for a flamegraph.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.store: Optional[ProfileStore] = None
+        self.sampler: Optional[StackSampler] = None
+        self._flusher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        self.stop()
+
+        self.app = app
+        app.extensions["profiler"] = self
+
+        path = app.config["PROFILE_DIR"] or os.path.join(
+            app.config["IMG_DIR"], "profiles"
+        )
+        os.makedirs(path, exist_ok=True)
+        self.store = ProfileStore(path, app.config["PROFILE_MAX_FILES"])
+
+        app.before_request(self.start_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.end_request)
+        app.cli.add_command(profile_token_command)
+
+        interval = app.config["PROFILE_SAMPLER_INTERVAL"]
+        if interval:
+            self.sampler = StackSampler(interval)
+            self.sampler.start()
+            self._stop = threading.Event()
+            self._flusher = threading.Thread(target=self._run, daemon=True)
+            self._flusher.start()
+            atexit.register(self.stop)
+
+    def start_request(self):
+        token = request.headers.get("X-Profile") or request.args.get(
+            "profile"
+        )
+        if not token:
+            return
+
+        mode = read_profile_token(token)
+        if mode is None:
+            return
+
+        if mode == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+        else:
+            profile = StackSampler(
+                self.app.config["PROFILE_SAMPLE_INTERVAL"],
+                threading.get_ident(),
+            )
+            profile.start()
+
+        g.profile = (mode, profile)
+
+    def after_request(self, response):
+        name = self.end_request()
+        if name is not None:
+            response.headers["X-Profile-Name"] = name
+
+        return response
+
+    def end_request(self, exc=None) -> Optional[str]:
+        """Stop profiling the request and save its profile"""
+        mode, profile = g.pop("profile", (None, None))
+        if profile is None:
+            return None
+
+        endpoint = request.endpoint or "unknown"
+
+        if mode == "cprofile":
+            profile.disable()
+            # What Profile.dump_stats writes, for pstats.Stats to read
+            profile.create_stats()
+            name = self.store.save(
+                f"{endpoint}.pstats", marshal.dumps(profile.stats)
+            )
+        else:
+            profile.stop()
+            name = self.store.save(
+                f"{endpoint}.collapsed", format_collapsed(profile.take())
+            )
+
+        profiles_written.inc(mode=mode)
+        return name
+
+    def flush(self):
+        """Save the stacks counted by the always-on sampler"""
+        stacks = self.sampler.take()
+        if stacks:
+            self.store.save("sampler.collapsed", format_collapsed(stacks))
+            profiles_written.inc(mode="sampler")
+
+    def _run(self):
+        interval = self.app.config["PROFILE_SAMPLER_FLUSH_INTERVAL"]
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def stop(self):
+        if self.sampler is not None:
+            self._stop.set()
+            self._flusher.join()
+            self.sampler.stop()
+            self.flush()
+            self.sampler = None
+
+
+@click.command("profile-token")
+@click.option("--mode", type=click.Choice(MODES), default="cprofile")
+@with_appcontext
+def profile_token_command(mode):
+    """Print a token to profile requests with, as the X-Profile header."""
+    click.echo(make_profile_token(mode))
+
+
+profiler = Profiler()
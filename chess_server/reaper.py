@@ -0,0 +1,202 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from chess_server import db
+from chess_server.idempotency import delete_expired_responses
+from chess_server.metrics import counter
+from chess_server.models import UserModel
+from chess_server.replay import replay_recorder
+from chess_server.storage import get_image_store
+
+logger = logging.getLogger(__name__)
+
+rows_reaped = counter(
+    "reaper_rows_deleted_total", "Expired game sessions deleted"
+)
+files_reaped = counter(
+    "reaper_files_deleted_total", "Board images deleted by the reaper"
+)
+bytes_reaped = counter(
+    "reaper_bytes_reclaimed_total", "Bytes of board images deleted"
+)
+responses_reaped = counter(
+    "reaper_webhook_responses_deleted_total",
+    "Expired webhook responses deleted from the database",
+)
+
+
+class ReapResult(NamedTuple):
+    rows: int = 0
+    files: int = 0
+    bytes: int = 0
+
+
+def reap_expired_sessions(
+    ttl: Optional[float] = None,
+    batch_size: Optional[int] = None,
+    max_batches: Optional[int] = None,
+    batch_delay: Optional[float] = None,
+) -> ReapResult:
+    """Delete sessions inactive for more than `ttl` seconds along with their
+    board images, and the webhook responses which have expired.
+
+    Expired rows are found with a range scan on the last_active_at index and
+    deleted `batch_size` at a time, sleeping `batch_delay` seconds between
+    batches and stopping after `max_batches` to cap the load on the db.
+    Arguments default to the REAPER_* config values.
+    """
+    config = current_app.config
+    ttl = config["REAPER_SESSION_TTL"] if ttl is None else ttl
+    batch_size = batch_size or config["REAPER_BATCH_SIZE"]
+    max_batches = max_batches or config["REAPER_MAX_BATCHES"]
+    if batch_delay is None:
+        batch_delay = config["REAPER_BATCH_DELAY"]
+
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    rows = files = freed = 0
+
+    for batch in range(max_batches):
+        if batch and batch_delay:
+            time.sleep(batch_delay)
+
+        expired = (
+            db.session.query(UserModel.session_id)
+            .filter(UserModel.last_active_at < cutoff)
+            .order_by(UserModel.last_active_at)
+            .limit(batch_size)
+            .all()
+        )
+        session_ids = [session_id for (session_id,) in expired]
+
+        if not session_ids:
+            break
+
+        # Check the cutoff again so that sessions which were played in the
+        # meantime are left alone
+        deleted = (
+            UserModel.query.filter(UserModel.session_id.in_(session_ids))
+            .filter(UserModel.last_active_at < cutoff)
+            .delete(synchronize_session=False)
+        )
+        db.session.commit()
+        rows += deleted
+
+        for session_id in session_ids:
+            size = replay_recorder.delete(session_id)
+            if size:
+                files += 1
+                freed += size
+
+        if len(session_ids) < batch_size:
+            break
+
+    sweep = sweep_stale_images(ttl, limit=batch_size * max_batches)
+    responses_reaped.inc(delete_expired_responses())
+    result = ReapResult(
+        rows=rows, files=files + sweep.files, bytes=freed + sweep.bytes
+    )
+
+    rows_reaped.inc(result.rows)
+    files_reaped.inc(result.files)
+    bytes_reaped.inc(result.bytes)
+
+    return result
+
+
+def sweep_stale_images(ttl: float, limit: int) -> ReapResult:
+    """Delete up to `limit` images and replays not modified in the last `ttl`
+    seconds. These are left behind by games which have ended or were reaped
+    before.
+    """
+    older_than = time.time() - ttl
+    files, freed = get_image_store().sweep(older_than, limit)
+    replay_files, replay_freed = replay_recorder.sweep(older_than, limit)
+
+    return ReapResult(files=files + replay_files, bytes=freed + replay_freed)
+
+
+class SessionReaper:
+    """Runs `reap_expired_sessions` every REAPER_INTERVAL seconds in a
+    background thread. An interval of 0 disables the thread.
+
+    Workers with the reaper on take turns: a round is skipped while another
+    process holds the lock on REAPER_LOCK_FILE.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions["session_reaper"] = self
+        app.cli.add_command(reap_sessions_command)
+
+        if app.config["REAPER_INTERVAL"] and self._thread is None:
+            self.start()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="session-reaper", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def lock_path(self) -> str:
+        return self.app.config["REAPER_LOCK_FILE"] or os.path.join(
+            self.app.config["IMG_DIR"], "reaper.lock"
+        )
+
+    def run_once(self) -> Optional[ReapResult]:
+        """Reap unless another process is reaping, then return None"""
+        with open(self.lock_path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            return reap_expired_sessions()
+
+    def _run(self):
+        while True:
+            time.sleep(self.app.config["REAPER_INTERVAL"])
+
+            with self.app.app_context():
+                try:
+                    result = self.run_once()
+                except Exception as exc:
+                    db.session.rollback()
+                    logger.error(f"Session reaper failed:\n{str(exc)}")
+                    continue
+                finally:
+                    db.session.remove()
+
+            if result is not None and any(result):
+                logger.info(
+                    f"Reaped {result.rows} sessions and {result.files} "
+                    f"images ({result.bytes} bytes)"
+                )
+
+
+session_reaper = SessionReaper()
+
+
+@click.command("reap-sessions")
+@click.option("--ttl", type=float, help="Idle seconds before expiry.")
+@with_appcontext
+def reap_sessions_command(ttl):
+    """Delete expired sessions and their board images."""
+    result = reap_expired_sessions(ttl=ttl)
+    click.echo(
+        f"Deleted {result.rows} sessions and {result.files} images, "
+        f"reclaimed {result.bytes} bytes."
+    )
@@ -0,0 +1,462 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import chess
+import chess.svg
+from cairosvg import svg2png
+from PIL import Image
+
+from chess_server.metrics import counter, histogram
+from chess_server.storage import (
+    BOARDS_PREFIX,
+    atomic_write,
+    iter_files,
+    shard_path,
+)
+from chess_server.tracing import span
+
+logger = logging.getLogger(__name__)
+
+cache_lookups = counter(
+    "render_cache_lookups_total",
+    "Board image lookups by the tier which served them",
+    labelnames=("tier",),
+)
+cache_bytes_saved = counter(
+    "render_cache_bytes_saved_total",
+    "Bytes of images served from the cache instead of being rendered",
+)
+render_duration = histogram(
+    "render_duration_seconds", "Time taken to render one board image"
+)
+
+
+# Encodings of board images, with their MIME type and file extension.
+# png8 is a PNG with a 64 colour palette, a fraction of the size of the
+# full colour one.
+IMAGE_FORMATS = {
+    "png": ("image/png", "png"),
+    "png8": ("image/png", "png"),
+    "webp": ("image/webp", "webp"),
+}
+
+
+class BoardSpec(NamedTuple):
+    """Everything that decides how a board image looks"""
+
+    board_fen: str
+    lastmove: Optional[str] = None
+    flipped: bool = False
+    size: Optional[int] = None
+    style: Optional[str] = None
+    format: str = "png"
+
+    @classmethod
+    def from_board(
+        cls,
+        board: chess.Board,
+        flipped: Optional[bool] = False,
+        size: Optional[int] = None,
+        style: Optional[str] = None,
+    ) -> "BoardSpec":
+        lastmove = board.peek().uci() if board.move_stack else None
+        return cls(board.board_fen(), lastmove, bool(flipped), size, style)
+
+    @property
+    def mimetype(self) -> str:
+        return IMAGE_FORMATS[self.format][0]
+
+    @property
+    def extension(self) -> str:
+        return IMAGE_FORMATS[self.format][1]
+
+    @property
+    def key(self) -> str:
+        """Content hash identifying the rendered image"""
+        parts = [
+            self.board_fen,
+            self.lastmove or "-",
+            "f" if self.flipped else "-",
+            str(self.size or "-"),
+            hashlib.sha1((self.style or "").encode()).hexdigest(),
+            self.format,
+        ]
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+    def to_svg(self) -> str:
+        lastmove = None
+        if self.lastmove:
+            lastmove = chess.Move.from_uci(self.lastmove)
+
+        return str(
+            chess.svg.board(
+                chess.BaseBoard(self.board_fen),
+                lastmove=lastmove,
+                flipped=self.flipped,
+                size=self.size,
+                style=self.style,
+            )
+        )
+
+
+# Size of the board in chess.svg units, including the coordinate margin
+VIEWBOX_SIZE = 390
+MARGIN = 15
+
+
+class SpriteRenderer:
+    """Draws boards by compositing pre-rasterised layers with Pillow instead
+    of rasterising the whole SVG for every image.
+
+    For one size and style, the empty board and the same board with every
+    square highlighted as last move are rendered once per orientation, plus
+    one layer per piece with that piece on all 64 squares. An image is then
+    built by copying square sized boxes out of these layers, which keeps the
+    look of the SVG renderer down to its anti-aliasing.
+    """
+
+    def __init__(
+        self, size: Optional[int] = None, style: Optional[str] = None
+    ):
+        self.size = size or VIEWBOX_SIZE
+        self.style = style
+
+        scale = self.size / VIEWBOX_SIZE
+        self.edges = [round((MARGIN + 45 * i) * scale) for i in range(9)]
+
+        self.backgrounds = {}
+        self.highlights = {}
+        for flipped in (False, True):
+            svg = self._board_svg(None, flipped)
+            self.backgrounds[flipped] = self._rasterise(svg)
+            self.highlights[flipped] = self._rasterise(self._highlight(svg))
+
+        self.pieces = {}
+        for symbol in "PNBRQKpnbrqk":
+            board = chess.BaseBoard.empty()
+            for square in chess.SQUARES:
+                board.set_piece_at(square, chess.Piece.from_symbol(symbol))
+
+            # Without the square and margin rects the layer is transparent
+            svg = re.sub(r"<rect [^>]*/>", "", self._board_svg(board, False))
+            self.pieces[symbol] = self._rasterise(svg)
+
+    def _board_svg(self, board: Optional[chess.BaseBoard], flipped: bool):
+        return str(
+            chess.svg.board(
+                board, flipped=flipped, size=self.size, style=self.style
+            )
+        )
+
+    @staticmethod
+    def _highlight(svg: str) -> str:
+        """Mark every square of a board SVG as part of the last move"""
+
+        def repl(match):
+            shade = match.group(1)
+            fill = chess.svg.DEFAULT_COLORS[f"square {shade} lastmove"]
+            return (
+                f'class="square {shade} lastmove {match.group(2)}" '
+                f'stroke="none" fill="{fill}"'
+            )
+
+        return re.sub(
+            r'class="square (light|dark) (\w\d)" stroke="none" fill="[^"]*"',
+            repl,
+            svg,
+        )
+
+    @staticmethod
+    def _rasterise(svg: str) -> Image.Image:
+        return Image.open(io.BytesIO(svg2png(bytestring=svg))).convert("RGBA")
+
+    def square_box(
+        self, square: chess.Square, flipped: bool
+    ) -> Tuple[int, int, int, int]:
+        """Pixel box of a square as (left, upper, right, lower)"""
+        file_index = chess.square_file(square)
+        rank_index = chess.square_rank(square)
+
+        col = 7 - file_index if flipped else file_index
+        row = rank_index if flipped else 7 - rank_index
+
+        return (
+            self.edges[col],
+            self.edges[row],
+            self.edges[col + 1],
+            self.edges[row + 1],
+        )
+
+    def render(self, spec: BoardSpec) -> bytes:
+        image = self.backgrounds[spec.flipped].copy()
+
+        if spec.lastmove:
+            move = chess.Move.from_uci(spec.lastmove)
+            for square in (move.from_square, move.to_square):
+                box = self.square_box(square, spec.flipped)
+                image.paste(self.highlights[spec.flipped].crop(box), box[:2])
+
+        board = chess.BaseBoard(spec.board_fen)
+        for square, piece in board.piece_map().items():
+            box = self.square_box(square, spec.flipped)
+            image.alpha_composite(
+                self.pieces[piece.symbol()], dest=box[:2], source=box
+            )
+
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+
+        return output.getvalue()
+
+
+_sprite_renderers: Dict[Tuple[Optional[int], Optional[str]], SpriteRenderer]
+_sprite_renderers = {}
+_sprite_renderers_lock = threading.Lock()
+
+
+def get_sprite_renderer(
+    size: Optional[int] = None, style: Optional[str] = None
+) -> SpriteRenderer:
+    """Sprite renderer for a size and style, prepared on first use"""
+    with _sprite_renderers_lock:
+        renderer = _sprite_renderers.get((size, style))
+
+        if renderer is None:
+            renderer = SpriteRenderer(size=size, style=style)
+            _sprite_renderers[(size, style)] = renderer
+
+        return renderer
+
+
+def warm_sprite_renderers(
+    sizes: Iterable[Optional[int]], style: Optional[str] = None
+):
+    """Prepare the sprite renderers of every size images are served in"""
+    for size in sorted(set(sizes), key=lambda size: size or 0):
+        get_sprite_renderer(size, style)
+
+
+def render_png(spec: BoardSpec, backend: str = "svg") -> bytes:
+    """Rasterise a board to PNG with the "svg" (cairosvg) or "sprite"
+    backend"""
+    with render_duration.time():
+        if backend == "sprite":
+            return get_sprite_renderer(spec.size, spec.style).render(spec)
+
+        return svg2png(bytestring=spec.to_svg())
+
+
+def convert_png(png: bytes, format: str) -> bytes:
+    """Re-encode a PNG in one of `IMAGE_FORMATS`"""
+    if format == "png":
+        return png
+
+    image = Image.open(io.BytesIO(png))
+    output = io.BytesIO()
+
+    if format == "png8":
+        image = image.convert("RGB").quantize(colors=64)
+        image.save(output, format="PNG", optimize=True)
+    elif format == "webp":
+        image.save(output, format="WEBP", quality=80, method=4)
+    else:
+        raise ValueError(f"Unknown image format: {format}")
+
+    return output.getvalue()
+
+
+def render_image(spec: BoardSpec, backend: str = "svg") -> bytes:
+    """Render a board in the size and format of the spec"""
+    return convert_png(render_png(spec, backend), spec.format)
+
+
+def get_image_sizes(config) -> List[Optional[int]]:
+    """Sizes of BOARD_IMAGE_SIZE and the image variants"""
+    return [config["BOARD_IMAGE_SIZE"], *config["IMAGE_SIZES"].values()]
+
+
+class RenderCache:
+    """Tiered cache of rendered boards keyed by `BoardSpec.key`.
+
+    An in-process LRU holds up to RENDER_CACHE_MEMORY_BYTES and a directory
+    shared by all workers of a node holds up to RENDER_CACHE_DISK_BYTES,
+    evicting the least recently written files first. Identical positions are
+    therefore rendered once and shared by every session. If the image store
+    is shared between nodes, boards are also kept there so that any node
+    can serve them.
+    """
+
+    def __init__(self):
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.memory_limit = 0
+        self.disk_dir = None
+        self.disk_limit = 0
+        self.disk_bytes = None  # Computed on first write
+        self.backend = "svg"
+        self.store = None
+        # The memory tier is behind _lock, which lookups take, while writes
+        # to the disk tier are counted and evicted under _disk_lock
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.memory.clear()
+        self.memory_bytes = 0
+        self.memory_limit = app.config["RENDER_CACHE_MEMORY_BYTES"]
+        self.disk_limit = app.config["RENDER_CACHE_DISK_BYTES"]
+        self.disk_dir = app.config["RENDER_CACHE_DIR"] or os.path.join(
+            app.config["IMG_DIR"], "cache"
+        )
+        self.disk_bytes = None
+        os.makedirs(self.disk_dir, exist_ok=True)
+        app.extensions["render_cache"] = self
+
+        store = app.extensions["image_store"]
+        self.store = store if store.shared else None
+
+        self.backend = app.config["BOARD_RENDERER"]
+        if self.backend == "sprite":
+            # Pre-rasterise the layers at startup rather than in a request
+            warm_sprite_renderers(
+                get_image_sizes(app.config), app.config["BOARD_IMAGE_STYLE"]
+            )
+
+    def get_image(self, spec: BoardSpec) -> bytes:
+        """Get the image of a board, rendering it only on a miss"""
+        image = self.lookup(spec)
+
+        if image is None:
+            with span("render", backend=self.backend, size=spec.size):
+                image = render_image(spec, self.backend)
+            self.put(spec, image)
+
+        return image
+
+    def lookup(self, spec: BoardSpec) -> Optional[bytes]:
+        """Get the image of a board if it is cached"""
+        return self.lookup_key(spec.key, spec.extension)
+
+    def lookup_key(self, key: str, ext: str = "png") -> Optional[bytes]:
+        """Get a cached image by `BoardSpec.key` and file extension"""
+        image = self._get_from_memory(key)
+        if image is not None:
+            cache_lookups.inc(tier="memory")
+            cache_bytes_saved.inc(len(image))
+            return image
+
+        image = self._get_from_disk(key, ext)
+        if image is not None:
+            cache_lookups.inc(tier="disk")
+            cache_bytes_saved.inc(len(image))
+            self._put_in_memory(key, image)
+            return image
+
+        if self.store is not None:
+            image = self.store.get(f"{BOARDS_PREFIX}/{key}")
+            if image is not None:
+                cache_lookups.inc(tier="store")
+                cache_bytes_saved.inc(len(image))
+                self._put_in_memory(key, image)
+                self._put_on_disk(key, ext, image)
+                return image
+
+        cache_lookups.inc(tier="miss")
+        return None
+
+    def put(self, spec: BoardSpec, image: bytes):
+        """Add a rendered board to every tier"""
+        self._put_in_memory(spec.key, image)
+        self._put_on_disk(spec.key, spec.extension, image)
+
+        if self.store is not None:
+            self.store.put(f"{BOARDS_PREFIX}/{spec.key}", image, spec.mimetype)
+
+    def disk_path(self, key: str, ext: str = "png") -> str:
+        return shard_path(self.disk_dir, f"{key}.{ext}", key)
+
+    def _get_from_memory(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            image = self.memory.get(key)
+            if image is not None:
+                self.memory.move_to_end(key)
+
+            return image
+
+    def _put_in_memory(self, key: str, image: bytes):
+        if len(image) > self.memory_limit:
+            return
+
+        with self._lock:
+            if key in self.memory:
+                return
+
+            self.memory[key] = image
+            self.memory_bytes += len(image)
+
+            while self.memory_bytes > self.memory_limit:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+    def _get_from_disk(self, key: str, ext: str) -> Optional[bytes]:
+        if not self.disk_limit:
+            return None
+
+        try:
+            with open(self.disk_path(key, ext), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _put_on_disk(self, key: str, ext: str, image: bytes):
+        if not self.disk_limit:
+            return
+
+        try:
+            atomic_write(self.disk_path(key, ext), image)
+        except OSError as exc:
+            logger.error(f"Unable to write render cache entry: {exc}")
+            return
+
+        with self._disk_lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = self._scan_disk_usage()
+            else:
+                self.disk_bytes += len(image)
+
+            if self.disk_bytes > self.disk_limit:
+                self._evict_from_disk()
+
+    def _scan_disk_usage(self) -> int:
+        return sum(entry.stat().st_size for entry in iter_files(self.disk_dir))
+
+    def _evict_from_disk(self):
+        """Delete the oldest files until the cache is at 90% of its limit"""
+        files = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in iter_files(self.disk_dir)
+        )
+
+        # Other workers write to the same directory, so start from the truth
+        self.disk_bytes = sum(size for _, size, _ in files)
+        target = self.disk_limit * 0.9
+
+        for _, size, path in files:
+            if self.disk_bytes <= target:
+                break
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+            self.disk_bytes -= size
+
+
+render_cache = RenderCache()
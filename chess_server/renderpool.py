@@ -0,0 +1,270 @@
+import atexit
+import io
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+from chess_server.metrics import counter, gauge
+from chess_server.render import (
+    BoardSpec,
+    get_image_sizes,
+    render_cache,
+    render_duration,
+    render_image,
+    warm_sprite_renderers,
+)
+
+logger = logging.getLogger(__name__)
+
+pending_renders = gauge(
+    "render_pool_pending", "Board images waiting for a render process"
+)
+inline_renders = counter(
+    "render_pool_inline_total",
+    "Board images rendered in the request because the render queue was full",
+)
+placeholders_served = counter(
+    "render_pool_placeholders_total",
+    "Placeholders served for images which were still being rendered",
+)
+
+
+def render_in_worker(spec: BoardSpec, backend: str) -> Tuple[bytes, float]:
+    """`render_image` in a render process, also returning the time taken
+    since metrics recorded in the render processes are lost"""
+    start = time.perf_counter()
+    image = render_image(spec, backend)
+
+    return image, time.perf_counter() - start
+
+
+def get_result(future: Future) -> bytes:
+    """Image of a finished render, recording its duration"""
+    image, duration = future.result()
+    render_duration.observe(duration)
+
+    return image
+
+
+class PendingRender:
+    """A board image being rendered for one image key"""
+
+    def __init__(self, spec: BoardSpec):
+        self.spec = spec
+        # Set once the image is in the render cache, or has failed
+        self.done = threading.Event()
+        self.future: Optional[Future] = None
+
+    def wait(self, timeout: float) -> bool:
+        return self.done.wait(timeout)
+
+
+class RenderPool:
+    """Renders board images in a pool of RENDER_WORKERS processes so that
+    rasterising does not hold the GIL of the worker serving requests.
+
+    Images are submitted by key (the session id) and land in the render
+    cache, and the request returns as soon as the URL is known. At most
+    RENDER_QUEUE_SIZE renders are pending or waited for at once; beyond
+    that images are rendered in the request again, which slows down the
+    callers rather than growing the queue. A pool size of 0 disables the
+    pool. If a render process dies, the pool is replaced on the next
+    submit.
+
+    The render processes are started by a fork server, as forking a worker
+    with threads running (database pool, flushers) can leave their locks
+    held in the child.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.pending: Dict[str, PendingRender] = {}
+        # Renders of get_image, which the calling thread waits for
+        self.waiting = 0
+        self._executor = None
+        self._placeholders: Dict[int, bytes] = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions["render_pool"] = self
+        atexit.register(self.close)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.app and self.app.config["RENDER_WORKERS"])
+
+    def submit(self, imgkey: str, spec: BoardSpec) -> PendingRender:
+        """Render a board into the render cache in the background. A render
+        still pending for the same imgkey is superseded.
+        """
+        render = PendingRender(spec)
+        queue_size = self.app.config["RENDER_QUEUE_SIZE"]
+
+        image = render_cache.lookup(spec)
+        if image is None and self.queued >= queue_size:
+            inline_renders.inc()
+            image = render_cache.get_image(spec)
+
+        with self._lock:
+            self.pending.pop(imgkey, None)
+
+            if image is None:
+                self.pending[imgkey] = render
+
+            pending_renders.set(self.queued)
+
+        if image is not None:
+            render.done.set()
+            return render
+
+        render.future = self._submit(spec)
+        render.future.add_done_callback(
+            lambda future: self._on_done(imgkey, render, future)
+        )
+
+        return render
+
+    def get_image(self, spec: BoardSpec) -> bytes:
+        """Get the image of a board, rendering it in the pool on a miss.
+        The calling thread blocks, but other threads can run meanwhile.
+        """
+        if not self.enabled:
+            return render_cache.get_image(spec)
+
+        image = render_cache.lookup(spec)
+        if image is not None:
+            return image
+
+        with self._lock:
+            full = self.queued >= self.app.config["RENDER_QUEUE_SIZE"]
+            if not full:
+                self.waiting += 1
+                pending_renders.set(self.queued)
+
+        if full:
+            inline_renders.inc()
+            return render_cache.get_image(spec)
+
+        try:
+            image = get_result(self._submit(spec))
+        except BrokenProcessPool:
+            # The render process died, render this one here
+            logger.error("Render process died, rendering in the request")
+            return render_cache.get_image(spec)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+                pending_renders.set(self.queued)
+
+        render_cache.put(spec, image)
+
+        return image
+
+    @property
+    def queued(self) -> int:
+        """Renders pending or waited for"""
+        return len(self.pending) + self.waiting
+
+    def get_pending(self, imgkey: str) -> Optional[PendingRender]:
+        return self.pending.get(imgkey)
+
+    def get_pending_by_spec_key(self, key: str) -> Optional[PendingRender]:
+        """Pending render of the board with this `BoardSpec.key`"""
+        for render in list(self.pending.values()):
+            if render.spec.key == key:
+                return render
+
+        return None
+
+    def get_placeholder(self, size: Optional[int] = None) -> bytes:
+        """Blank PNG of a board of `size`, BOARD_IMAGE_SIZE by default,
+        served while its image is being rendered"""
+        size = size or self.app.config["BOARD_IMAGE_SIZE"] or 390
+        placeholder = self._placeholders.get(size)
+
+        if placeholder is None:
+            output = io.BytesIO()
+            Image.new("RGB", (size, size), "#212121").save(output, "PNG")
+            placeholder = self._placeholders[size] = output.getvalue()
+
+        placeholders_served.inc()
+        return placeholder
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            # Created lazily so that each forked worker gets its own pool
+            if self._executor is None:
+                config = self.app.config
+                kwargs = {}
+
+                if config["BOARD_RENDERER"] == "sprite":
+                    kwargs["initializer"] = warm_sprite_renderers
+                    kwargs["initargs"] = (
+                        get_image_sizes(config),
+                        config["BOARD_IMAGE_STYLE"],
+                    )
+
+                self._executor = ProcessPoolExecutor(
+                    max_workers=config["RENDER_WORKERS"],
+                    mp_context=multiprocessing.get_context("forkserver"),
+                    **kwargs,
+                )
+
+            return self._executor
+
+    def _submit(self, spec: BoardSpec) -> Future:
+        """Submit a render, replacing the pool if a render process died"""
+        executor = self._get_executor()
+
+        try:
+            return executor.submit(
+                render_in_worker, spec, render_cache.backend
+            )
+        except BrokenProcessPool:
+            logger.error("Render process died, starting a new render pool")
+
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+
+            executor.shutdown(wait=False)
+
+            return self._get_executor().submit(
+                render_in_worker, spec, render_cache.backend
+            )
+
+    def _on_done(self, imgkey: str, render: PendingRender, future: Future):
+        try:
+            image = get_result(future)
+        except Exception as exc:
+            logger.error(
+                f"Unable to process image. Failed with error:\n{str(exc)}"
+            )
+            image = None
+
+        try:
+            if image is not None:
+                render_cache.put(render.spec, image)
+        finally:
+            with self._lock:
+                # A newer position of the same game may be pending already
+                if self.pending.get(imgkey) is render:
+                    del self.pending[imgkey]
+                    pending_renders.set(self.queued)
+
+            render.done.set()
+
+
+render_pool = RenderPool()
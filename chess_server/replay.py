@@ -0,0 +1,414 @@
+import atexit
+import fcntl
+import io
+import logging
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import chess
+from PIL import Image
+
+from chess_server.metrics import counter
+from chess_server.render import BoardSpec
+from chess_server.renderpool import render_pool
+from chess_server.storage import atomic_write, image_path, iter_files, unlink
+
+logger = logging.getLogger(__name__)
+
+frames_appended = counter(
+    "replay_frames_appended_total", "Frames appended to game replays"
+)
+frames_truncated = counter(
+    "replay_frames_truncated_total",
+    "Frames cut from game replays by undo or a new game",
+)
+
+# GIF89a with a logical screen of the frame size and no global colour
+# table, followed by the NETSCAPE2.0 extension to loop forever
+HEADER_SIZE = 32
+GIF_TRAILER = b";"
+# Offset of the delay within a frame, which starts with its graphic control
+# extension
+DELAY_OFFSET = 4
+
+
+def gif_header(width: int, height: int) -> bytes:
+    return (
+        b"GIF89a"
+        + struct.pack("<HHBBB", width, height, 0, 0, 0)
+        + b"!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00"
+    )
+
+
+def gif_frame(image: Image.Image, delay: int) -> bytes:
+    """One frame of an animated GIF, to be written between the header and
+    the trailer. `delay` is in hundredths of a second. The palette of the
+    image is written as its local colour table, so frames are independent
+    of each other and can be appended or cut without touching the rest.
+    """
+    output = io.BytesIO()
+    image.convert("RGB").quantize(colors=256).save(output, "GIF")
+    data = output.getvalue()
+
+    # Global colour table of the single frame GIF written by Pillow
+    flags = data[10]
+    palette_size = 3 * 2 ** ((flags & 0x07) + 1) if flags & 0x80 else 0
+    palette = data[13:13 + palette_size]
+    pos = 13 + palette_size
+
+    # Skip extensions up to the image descriptor
+    while data[pos] == 0x21:
+        pos = _skip_sub_blocks(data, pos + 2)
+
+    if data[pos] != 0x2C:
+        raise ValueError("No image found in GIF")
+
+    descriptor = bytearray(data[pos:pos + 10])
+    pos += 10
+    if not descriptor[9] & 0x80:
+        # Move the global colour table into the frame
+        descriptor[9] |= 0x80 | (flags & 0x07)
+        descriptor += palette
+
+    # LZW minimum code size and the image data
+    end = _skip_sub_blocks(data, pos + 1)
+
+    control = b"!\xf9\x04" + struct.pack("<BHBB", 0x04, delay, 0, 0)
+
+    return control + bytes(descriptor) + data[pos:end]
+
+
+def _skip_sub_blocks(data: bytes, pos: int) -> int:
+    """Position after the data sub-blocks starting at pos"""
+    while data[pos]:
+        pos += data[pos] + 1
+
+    return pos + 1
+
+
+class ReplayIndex(NamedTuple):
+    """Sidecar of a replay. Frame i shows ply `first_ply + i` of the game,
+    ends at byte `ends[i]` of the GIF and is the board with `keys[i]`. The
+    revision is the time the recorded board was saved at."""
+
+    first_ply: int
+    ends: List[int]
+    keys: List[str]
+    revision: float = 0
+
+    def start(self, frame: int) -> int:
+        return self.ends[frame - 1] if frame else HEADER_SIZE
+
+
+def get_ply(board: chess.Board) -> int:
+    """Half moves played before a position"""
+    return (board.fullmove_number - 1) * 2 + (board.turn == chess.BLACK)
+
+
+class ReplayRecorder:
+    """Keeps an animated GIF of every game, growing by one frame per ply as
+    it is played, so that the replay is complete the moment the game ends.
+
+    Frames are rendered through the render cache, so positions which were
+    already shown are not rendered again. Each replay is a valid GIF at all
+    times: a new frame is written over the trailer, which is then written
+    again after it. The sidecar records where every frame ends so that an
+    undo cuts the replay back with a truncate. Replays are kept in
+    REPLAY_DIR, which nodes must share for any of them to serve a replay.
+
+    With REPLAY_IN_BACKGROUND, boards are submitted to a thread which
+    records them after the response has been sent. Only the latest board of
+    a session waits there, and a board saved before the one recorded last,
+    e.g. by a slower worker, is skipped, so replays follow the order in
+    which the game was played.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.dir = None
+        self.pending: Dict[str, Tuple[chess.Board, bool, float]] = (
+            OrderedDict()
+        )
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.dir = app.config["REPLAY_DIR"] or os.path.join(
+            app.config["IMG_DIR"], "replays"
+        )
+        os.makedirs(self.dir, exist_ok=True)
+        app.extensions["replay_recorder"] = self
+        atexit.register(self.close)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.app and self.app.config["REPLAY_ENABLED"])
+
+    def path(self, session_id: str) -> str:
+        return image_path(self.dir, session_id, "gif")
+
+    def index_path(self, session_id: str) -> str:
+        return image_path(self.dir, session_id, "idx")
+
+    def submit(self, session_id: str, board: chess.Board, flipped: bool):
+        """Record a board which was just saved, in the background with
+        REPLAY_IN_BACKGROUND"""
+        revision = time.time()
+
+        if not self.app.config["REPLAY_IN_BACKGROUND"]:
+            self.record(session_id, board, flipped, revision)
+            return
+
+        with self._lock:
+            # A board still waiting is older, this one replaces it
+            self.pending.pop(session_id, None)
+            self.pending[session_id] = (board.copy(), flipped, revision)
+
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def record(
+        self,
+        session_id: str,
+        board: chess.Board,
+        flipped: bool,
+        revision: Optional[float] = None,
+    ):
+        """Bring the replay of a session up to date with its board, saved
+        at `revision` (now by default).
+
+        Frames still matching the board are kept, the rest are cut and the
+        plies after them appended. Usually this appends the one ply just
+        played or cuts the ones just undone.
+        """
+        path = self.path(session_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        with os.fdopen(fd, "r+b") as f:
+            # Serialises writers across threads and worker processes
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self._record(
+                f,
+                session_id,
+                board,
+                flipped,
+                time.time() if revision is None else revision,
+            )
+
+    def flush(self) -> int:
+        """Record all waiting boards, returns the number recorded"""
+        recorded = 0
+
+        while True:
+            with self._lock:
+                if not self.pending:
+                    return recorded
+
+                session_id, (board, flipped, revision) = self.pending.popitem(
+                    last=False
+                )
+
+            try:
+                self.record(session_id, board, flipped, revision)
+                recorded += 1
+            except Exception as exc:
+                logger.error(
+                    f"Unable to record replay. Failed with error:\n{exc}"
+                )
+
+    def close(self):
+        if self.app is not None and self.pending:
+            with self.app.app_context():
+                self.flush()
+
+    def _ensure_thread(self):
+        with self._lock:
+            # Started lazily so that each forked worker gets its own thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="replay-recorder", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+
+            with self.app.app_context():
+                self.flush()
+
+    def read(self, session_id: str) -> Optional[bytes]:
+        try:
+            with open(self.path(session_id), "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return f.read() or None
+        except FileNotFoundError:
+            return None
+
+    def delete(self, session_id: str) -> int:
+        """Delete the replay of a session, returns the bytes freed"""
+        return unlink(self.path(session_id)) + unlink(
+            self.index_path(session_id)
+        )
+
+    def sweep(self, older_than: float, limit: int) -> Tuple[int, int]:
+        """Delete up to `limit` replay files last written before the
+        timestamp `older_than`. Returns the number of files and bytes."""
+        files = freed = 0
+
+        for entry in iter_files(self.dir):
+            if files >= limit:
+                break
+
+            if entry.stat().st_mtime < older_than:
+                freed += unlink(entry.path)
+                files += 1
+
+        return files, freed
+
+    def _record(
+        self,
+        f,
+        session_id: str,
+        board: chess.Board,
+        flipped: bool,
+        revision: float,
+    ):
+        specs = self._get_specs(board, flipped)
+        first_ply = get_ply(board.root())
+        index = self._read_index(session_id)
+
+        if index is not None and index.revision > revision:
+            # A newer board has been recorded already
+            return
+
+        if (
+            index is None
+            or index.start(len(index.ends)) >= os.fstat(f.fileno()).st_size
+            or not 0 <= first_ply - index.first_ply <= len(index.ends)
+        ):
+            # No replay yet, one cut short by the reaper or a board which
+            # starts outside of it
+            index = ReplayIndex(first_ply, [], [])
+
+        # Frame `offset` is the first position of the board. Past the start
+        # of the game that position has lost its last move, so its frame is
+        # kept as recorded.
+        offset = first_ply - index.first_ply
+        kept = len(index.ends)
+        keep = min(kept, offset + len(specs))
+        for i in range(1 if offset else 0, keep - offset):
+            if index.keys[offset + i] != specs[i].key:
+                keep = offset + i
+                break
+
+        new_specs = specs[keep - offset:]
+
+        if keep == kept and not new_specs:
+            if index.revision < revision:
+                index = index._replace(revision=revision)
+                self._write_index(session_id, index)
+            return
+
+        config = self.app.config
+        delay = round(config["REPLAY_FRAME_DURATION"] * 100)
+        final_delay = round(config["REPLAY_FINAL_FRAME_DURATION"] * 100)
+
+        if keep < kept:
+            frames_truncated.inc(kept - keep)
+
+        if keep:
+            # Frames follow the old final frame now, or it is final again
+            f.seek(index.start(keep - 1) + DELAY_OFFSET)
+            f.write(struct.pack("<H", delay if new_specs else final_delay))
+        else:
+            f.seek(0)
+            f.write(gif_header(*self._get_image(new_specs[0]).size))
+
+        ends, keys = index.ends[:keep], index.keys[:keep]
+        f.seek(index.start(keep))
+
+        for i, spec in enumerate(new_specs):
+            frame = gif_frame(
+                self._get_image(spec),
+                final_delay if i == len(new_specs) - 1 else delay,
+            )
+            f.write(frame)
+            ends.append(f.tell())
+            keys.append(spec.key)
+
+        f.write(GIF_TRAILER)
+        f.truncate()
+        f.flush()
+        frames_appended.inc(len(new_specs))
+
+        # Written after the frames, so the sidecar never points past them
+        self._write_index(
+            session_id, ReplayIndex(index.first_ply, ends, keys, revision)
+        )
+
+    def _get_specs(self, board: chess.Board, flipped: bool) -> List[BoardSpec]:
+        """Spec of the frame of every position of the board, oldest first"""
+        config = self.app.config
+        replay = board.root()
+        specs = []
+
+        for move in [None, *board.move_stack]:
+            if move is not None:
+                replay.push(move)
+
+            specs.append(
+                BoardSpec(
+                    board_fen=replay.board_fen(),
+                    lastmove=move.uci() if move else None,
+                    flipped=bool(flipped),
+                    size=config["REPLAY_IMAGE_SIZE"] or None,
+                    style=config["BOARD_IMAGE_STYLE"],
+                )
+            )
+
+        return specs
+
+    @staticmethod
+    def _get_image(spec: BoardSpec) -> Image.Image:
+        return Image.open(io.BytesIO(render_pool.get_image(spec)))
+
+    def _read_index(self, session_id: str) -> Optional[ReplayIndex]:
+        try:
+            with open(self.index_path(session_id)) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+        if not lines:
+            return None
+
+        first_ply, revision = lines[0].split()
+        frames = [line.split() for line in lines[1:]]
+
+        return ReplayIndex(
+            first_ply=int(first_ply),
+            ends=[int(end) for end, _ in frames],
+            keys=[key for _, key in frames],
+            revision=float(revision),
+        )
+
+    def _write_index(self, session_id: str, index: ReplayIndex):
+        lines = [f"{index.first_ply} {index.revision!r}"] + [
+            f"{end} {key}" for end, key in zip(index.ends, index.keys)
+        ]
+        atomic_write(
+            self.index_path(session_id), "\n".join(lines).encode() + b"\n"
+        )
+
+
+replay_recorder = ReplayRecorder()
@@ -0,0 +1,30 @@
+import json
+from typing import Any
+
+from flask import Response, current_app
+
+try:
+    import orjson
+except ImportError:  # Optional, the stdlib encoder is used without it
+    orjson = None
+
+
+def use_orjson() -> bool:
+    return orjson is not None and current_app.config["RESPONSE_JSON_ORJSON"]
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialize a webhook response to compact UTF-8 JSON, with orjson when
+    it is installed and enabled"""
+    if use_orjson():
+        return orjson.dumps(obj)
+
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def json_response(obj: Any, status: int = 200) -> Response:
+    """Response with `obj` as the JSON body. Unlike `jsonify`, keys are not
+    sorted and the body is never indented."""
+    return current_app.response_class(
+        dumps(obj), status=status, mimetype="application/json"
+    )
@@ -1,82 +1,267 @@
+import logging
 import os
+import re
+from typing import Optional
 
 from flask import current_app as app
-from flask import Blueprint, make_response, jsonify, request, send_file
-from werkzeug.exceptions import BadRequest, NotFound
-
-from chess_server.main import (
-    welcome,
-    choose_color,
-    two_squares,
-    castle,
-    resign,
-    piece_and_square,
-    show_board,
-    simply_san,
-    undo,
+from flask import (
+    Blueprint,
+    Response,
+    make_response,
+    request,
+    send_file,
 )
+from werkzeug.exceptions import NotFound, Unauthorized
 
+from chess_server import main  # noqa: F401  Registers the intent handlers
+from chess_server.intents import dispatch
+from chess_server.metrics import metrics_dir
+from chess_server.profiling import profiler
+from chess_server.render import IMAGE_FORMATS, BoardSpec, render_cache
+from chess_server.renderpool import render_pool
+from chess_server.responses import json_response
+from chess_server.replay import replay_recorder
+from chess_server.utils import decode_board_image_token, get_game_board_spec
+
+
+logger = logging.getLogger(__name__)
 
 webhook_bp = Blueprint("webhook_bp", __name__)
 
-log = app.logger
+IMAGE_KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+IMAGE_MIMETYPES = {ext: mimetype for mimetype, ext in IMAGE_FORMATS.values()}
 
 
 @webhook_bp.route("/webhook", methods=["POST"])
 def webhook():
 
     req = request.get_json()
+    action = req["queryResult"].get("action")
 
-    print(f"Got POST request at /webhook:\n{str(req)}")
+    logger.info(
+        "Webhook request",
+        extra={
+            "action": action,
+            "session": req.get("session"),
+            "payload": req,
+        },
+    )
 
-    action = req["queryResult"].get("action")
+    res = dispatch(action, req)
 
-    if action == "welcome":
-        res = welcome(req)
+    logger.info("Webhook response", extra={"action": action, "payload": res})
 
-    elif action == "choose_color":
-        res = choose_color(req)
+    return json_response(res)
 
-    elif action == "two_squares":
-        res = two_squares(req)
 
-    elif action == "castle":
-        res = castle(req)
+@webhook_bp.route(
+    "/webhook/images/boards/<session_id>/<move_number>", methods=["GET"]
+)
+def png_image(session_id, move_number):
+    """Current board of a game, linked by cards of older versions. It is
+    served by `BoardSpec.key` like board_image, in the format of the
+    default variant.
 
-    elif action == "resign":
-        res = resign(req)
+    Note: Move number is added in URL to prevent use of outdated cached
+    images on the client's side"""
 
-    elif action == "simply_san":
-        res = simply_san(req)
+    spec = get_game_board_spec(session_id)
+    if spec is None:
+        return NotFound()
 
-    elif action == "piece_and_square":
-        res = piece_and_square(req)
+    # Undo can bring back a move number, so clients must revalidate
+    return get_board_image_response(
+        spec.key, spec.extension, spec, immutable=False
+    )
 
-    elif action == "show_board":
-        res = show_board(req)
 
-    elif action == "undo":
-        res = undo(req)
+@webhook_bp.route("/webhook/images/boards/<key>.<ext>", methods=["GET"])
+def board_image(key, ext):
+    """Board image by the content hash of the position, see `BoardSpec.key`.
+    The URL changes whenever the image would, so it is cached for good. Its
+    position argument, a token like for `position_image`, is rendered if
+    the image is not in the render cache."""
 
-    else:
-        log.error(f"Bad request:\n{str(req)}")
-        raise BadRequest(f"Unknown intent action: {action}")
+    if not IMAGE_KEY_RE.match(key) or ext not in IMAGE_MIMETYPES:
+        raise NotFound()
 
-    print(f"\nResponse:\n{res}\n")
+    spec = decode_board_image_token(request.args.get("position", ""))
 
-    return make_response(jsonify(res))
+    return get_board_image_response(key, ext, spec)
 
 
-@webhook_bp.route(
-    "/webhook/images/boards/<session_id>/<move_number>", methods=["GET"]
-)
-def png_image(session_id, move_number):
-    """Note: Move number is added in URL to prevent use of outdated cached
-    images on the client's side"""
+@webhook_bp.route("/webhook/images/positions/<token>", methods=["GET"])
+def position_image(token):
+    """Render the board signed into the token, or serve it from the render
+    cache if the position has been rendered before"""
+
+    spec = decode_board_image_token(token)
+
+    if spec is None:
+        raise NotFound()
+
+    if request.if_none_match.contains_weak(spec.key):
+        return get_image_response(spec.key, spec.mimetype, status=304)
+
+    image = render_pool.get_image(spec)
+
+    return get_image_response(spec.key, spec.mimetype, image=image)
+
+
+@webhook_bp.route("/webhook/images/replays/<session_id>.gif", methods=["GET"])
+def replay_image(session_id):
+    """Animated replay of a game up to its latest ply"""
+
+    image = replay_recorder.read(session_id)
+
+    if image is None:
+        raise NotFound()
+
+    # The replay grows while the game is played, so clients must revalidate
+    response = make_response(image, 200, {"Content-Type": "image/gif"})
+    response.cache_control.max_age = 0
+    response.add_etag()
+
+    return response.make_conditional(request)
+
+
+@webhook_bp.route("/metrics", methods=["GET"])
+def metrics():
+    """Metrics of all workers in the Prometheus text format"""
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        raise Unauthorized()
+
+    return Response(
+        metrics_dir.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
 
-    img_path = os.path.join(app.config["IMG_DIR"], f"{session_id}.png")
 
-    if os.path.exists(img_path):
-        return send_file(img_path, mimetype="image/png", cache_timeout=0)
+def check_admin_token():
+    """Admin endpoints need the ADMIN_TOKEN as a bearer token, and do not
+    exist without one"""
+    token = app.config["ADMIN_TOKEN"]
+    if not token:
+        raise NotFound()
+
+    if request.headers.get("Authorization") != f"Bearer {token}":
+        raise Unauthorized()
+
+
+@webhook_bp.route("/admin/profiles", methods=["GET"])
+def list_profiles():
+    check_admin_token()
+    return json_response({"profiles": profiler.store.list()})
+
+
+@webhook_bp.route("/admin/profiles/<name>", methods=["GET"])
+def get_profile(name):
+    check_admin_token()
+
+    path = profiler.store.get_path(name)
+    if path is None:
+        raise NotFound()
+
+    return send_file(
+        path,
+        mimetype="application/octet-stream",
+        as_attachment=True,
+        attachment_filename=name,
+    )
+
+
+def is_offloaded() -> bool:
+    """Whether the web server in front sends image files for us"""
+    return bool(
+        app.config["USE_X_SENDFILE"]
+        or app.config["IMAGE_ACCEL_REDIRECT_PREFIX"]
+    )
+
+
+def get_image_response(
+    key: str,
+    mimetype: str,
+    image: Optional[bytes] = None,
+    path: Optional[str] = None,
+    status: int = 200,
+    immutable: bool = True,
+) -> Response:
+    """Response for a board image with `key` as its strong ETag, cached for
+    good unless it is not immutable. The body is either the image, or the
+    file at `path` handed off to the web server."""
+
+    prefix = app.config["IMAGE_ACCEL_REDIRECT_PREFIX"]
+
+    if path is not None and prefix:
+        relpath = os.path.relpath(path, render_cache.disk_dir)
+        response = make_response("", status)
+        response.headers["X-Accel-Redirect"] = (
+            f"{prefix.rstrip('/')}/{relpath}"
+        )
+    elif path is not None:
+        # Sent as X-Sendfile since USE_X_SENDFILE is on
+        response = send_file(path)
     else:
-        return NotFound()
+        response = make_response(image or b"", status)
+
+    response.content_type = mimetype
+    response.set_etag(key)
+    response.headers["Cache-Control"] = (
+        f"public, max-age={app.config['IMAGE_MAX_AGE']}, immutable"
+        if immutable
+        else "no-cache"
+    )
+
+    return response
+
+
+def get_board_image_response(
+    key: str,
+    ext: str,
+    spec: Optional[BoardSpec] = None,
+    immutable: bool = True,
+) -> Response:
+    """Response with the board image of `BoardSpec.key` key, from the render
+    cache or a pending render, else rendered from spec if it has that key"""
+    mimetype = IMAGE_MIMETYPES[ext]
+
+    if request.if_none_match.contains_weak(key):
+        return get_image_response(
+            key, mimetype, status=304, immutable=immutable
+        )
+
+    path = render_cache.disk_path(key, ext)
+    if is_offloaded() and os.path.exists(path):
+        return get_image_response(
+            key, mimetype, path=path, immutable=immutable
+        )
+
+    image = render_cache.lookup_key(key, ext)
+
+    if image is None:
+        pending = render_pool.get_pending_by_spec_key(key)
+
+        if pending is not None:
+            if not pending.wait(app.config["RENDER_WAIT_TIMEOUT"]):
+                return get_placeholder_response(pending.spec.size)
+
+            image = render_cache.lookup_key(key, ext)
+
+    if image is None:
+        # Rendered by another worker, evicted, or the render failed, so
+        # render the position the URL was handed out with
+        if spec is None or spec.key != key:
+            raise NotFound()
+
+        image = render_pool.get_image(spec)
+
+    return get_image_response(key, mimetype, image=image, immutable=immutable)
+
+
+def get_placeholder_response(size: Optional[int] = None) -> Response:
+    return make_response(
+        render_pool.get_placeholder(size),
+        200,
+        {"Content-Type": "image/png", "Cache-Control": "no-store"},
+    )
@@ -0,0 +1,431 @@
+import hashlib
+import itertools
+from abc import ABC, abstractmethod
+import os
+import posixpath
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+SHARD_RE = re.compile(r"^[0-9a-f]{2}$")
+
+# Only files with these extensions are migrated and swept, the reaper lock
+# and anything else kept next to the images is left alone
+IMAGE_EXTENSIONS = (".png", ".webp")
+
+# Prefix of the rendered boards kept in shared stores
+BOARDS_PREFIX = "boards"
+
+
+def shard_path(root: str, name: str, digest: Optional[str] = None) -> str:
+    """Path of a file in a two level layout like <root>/3f/a2/<name>.
+
+    The directories are the first four hex digits of `digest`, the SHA-1 of
+    the name by default, which keeps each of them to a few hundred entries
+    even with millions of files.
+    """
+    if digest is None:
+        digest = hashlib.sha1(name.encode()).hexdigest()
+
+    return os.path.join(root, digest[:2], digest[2:4], name)
+
+
+def image_path(img_dir: str, imgkey: str, ext: str) -> str:
+    """Location of the image of e.g. a session. All formats of the same
+    image share a directory."""
+    digest = hashlib.sha1(imgkey.encode()).hexdigest()
+    return shard_path(img_dir, f"{imgkey}.{ext}", digest)
+
+
+def atomic_write(path: str, data: bytes, fsync: bool = False):
+    """Write a file so that readers see either the old or the new content,
+    never a partial one. The data goes to a temporary file in the same
+    directory which is then renamed over `path`. With fsync the data is on
+    disk before it becomes visible, which network filesystems need for
+    other nodes to never read a truncated file.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        # mkstemp creates files readable by the owner only
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def unlink(path: str) -> int:
+    """Delete a file if it exists, returns the number of bytes freed"""
+    try:
+        size = os.stat(path).st_size
+        os.unlink(path)
+    except FileNotFoundError:
+        return 0
+
+    return size
+
+
+def iter_files(root: str) -> Iterator[os.DirEntry]:
+    """Files directly in root and in its shard directories"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry
+            elif entry.is_dir() and SHARD_RE.match(entry.name):
+                yield from iter_files(entry.path)
+
+
+def iter_dir_files(root: str) -> Iterator[os.DirEntry]:
+    """Like `iter_files`, nothing if root does not exist"""
+    if os.path.isdir(root):
+        yield from iter_files(root)
+
+
+def migrate_flat_files(root: str, get_path: Callable[[str, str], str]) -> int:
+    """Move files stored directly in root by earlier versions to the path
+    given by `get_path(stem, ext)`. Files already at their new location are
+    newer and are kept. Returns the number of files migrated.
+    """
+    migrated = 0
+
+    with os.scandir(root) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+
+            if not entry.is_file() or ext not in IMAGE_EXTENSIONS:
+                continue
+
+            path = get_path(stem, ext[1:])
+
+            if os.path.exists(path):
+                os.unlink(entry.path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(entry.path, path)
+
+            migrated += 1
+
+    return migrated
+
+
+class BlobStore(ABC):
+    """Where board images are kept, by keys like "<session_id>.png" for the
+    image of a session or "boards/<key>" for a rendered position.
+
+    Images in a shared store can be read by every node of a deployment, so
+    requests for them need not be routed to the node which rendered them.
+    """
+
+    shared = False
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """Contents of a blob, None if it does not exist"""
+
+    @abstractmethod
+    def put(self, key: str, data: bytes, content_type: str = "image/png"):
+        """Write a blob, replacing the one with the same key"""
+
+    @abstractmethod
+    def delete(self, key: str) -> int:
+        """Delete a blob if it exists, returns the number of bytes freed"""
+
+    @abstractmethod
+    def sweep(self, older_than: float, limit: int) -> Tuple[int, int]:
+        """Delete up to `limit` blobs last written before the timestamp
+        `older_than`. Returns the number of blobs and bytes deleted.
+        """
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Path of the blob on this node if it is a file, for send_file"""
+        return None
+
+
+class LocalBlobStore(BlobStore):
+    """Files in a sharded directory on the local disk, see `shard_path`"""
+
+    fsync = False
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        dirname, name = posixpath.split(key)
+        stem = name.split(".", 1)[0]
+        digest = hashlib.sha1(stem.encode()).hexdigest()
+
+        return shard_path(os.path.join(self.root, dirname), name, digest)
+
+    def local_path(self, key: str) -> Optional[str]:
+        for path in self._candidates(key):
+            if os.path.exists(path):
+                return path
+
+        return None
+
+    def get(self, key: str) -> Optional[bytes]:
+        for path in self._candidates(key):
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                continue
+
+        return None
+
+    def put(self, key: str, data: bytes, content_type: str = "image/png"):
+        atomic_write(self.path(key), data, fsync=self.fsync)
+
+    def delete(self, key: str) -> int:
+        return sum(unlink(path) for path in self._candidates(key))
+
+    def sweep(self, older_than: float, limit: int) -> Tuple[int, int]:
+        files = freed = 0
+        boards = os.path.join(self.root, BOARDS_PREFIX)
+        entries = itertools.chain(
+            # Also catches temporary files left behind by interrupted writes
+            (
+                entry
+                for entry in iter_dir_files(self.root)
+                if entry.name.endswith(IMAGE_EXTENSIONS + (".tmp",))
+            ),
+            # Everything kept there is a board
+            iter_dir_files(boards),
+        )
+
+        for entry in entries:
+            if files >= limit:
+                break
+
+            if entry.stat().st_mtime < older_than:
+                freed += unlink(entry.path)
+                files += 1
+
+        return files, freed
+
+    def _candidates(self, key: str):
+        yield self.path(key)
+
+        if "/" not in key:
+            # Saved before images were sharded and not migrated yet
+            yield os.path.join(self.root, key)
+
+
+class SharedDirBlobStore(LocalBlobStore):
+    """Files on a filesystem mounted by every node, e.g. NFS or EFS"""
+
+    shared = True
+    fsync = True
+
+
+class MemoryBlobStore(BlobStore):
+    """Blobs in a dict, for tests and single process development servers"""
+
+    def __init__(self):
+        self.blobs: Dict[str, Tuple[bytes, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        blob = self.blobs.get(key)
+        return blob[0] if blob else None
+
+    def put(self, key: str, data: bytes, content_type: str = "image/png"):
+        with self._lock:
+            self.blobs[key] = (data, time.time())
+
+    def delete(self, key: str) -> int:
+        with self._lock:
+            blob = self.blobs.pop(key, None)
+
+        return len(blob[0]) if blob else 0
+
+    def sweep(self, older_than: float, limit: int) -> Tuple[int, int]:
+        with self._lock:
+            stale = [
+                key
+                for key, (_, mtime) in self.blobs.items()
+                if mtime < older_than
+            ][:limit]
+
+            freed = sum(len(self.blobs.pop(key)[0]) for key in stale)
+
+        return len(stale), freed
+
+
+class S3BlobStore(BlobStore):
+    """Objects in an S3 compatible bucket. The client is created with boto3,
+    from the "s3" extra, unless one is given. `endpoint_url` points it to
+    services other than AWS like MinIO.
+    """
+
+    shared = True
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        client: Any = None,
+        endpoint_url: Optional[str] = None,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self._client = client
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client("s3", endpoint_url=self.endpoint_url)
+
+        return self._client
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self.prefix + key
+            )
+        except Exception as exc:
+            if is_not_found(exc):
+                return None
+            raise
+
+        return response["Body"].read()
+
+    def put(self, key: str, data: bytes, content_type: str = "image/png"):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            Body=data,
+            ContentType=content_type,
+        )
+
+    def delete(self, key: str) -> int:
+        try:
+            head = self.client.head_object(
+                Bucket=self.bucket, Key=self.prefix + key
+            )
+        except Exception as exc:
+            if is_not_found(exc):
+                return 0
+            raise
+
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+        return head["ContentLength"]
+
+    def sweep(self, older_than: float, limit: int) -> Tuple[int, int]:
+        cutoff = datetime.fromtimestamp(older_than, tz=timezone.utc)
+        stale = []
+        kwargs = {"Bucket": self.bucket, "Prefix": self.prefix}
+
+        while len(stale) < limit:
+            page = self.client.list_objects_v2(**kwargs)
+
+            for obj in page.get("Contents", []):
+                if obj["LastModified"] < cutoff:
+                    stale.append(obj)
+
+            if not page.get("IsTruncated"):
+                break
+
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+        stale = stale[:limit]
+
+        keys = [{"Key": obj["Key"]} for obj in stale]
+
+        # Up to 1000 keys can be deleted per request
+        while keys:
+            batch, keys = keys[:1000], keys[1000:]
+            self.client.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": batch}
+            )
+
+        return len(stale), sum(obj["Size"] for obj in stale)
+
+
+def is_not_found(exc: Exception) -> bool:
+    """Whether a boto3 client error is for a missing object"""
+    error = getattr(exc, "response", {}).get("Error", {})
+    return error.get("Code") in ("404", "NoSuchKey", "NotFound")
+
+
+def create_blob_store(config: Dict[str, Any]) -> BlobStore:
+    """Image store selected by IMAGE_STORE"""
+    kind = config["IMAGE_STORE"]
+
+    if kind == "local":
+        return LocalBlobStore(config["IMG_DIR"])
+
+    if kind == "shared":
+        return SharedDirBlobStore(
+            config["IMAGE_STORE_DIR"] or config["IMG_DIR"]
+        )
+
+    if kind == "memory":
+        return MemoryBlobStore()
+
+    if kind == "s3":
+        return S3BlobStore(
+            bucket=config["IMAGE_STORE_BUCKET"],
+            prefix=config["IMAGE_STORE_PREFIX"],
+            endpoint_url=config["IMAGE_STORE_ENDPOINT_URL"],
+        )
+
+    raise ValueError(f"Unknown image store: {kind}")
+
+
+def get_image_store() -> BlobStore:
+    return current_app.extensions["image_store"]
+
+
+def migrate_images() -> int:
+    """Move session images and the render cache to the sharded layout"""
+    from chess_server.render import render_cache
+
+    img_dir = current_app.config["IMG_DIR"]
+    migrated = migrate_flat_files(
+        img_dir, lambda stem, ext: image_path(img_dir, stem, ext)
+    )
+
+    if os.path.isdir(render_cache.disk_dir):
+        migrated += migrate_flat_files(
+            render_cache.disk_dir, render_cache.disk_path
+        )
+
+    return migrated
+
+
+@click.command("migrate-images")
+@with_appcontext
+def migrate_images_command():
+    """Move images from the flat layout to sharded directories."""
+    click.echo(f"Migrated {migrate_images()} images.")
+
+
+def init_app(app):
+    app.extensions["image_store"] = create_blob_store(app.config)
+    app.cli.add_command(migrate_images_command)
@@ -0,0 +1,349 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from flask import g, request
+
+from chess_server.metrics import counter
+
+logger = logging.getLogger(__name__)
+
+traces_exported = counter(
+    "traces_exported_total",
+    "Traces kept by sampling and handed to the exporter, by reason",
+    labelnames=("reason",),
+)
+traces_dropped = counter(
+    "traces_dropped_total",
+    "Traces kept by sampling but dropped because the export queue was full",
+)
+
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+class Span:
+    """A timed operation within a trace"""
+
+    def __init__(
+        self,
+        trace: "Trace",
+        name: str,
+        parent_id: Optional[str],
+        attributes: Dict[str, Any],
+    ):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def make_dict(self) -> Dict[str, Any]:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    """Spans of one request, kept until the request ends and sampling
+    decides whether to export them"""
+
+    def __init__(self, trace_id: str, parent_id: Optional[str] = None):
+        self.trace_id = trace_id
+        # Span of the caller, from its traceparent header
+        self.parent_id = parent_id
+        self.spans: List[Span] = []
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+    def make_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "spans": [span.make_dict() for span in self.spans],
+        }
+
+
+# Span of the block running in this thread, None outside of traced requests
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Time the block as a child of the current span. Does nothing outside
+    of a traced request. Like `Histogram.time`, it can decorate functions.
+    """
+    parent = current_span.get()
+
+    if parent is None:
+        yield None
+        return
+
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    parent.trace.spans.append(child)
+    token = current_span.set(child)
+
+    try:
+        yield child
+    except BaseException as exc:
+        child.error = f"{type(exc).__name__}: {exc}"
+        raise
+    finally:
+        child.end_ns = time.time_ns()
+        current_span.reset(token)
+
+
+class StdoutExporter:
+    """Logs each trace as a JSON record, written by the log thread"""
+
+    def export(self, traces: List[Trace]):
+        for trace in traces:
+            logger.info("Trace", extra={"trace": trace.make_dict()})
+
+
+class OTLPExporter:
+    """Posts traces to an OpenTelemetry collector, as OTLP/HTTP JSON"""
+
+    def __init__(self, endpoint: str, service_name: str, timeout: float = 5):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def export(self, traces: List[Trace]):
+        body = json.dumps(self.encode(traces)).encode()
+        req = urllib.request.Request(
+            self.endpoint,
+            data=body,
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(req, timeout=self.timeout) as response:
+            response.read()
+
+    def encode(self, traces: List[Trace]) -> Dict[str, Any]:
+        spans = [
+            {
+                "traceId": trace.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id or trace.parent_id or "",
+                "name": span.name,
+                # SPAN_KIND_SERVER for the request, INTERNAL for the rest
+                "kind": 2 if span is trace.root else 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": [
+                    {"key": key, "value": {"stringValue": str(value)}}
+                    for key, value in span.attributes.items()
+                ],
+                # STATUS_CODE_ERROR or STATUS_CODE_UNSET
+                "status": (
+                    {"code": 2, "message": span.error}
+                    if span.error
+                    else {"code": 0}
+                ),
+            }
+            for trace in traces
+            for span in trace.spans
+        ]
+        resource = {
+            "attributes": [
+                {
+                    "key": "service.name",
+                    "value": {"stringValue": self.service_name},
+                }
+            ]
+        }
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": resource,
+                    "scopeSpans": [
+                        {"scope": {"name": "chess_server"}, "spans": spans}
+                    ],
+                }
+            ]
+        }
+
+
+class Tracer:
+    """Traces requests with a span per handler, engine search, game read or
+    write and render, under a root span for the request.
+
+    Sampling is done once a request has ended, so that requests slower than
+    TRACING_SLOW_THRESHOLD seconds and failed ones are always kept, along
+    with TRACING_SAMPLE_RATE of the others. Kept traces are exported in
+    batches by a background thread, to stdout as JSON or to an OTLP/HTTP
+    collector at TRACING_OTLP_ENDPOINT. Traces are dropped rather than
+    queued when TRACING_QUEUE_SIZE traces are waiting.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.exporter = None
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def init_app(self, app):
+        self.stop()
+
+        self.app = app
+        app.extensions["tracer"] = self
+
+        if not self.enabled:
+            return
+
+        config = app.config
+        if config["TRACING_EXPORTER"] == "otlp":
+            self.exporter = OTLPExporter(
+                config["TRACING_OTLP_ENDPOINT"],
+                config["TRACING_SERVICE_NAME"],
+            )
+        else:
+            self.exporter = StdoutExporter()
+
+        self._queue = queue.Queue(maxsize=config["TRACING_QUEUE_SIZE"])
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+        app.before_request(self.start_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.end_request)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.app and self.app.config["TRACING_ENABLED"])
+
+    def start_request(self):
+        trace_id, parent_id = parse_traceparent(
+            request.headers.get("traceparent", "")
+        )
+        trace = Trace(trace_id or os.urandom(16).hex(), parent_id)
+        root = Span(
+            trace,
+            f"{request.method} {request.url_rule or request.path}",
+            None,
+            {"http.method": request.method, "http.target": request.path},
+        )
+        trace.spans.append(root)
+
+        g.trace_token = current_span.set(root)
+
+    def after_request(self, response):
+        root = current_span.get()
+
+        if root is not None:
+            root.attributes["http.status_code"] = response.status_code
+            if response.status_code >= 500:
+                root.error = f"HTTP {response.status_code}"
+            response.headers["X-Trace-Id"] = root.trace.trace_id
+
+        self.end_request()
+
+        return response
+
+    def end_request(self, exc=None):
+        """End the trace of the request, once it has a response or, on an
+        unhandled error, at teardown"""
+        token = g.pop("trace_token", None)
+        if token is None:
+            return
+
+        root = current_span.get()
+        current_span.reset(token)
+
+        root.end_ns = time.time_ns()
+        if exc is not None:
+            root.error = f"{type(exc).__name__}: {exc}"
+
+        reason = self.sample(root.trace)
+        if reason is None:
+            return
+
+        try:
+            self._queue.put_nowait(root.trace)
+        except queue.Full:
+            traces_dropped.inc()
+            return
+
+        traces_exported.inc(reason=reason)
+
+    def sample(self, trace: Trace) -> Optional[str]:
+        """Why a finished trace is kept, or None to drop it"""
+        config = self.app.config
+
+        if any(span.error for span in trace.spans):
+            return "error"
+
+        if trace.root.duration >= config["TRACING_SLOW_THRESHOLD"]:
+            return "slow"
+
+        if random.random() < config["TRACING_SAMPLE_RATE"]:
+            return "sampled"
+
+        return None
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 64:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            batch = [trace for trace in batch if trace is not None]
+
+            if batch:
+                try:
+                    self.exporter.export(batch)
+                except Exception as exc:
+                    logger.warning(f"Unable to export traces: {exc}")
+
+            if stop:
+                return
+
+    def stop(self):
+        """Export the traces still queued and stop the export thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def parse_traceparent(header: str):
+    """Trace and parent span ids of a W3C traceparent header"""
+    match = TRACEPARENT_RE.match(header.strip().lower())
+
+    if match is None:
+        return None, None
+
+    return match.group(1), match.group(2)
+
+
+tracer = Tracer()
@@ -1,16 +1,27 @@
-import os
+import functools
+import math
 import random
 import re
+from datetime import datetime, timedelta
 from typing import Any, Dict, List, NamedTuple, Optional, Union
 
 import chess
-import chess.svg
-from cairosvg import svg2png
-from flask import current_app, url_for
+from flask import current_app, g, url_for
+from itsdangerous import (
+    BadSignature,
+    URLSafeSerializer,
+    URLSafeTimedSerializer,
+)
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
 from chess_server import db
+from chess_server.metrics import gauge, histogram
 from chess_server.models import UserModel
+from chess_server.render import IMAGE_FORMATS, BoardSpec, render_cache
+from chess_server.renderpool import render_pool
+from chess_server.replay import replay_recorder
+from chess_server.tracing import span
 
 pieces = {
     "K": "King",
@@ -29,6 +40,33 @@ pieces_symbols = {
     "pawn": "",
 }
 
+GAME_CONTEXT_NAME = "wizardchess-game"
+
+OPTION_INTENT = "actions.intent.OPTION"
+OPTION_VALUE_SPEC = "type.googleapis.com/google.actions.v2.OptionValueSpec"
+
+user_operation_duration = histogram(
+    "db_operation_duration_seconds",
+    "Time taken to read or write a game, by operation",
+    labelnames=("operation",),
+)
+
+
+def user_operation(name: str):
+    """Time and trace a read or write of a game"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with user_operation_duration.time(operation=name):
+                with span(f"db.{name}"):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 PROMPT_PHRASES = [
     "Your turn.",
     "Your move.",
@@ -51,6 +89,11 @@ class User(NamedTuple):
     color: chess.Color
 
 
+class ConcurrentUpdateError(Exception):
+    """Raised when a game was modified by another request after the current
+    request had read it"""
+
+
 class Image(NamedTuple):
     url: str
     accessibilityText: str
@@ -72,6 +115,16 @@ class Image(NamedTuple):
         return image
 
 
+class Button(NamedTuple):
+    """Button of a card which opens a URL"""
+
+    title: str
+    url: str
+
+    def make_dict(self) -> Dict[str, Any]:
+        return {"title": self.title, "openUrlAction": {"url": self.url}}
+
+
 class BasicCard(NamedTuple):
     """Basic card for response.
     Note: At least one of image and formattedText is required.
@@ -84,6 +137,7 @@ class BasicCard(NamedTuple):
     # All optional:
     title: Optional[str] = None
     subtitle: Optional[str] = None
+    buttons: Optional[List[Button]] = None
 
     def make_dict(self) -> Dict[str, Any]:
         card = {}
@@ -100,6 +154,9 @@ class BasicCard(NamedTuple):
         if self.subtitle is not None:
             card["subtitle"] = self.subtitle
 
+        if self.buttons:
+            card["buttons"] = [button.make_dict() for button in self.buttons]
+
         return card
 
 
@@ -131,12 +188,8 @@ def get_response_template_for_google(
 
     if options:
         template["payload"]["google"]["systemIntent"] = {
-            "intent": "actions.intent.OPTION",
-            "data": {
-                "@type": "type.googleapis.com/"
-                "google.actions.v2.OptionValueSpec",
-                "listSelect": {"items": []},
-            },
+            "intent": OPTION_INTENT,
+            "data": {"@type": OPTION_VALUE_SPEC, "listSelect": {"items": []}},
         }
 
     return template
@@ -266,51 +319,215 @@ def get_response_for_google(
     conversation
     """
 
-    # Get template for response
-    template = get_response_template_for_google(options=bool(options))
-
-    # Modify the dict as per the arguments
-    template["payload"]["google"]["expectUserResponse"] = expectUserResponse
-    template["payload"]["google"]["richResponse"]["items"][0][
-        "simpleResponse"
-    ]["textToSpeech"] = textToSpeech
-
+    # Built in one pass, in the shape of the response, rather than by
+    # filling in a copy of the template through its key paths
+    simple_response = {"textToSpeech": textToSpeech}
     if displayText:
-        template["payload"]["google"]["richResponse"]["items"][0][
-            "simpleResponse"
-        ]["displayText"] = displayText
+        simple_response["displayText"] = displayText
 
-    # If options List is given
+    items = [{"simpleResponse": simple_response}]
+    if basicCard:
+        items.append({"basicCard": basicCard.make_dict()})
+
+    google = {
+        "expectUserResponse": expectUserResponse,
+        "richResponse": {"items": items},
+    }
     if options:
-        template["payload"]["google"]["systemIntent"]["data"]["listSelect"][
-            "items"
-        ] = options
+        google["systemIntent"] = {
+            "intent": OPTION_INTENT,
+            "data": {
+                "@type": OPTION_VALUE_SPEC,
+                "listSelect": {"items": options},
+            },
+        }
 
-    # If basicCard is given
-    if basicCard:
-        card = basicCard.make_dict()
-        template["payload"]["google"]["richResponse"]["items"].append(
-            {"basicCard": card}
+    return {"payload": {"google": google}}
+
+
+def is_stateless() -> bool:
+    """Whether game state is carried in output contexts instead of the db"""
+    return current_app.config.get("STATELESS_MODE", False)
+
+
+def get_game_state_serializer() -> URLSafeTimedSerializer:
+    return URLSafeTimedSerializer(
+        current_app.config["SECRET_KEY"], salt="game-state"
+    )
+
+
+def encode_game_state(user: User) -> str:
+    """Serialize and sign the compact state of a game
+
+    Only the last STATELESS_HISTORY_PLIES moves are kept along with the FEN
+    of the position before them, which is enough for undo and for the
+    repetition checks of a typical game.
+    """
+    board = user.board.copy()
+    limit = current_app.config["STATELESS_HISTORY_PLIES"]
+
+    moves = []
+    while board.move_stack and len(moves) < limit:
+        moves.append(board.pop().uci())
+    moves.reverse()
+
+    state = {"fen": board.fen(), "moves": moves, "color": bool(user.color)}
+
+    return get_game_state_serializer().dumps(state)
+
+
+def decode_game_state(token: str) -> Optional[User]:
+    """Verify and load a game state encoded with `encode_game_state`.
+    Returns None if the token is tampered, malformed or older than
+    REAPER_SESSION_TTL, after which a game in the database is reaped too.
+    Every turn signs the state again, so only idle games expire.
+    """
+    try:
+        state = get_game_state_serializer().loads(
+            token, max_age=current_app.config["REAPER_SESSION_TTL"]
         )
+        board = chess.Board(state["fen"])
+        for uci in state["moves"]:
+            board.push_uci(uci)
 
-    # Return DICT
-    return template
+    except (BadSignature, KeyError, TypeError, ValueError) as err:
+        current_app.logger.error(f"Discarding invalid game state: {err}")
+        return None
+
+    color = chess.WHITE if state["color"] else chess.BLACK
+
+    return User(board=board, color=color)
+
+
+def get_game_states() -> Dict[str, Optional[User]]:
+    """Game states of the current request, keyed by session id.
+    A value of None marks a game which has ended during this request.
+    """
+    if "game_states" not in g:
+        g.game_states = {}
+
+    return g.game_states
+
+
+def load_game_states_from_req(req: Dict[str, Any]):
+    """Read the game state carried in the output contexts of a request"""
+    states = get_game_states()
+    suffix = f"/contexts/{GAME_CONTEXT_NAME}"
+
+    for context in req["queryResult"].get("outputContexts", []):
+        if not context.get("name", "").endswith(suffix):
+            continue
+
+        token = context.get("parameters", {}).get("state")
+        if not token:
+            continue
+
+        user = decode_game_state(token)
+        if user is not None:
+            # Name is of the form <session>/contexts/<context name>
+            states[context["name"].split("/")[-3]] = user
+
+
+def get_output_contexts_for_game_states(
+    req: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """Build the output contexts carrying the game state to the next turn.
+    Ended games get a lifespan of 0 so that Dialogflow drops the context.
+    """
+    prefix = "/".join(req["session"].split("/")[:-1])
+    lifespan = current_app.config["GAME_CONTEXT_LIFESPAN"]
+
+    contexts = []
+    for session_id, user in get_game_states().items():
+        context = {
+            "name": f"{prefix}/{session_id}/contexts/{GAME_CONTEXT_NAME}",
+            "lifespanCount": lifespan if user else 0,
+        }
+        if user:
+            context["parameters"] = {"state": encode_game_state(user)}
+
+        contexts.append(context)
+
+    return contexts
+
+
+def get_user_versions() -> Dict[str, int]:
+    """Version of each game row as seen by the current request"""
+    if "user_versions" not in g:
+        g.user_versions = {}
+
+    return g.user_versions
+
+
+def has_written_users() -> bool:
+    """Whether the current request has committed changes to any game"""
+    return g.get("user_writes", 0) > 0
+
+
+def check_user_version(session_id: str, res: UserModel):
+    """Compare the version of a row against the one first read by this
+    request and raise ConcurrentUpdateError if someone else has changed it"""
+    expected = get_user_versions().setdefault(session_id, res.version)
+
+    if res.version != expected:
+        current_app.logger.warning(
+            f"Entry with key {session_id} changed from version {expected} "
+            f"to {res.version} during the request."
+        )
+        raise ConcurrentUpdateError(
+            f"Entry with key {session_id} was modified concurrently."
+        )
+
+
+def commit_user(session_id: str):
+    """Commit changes to a game row. The UPDATE or DELETE only matches the
+    version which was read, so a concurrent write makes it fail instead of
+    being silently overwritten."""
+    try:
+        with span("db.commit"):
+            db.session.commit()
+
+    except StaleDataError:
+        db.session.rollback()
+        current_app.logger.warning(
+            f"Compare-and-swap failed for entry with key {session_id}."
+        )
+        raise ConcurrentUpdateError(
+            f"Entry with key {session_id} was modified concurrently."
+        )
+
+    g.user_writes = g.get("user_writes", 0) + 1
 
 
+@user_operation("exists_in_db")
 def exists_in_db(session_id: str) -> bool:
     """Returns boolean indicating whether the entry exists in db"""
 
+    if is_stateless():
+        return get_game_states().get(session_id) is not None
+
     q = UserModel.query.filter_by(session_id=session_id)
     return not q.count() == 0
 
 
+@user_operation("create_user")
 def create_user(session_id: str, board: chess.Board, color: chess.Color):
     """Creates a new entry in table with given data"""
 
+    if is_stateless():
+        if exists_in_db(session_id):
+            raise Exception(f"Entry with key {session_id} already exists.")
+
+        get_game_states()[session_id] = User(board=board.copy(), color=color)
+        record_replay(session_id, board, color)
+        return
+
     try:
         new_user = UserModel(session_id=session_id, board=board, color=color)
         db.session.add(new_user)
-        db.session.commit()
+        commit_user(session_id)
+        get_user_versions()[session_id] = 1
+        record_replay(session_id, board, color)
 
     except IntegrityError as err:
         # TODO: Handle this better
@@ -322,9 +539,19 @@ def create_user(session_id: str, board: chess.Board, color: chess.Color):
         raise Exception(f"Entry with key {session_id} already exists.")
 
 
+@user_operation("get_user")
 def get_user(session_id: str) -> User:
     """Gets the required user from database when its session id is given"""
 
+    if is_stateless():
+        user = get_game_states().get(session_id)
+        if user is None:
+            current_app.logger.error("No game state found for session.")
+            raise Exception("Entry not found.")
+
+        # Hand out a copy, like a fresh row would be
+        return User(board=user.board.copy(), color=user.color)
+
     # Get object by pk
     res = UserModel.query.get(session_id)
 
@@ -335,15 +562,24 @@ def get_user(session_id: str) -> User:
         current_app.logger.error("No result found for provided query.")
         raise Exception("Entry not found.")
 
+    check_user_version(session_id, res)
+
     board = res.board
     color = chess.WHITE if res.color else chess.BLACK
 
     return User(board=board, color=color)
 
 
+@user_operation("update_user")
 def update_user(session_id: str, board: chess.Board):
     """Updates an existing entry for user with session id session_id"""
 
+    if is_stateless():
+        color = get_user(session_id).color
+        get_game_states()[session_id] = User(board=board.copy(), color=color)
+        record_replay(session_id, board, color)
+        return
+
     res = UserModel.query.get(session_id)
 
     if res is None:
@@ -351,13 +587,25 @@ def update_user(session_id: str, board: chess.Board):
         current_app.logger.error("No result found for provided query.")
         raise Exception("Entry not found.")
 
+    check_user_version(session_id, res)
+
     res.board = board
-    db.session.commit()
+    commit_user(session_id)
+    get_user_versions()[session_id] += 1
+    record_replay(
+        session_id, board, chess.WHITE if res.color else chess.BLACK
+    )
 
 
+@user_operation("delete_user")
 def delete_user(session_id: str):
     """Deletes a user entry from db"""
 
+    if is_stateless():
+        get_user(session_id)  # Raises if the game does not exist
+        get_game_states()[session_id] = None
+        return
+
     res = UserModel.query.get(session_id)
 
     if res is None:
@@ -365,8 +613,48 @@ def delete_user(session_id: str):
         current_app.logger.error("No result found for provided query.")
         raise Exception("Entry not found.")
 
+    check_user_version(session_id, res)
+
     db.session.delete(res)
-    db.session.commit()
+    commit_user(session_id)
+    get_user_versions().pop(session_id)
+
+
+def count_active_sessions() -> float:
+    """Games played in the last METRICS_ACTIVE_SESSION_WINDOW seconds. Not
+    known in STATELESS_MODE, where games are only kept by the clients."""
+    if is_stateless():
+        return math.nan
+
+    window = timedelta(
+        seconds=current_app.config["METRICS_ACTIVE_SESSION_WINDOW"]
+    )
+    return UserModel.query.filter(
+        UserModel.last_active_at >= datetime.utcnow() - window
+    ).count()
+
+
+active_sessions = gauge(
+    "active_sessions",
+    "Games played recently, across all workers",
+    collect=count_active_sessions,
+)
+
+
+def record_replay(session_id: str, board: chess.Board, color: chess.Color):
+    """Bring the replay of a game up to date after its board was saved,
+    usually in the background. A failure is logged rather than failing the
+    turn, which is already saved.
+    """
+    if not replay_recorder.enabled:
+        return
+
+    try:
+        replay_recorder.submit(session_id, board, flipped=color is chess.BLACK)
+    except Exception as exc:
+        current_app.logger.error(
+            f"Unable to record replay. Failed with error:\n{str(exc)}"
+        )
 
 
 def get_piece_symbol(piece: str, upper: Optional[bool] = False) -> str:
@@ -540,31 +828,158 @@ def get_san_description(board: chess.Board, san: str) -> str:
     return status
 
 
-def save_board_as_png(
-    imgkey: str, board: chess.Board, flipped: Optional[bool] = False
+class ImageVariant(NamedTuple):
+    """Size (a key of IMAGE_SIZES) and format (a key of IMAGE_FORMATS) of
+    board images"""
+
+    size: str = "medium"
+    format: str = "png"
+
+
+def negotiate_image_variant(req: Dict[str, Any]) -> ImageVariant:
+    """Pick the variant of board images for the surface of a request.
+
+    Phones, which are the surfaces able to open links, get small images in
+    IMAGE_FORMAT_SMALL as they are often on cellular connections. Other
+    devices with a screen, like smart displays, get large images.
+    """
+    payload = req.get("originalDetectIntentRequest", {}).get("payload", {})
+    capabilities = {
+        capability.get("name")
+        for capability in payload.get("surface", {}).get("capabilities", [])
+    }
+    config = current_app.config
+
+    if "actions.capability.WEB_BROWSER" in capabilities:
+        return ImageVariant("small", config["IMAGE_FORMAT_SMALL"])
+
+    if "actions.capability.SCREEN_OUTPUT" in capabilities:
+        return ImageVariant("large", config["IMAGE_FORMAT"])
+
+    return ImageVariant("medium", config["IMAGE_FORMAT"])
+
+
+def load_image_variant_from_req(req: Dict[str, Any]):
+    """Use the variant negotiated for a request for its board images"""
+    g.image_variant = negotiate_image_variant(req)
+
+
+def get_image_variant() -> ImageVariant:
+    """Variant of board images for the current request"""
+    if "image_variant" not in g:
+        return ImageVariant("medium", current_app.config["IMAGE_FORMAT"])
+
+    return g.image_variant
+
+
+def get_board_spec(
+    board: chess.BaseBoard,
+    lastmove: Optional[str] = None,
+    flipped: Optional[bool] = False,
+    variant: Optional[ImageVariant] = None,
+) -> BoardSpec:
+    """Spec of a board image with the configured style, in the variant of
+    the current request unless one is given"""
+    variant = variant or get_image_variant()
+
+    return BoardSpec(
+        board_fen=board.board_fen(),
+        lastmove=lastmove,
+        flipped=bool(flipped),
+        size=current_app.config["IMAGE_SIZES"][variant.size],
+        style=current_app.config["BOARD_IMAGE_STYLE"],
+        format=variant.format,
+    )
+
+
+def get_game_board_spec(
+    session_id: str, variant: Optional[ImageVariant] = None
+) -> Optional[BoardSpec]:
+    """Spec of the image of the current board of a game, None if there is
+    no such game"""
+    try:
+        user = get_user(session_id)
+    except Exception:
+        return None
+
+    board = user.board
+    lastmove = board.peek().uci() if board.move_stack else None
+
+    return get_board_spec(
+        board,
+        lastmove=lastmove,
+        flipped=user.color is chess.BLACK,
+        variant=variant,
+    )
+
+
+def get_board_image_serializer() -> URLSafeSerializer:
+    return URLSafeSerializer(
+        current_app.config["SECRET_KEY"], salt="board-image"
+    )
+
+
+def encode_board_image_token(
+    spec: BoardSpec, variant: Optional[ImageVariant] = None
 ) -> str:
-    """Render the PNG of a board, save it on disk and return the location.
-    imgkey argument should be the identifier for the image like session id.
+    """Signed token with the position and variant of a board image, for its
+    URL. Pixel size and style are left out as they are read from config
+    when the image is rendered.
     """
-    img_dir = current_app.config["IMG_DIR"]
+    variant = variant or get_image_variant()
+
+    return get_board_image_serializer().dumps(
+        [spec.board_fen, spec.lastmove, spec.flipped, *variant]
+    )
 
+
+def decode_board_image_token(token: str) -> Optional[BoardSpec]:
+    """Inverse of `encode_board_image_token`, None if the token is invalid"""
     try:
-        # Get last move on the board
-        lastmove = board.peek()
-    except IndexError:
-        # This is the first move
-        lastmove = None
+        board_fen, lastmove, flipped, size, format = (
+            get_board_image_serializer().loads(token)
+        )
+        board = chess.BaseBoard(board_fen)
 
-    # Render SVG
-    svg = str(chess.svg.board(board, lastmove=lastmove, flipped=flipped))
+        variant = ImageVariant(size, format)
+        if (
+            variant.size not in current_app.config["IMAGE_SIZES"]
+            or variant.format not in IMAGE_FORMATS
+        ):
+            return None
 
-    # Path to png
-    pngfile = os.path.join(img_dir, f"{imgkey}.png")
+    except (BadSignature, TypeError, ValueError):
+        return None
+
+    return get_board_spec(
+        board, lastmove=lastmove, flipped=flipped, variant=variant
+    )
+
+
+def save_board_as_png(
+    imgkey: str, board: chess.Board, flipped: Optional[bool] = False
+) -> str:
+    """Render the image of a board into the render cache and return its
+    `BoardSpec.key`, which board_image serves it by. imgkey argument should
+    be the identifier for the image like session id. The image is in the
+    variant of the current request, so it is a PNG unless the variant is
+    WebP.
+
+    Identical positions are rendered once and then served from the render
+    cache. With RENDER_WORKERS the image is rendered in the background and
+    the key is returned right away.
+    """
+    lastmove = board.peek().uci() if board.move_stack else None
+    spec = get_board_spec(board, lastmove=lastmove, flipped=flipped)
 
     # Perform conversion
     try:
-        svg2png(bytestring=svg, write_to=pngfile)
-        return pngfile
+        if render_pool.enabled:
+            render_pool.submit(imgkey, spec)
+        else:
+            render_cache.get_image(spec)
+
+        return spec.key
     except Exception as exc:
         # Log error and raise
         current_app.logger.error(
@@ -573,26 +988,58 @@ def save_board_as_png(
         raise
 
 
-def save_board_as_png_and_get_image_card(session_id: str):
+def save_board_as_png_and_get_image_card(
+    session_id: str, replay: Optional[bool] = False
+):
+    """Get a card with the image of the current board of a user.
+
+    With LAZY_BOARD_IMAGES the position is signed into the image URL and
+    only rendered when the client fetches it. Otherwise it is rendered and
+    saved to disk right away, and linked by its content hash. With replay,
+    for the end of a game, the card links the replay of the game if
+    REPLAY_ENABLED.
+    """
     user = get_user(session_id)
     board = user.board
     flipped = user.color is chess.BLACK
     move_number = board.fullmove_number
 
-    # Saves board to disk
-    save_board_as_png(imgkey=session_id, board=board, flipped=flipped)
+    lastmove = board.peek().uci() if board.move_stack else None
+    spec = get_board_spec(board, lastmove=lastmove, flipped=flipped)
+
+    if current_app.config["LAZY_BOARD_IMAGES"]:
+        url = url_for(
+            "webhook_bp.position_image",
+            token=encode_board_image_token(spec),
+            _external=True,
+        )
+
+    else:
+        # Saves board to disk
+        save_board_as_png(imgkey=session_id, board=board, flipped=flipped)
+
+        # The position lets any worker render the image if it has not been
+        url = url_for(
+            "webhook_bp.board_image",
+            key=spec.key,
+            ext=spec.extension,
+            position=encode_board_image_token(spec),
+            _external=True,
+        )
 
-    url = url_for(
-        "webhook_bp.png_image",
-        session_id=session_id,
-        move_number=move_number,
-        _external=True,
-    )
     alt = str(board)
 
     image = Image(url=url, accessibilityText=alt)
     formattedText = f"**Current move number: {move_number}**"
-    card = BasicCard(image=image, formattedText=formattedText)
+
+    buttons = None
+    if replay and replay_recorder.enabled:
+        url = url_for(
+            "webhook_bp.replay_image", session_id=session_id, _external=True
+        )
+        buttons = [Button(title="Watch the replay", url=url)]
+
+    card = BasicCard(image=image, formattedText=formattedText, buttons=buttons)
 
     return card
 
@@ -5,6 +5,16 @@ basedir = path.abspath(path.dirname(__file__))
 load_dotenv(path.join(basedir, ".env"))
 
 
+def env_flag(name: str, default: bool = False) -> bool:
+    """Read a boolean flag like `STATELESS_MODE=true` from the environment"""
+    value = environ.get(name)
+
+    if value is None:
+        return default
+
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 class Config:
     """Base config"""
 
@@ -13,6 +23,203 @@ class Config:
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Carry game state in a signed Dialogflow output context instead of the
+    # database. SECRET_KEY must be shared by all nodes for this to work.
+    # States expire after REAPER_SESSION_TTL seconds without a turn.
+    STATELESS_MODE = env_flag("STATELESS_MODE")
+    STATELESS_HISTORY_PLIES = int(environ.get("STATELESS_HISTORY_PLIES", 20))
+    GAME_CONTEXT_LIFESPAN = int(environ.get("GAME_CONTEXT_LIFESPAN", 50))
+
+    # Finished games are bulk written to monthly archive tables
+    ARCHIVE_ENABLED = env_flag("ARCHIVE_ENABLED", True)
+    ARCHIVE_FLUSH_INTERVAL = float(environ.get("ARCHIVE_FLUSH_INTERVAL", 5))
+    ARCHIVE_BATCH_SIZE = int(environ.get("ARCHIVE_BATCH_SIZE", 100))
+
+    # Logs are written as JSON lines by a background thread. Request and
+    # response payloads are logged for a fraction of records by level, with
+    # these fields redacted, and cut to LOG_PAYLOAD_MAX_BYTES.
+    LOG_LEVEL = environ.get("LOG_LEVEL", "INFO")
+    LOG_QUEUE_SIZE = int(environ.get("LOG_QUEUE_SIZE", 10000))
+    LOG_PAYLOAD_SAMPLE_RATES = {
+        "DEBUG": float(environ.get("LOG_PAYLOAD_SAMPLE_DEBUG", 1)),
+        "INFO": float(environ.get("LOG_PAYLOAD_SAMPLE_INFO", 0.01)),
+    }
+    LOG_PAYLOAD_MAX_BYTES = int(environ.get("LOG_PAYLOAD_MAX_BYTES", 4096))
+    LOG_REDACT_FIELDS = environ.get(
+        "LOG_REDACT_FIELDS", "userId,idToken,accessToken,state"
+    ).split(",")
+
+    # Database pool, sized for the threads of one gunicorn worker plus one
+    # connection for the background jobs
+    WORKER_THREADS = int(environ.get("WORKER_THREADS", 1))
+    DB_POOL_SIZE = int(environ.get("DB_POOL_SIZE", WORKER_THREADS + 1))
+    DB_MAX_OVERFLOW = int(environ.get("DB_MAX_OVERFLOW", 2))
+    DB_POOL_TIMEOUT = float(environ.get("DB_POOL_TIMEOUT", 5))
+    DB_POOL_RECYCLE = int(environ.get("DB_POOL_RECYCLE", 1800))
+    # Milliseconds, enforced by the server for each statement (0 disables)
+    DB_STATEMENT_TIMEOUT = int(environ.get("DB_STATEMENT_TIMEOUT", 5000))
+    DB_SLOW_QUERY_THRESHOLD = float(
+        environ.get("DB_SLOW_QUERY_THRESHOLD", 0.25)
+    )
+
+    # Board images. Style is extra CSS for chess.svg, e.g. a colour theme
+    BOARD_IMAGE_SIZE = int(environ.get("BOARD_IMAGE_SIZE", 0)) or None
+    BOARD_IMAGE_STYLE = environ.get("BOARD_IMAGE_STYLE")
+    # Pixel sizes of board images by variant, phones get small ones and
+    # smart displays large ones. None is the natural size of 390px.
+    IMAGE_SIZES = {
+        "small": int(environ.get("IMAGE_SIZE_SMALL", 240)),
+        "medium": BOARD_IMAGE_SIZE,
+        "large": int(environ.get("IMAGE_SIZE_LARGE", 600)),
+    }
+    # One of png, png8 (palette PNG) or webp
+    IMAGE_FORMAT = environ.get("IMAGE_FORMAT", "png")
+    IMAGE_FORMAT_SMALL = environ.get("IMAGE_FORMAT_SMALL", "png8")
+    # "svg" rasterises every image with cairosvg, "sprite" composes them from
+    # layers rasterised once at startup
+    BOARD_RENDERER = environ.get("BOARD_RENDERER", "svg")
+    # Sign the position into image URLs and render when they are fetched,
+    # instead of before the webhook responds
+    LAZY_BOARD_IMAGES = env_flag("LAZY_BOARD_IMAGES")
+    # Rendered positions are shared between sessions through these caches
+    RENDER_CACHE_MEMORY_BYTES = int(
+        environ.get("RENDER_CACHE_MEMORY_BYTES", 32 * 1024 * 1024)
+    )
+    RENDER_CACHE_DISK_BYTES = int(
+        environ.get("RENDER_CACHE_DISK_BYTES", 512 * 1024 * 1024)
+    )
+    RENDER_CACHE_DIR = environ.get("RENDER_CACHE_DIR")  # IMG_DIR/cache
+    # Processes rendering board images outside of requests, 0 renders them
+    # in the request. Image requests wait up to RENDER_WAIT_TIMEOUT seconds
+    # for a pending render before getting a placeholder.
+    RENDER_WORKERS = int(environ.get("RENDER_WORKERS", 0))
+    RENDER_QUEUE_SIZE = int(environ.get("RENDER_QUEUE_SIZE", 64))
+    RENDER_WAIT_TIMEOUT = float(environ.get("RENDER_WAIT_TIMEOUT", 2))
+    # Board images by content hash never change, so they can be cached for
+    # as long as clients and proxies like
+    IMAGE_MAX_AGE = int(environ.get("IMAGE_MAX_AGE", 365 * 24 * 60 * 60))
+    # Let the web server send cached images from disk, either with
+    # X-Sendfile (e.g. Apache) or with X-Accel-Redirect to an internal nginx
+    # location mapped to the render cache directory
+    USE_X_SENDFILE = env_flag("USE_X_SENDFILE")
+    IMAGE_ACCEL_REDIRECT_PREFIX = environ.get("IMAGE_ACCEL_REDIRECT_PREFIX")
+
+    # Where session images and, for shared stores, rendered boards are kept:
+    # local (IMG_DIR), shared (a directory mounted by all nodes), memory or
+    # s3, which needs the s3 extra for boto3. Any node can serve images from
+    # a shared or s3 store.
+    IMAGE_STORE = environ.get("IMAGE_STORE", "local")
+    IMAGE_STORE_DIR = environ.get("IMAGE_STORE_DIR")  # Defaults to IMG_DIR
+    IMAGE_STORE_BUCKET = environ.get("IMAGE_STORE_BUCKET")
+    IMAGE_STORE_PREFIX = environ.get("IMAGE_STORE_PREFIX", "")
+    IMAGE_STORE_ENDPOINT_URL = environ.get("IMAGE_STORE_ENDPOINT_URL")
+
+    # Animated GIF replays of games, grown by a frame per ply while they are
+    # played. Frames are shown for REPLAY_FRAME_DURATION seconds and the
+    # final position for REPLAY_FINAL_FRAME_DURATION. With
+    # REPLAY_IN_BACKGROUND they are written after the response is sent.
+    REPLAY_ENABLED = env_flag("REPLAY_ENABLED")
+    REPLAY_IN_BACKGROUND = env_flag("REPLAY_IN_BACKGROUND", True)
+    REPLAY_DIR = environ.get("REPLAY_DIR")  # IMG_DIR/replays
+    REPLAY_IMAGE_SIZE = int(environ.get("REPLAY_IMAGE_SIZE", 240))
+    REPLAY_FRAME_DURATION = float(environ.get("REPLAY_FRAME_DURATION", 1))
+    REPLAY_FINAL_FRAME_DURATION = float(
+        environ.get("REPLAY_FINAL_FRAME_DURATION", 4)
+    )
+
+    # Each worker writes its metrics to METRICS_DIR, which /metrics adds up,
+    # folding those of exited workers into one file. It should be emptied
+    # on deploys, like a tmpfs. Without it, /metrics only has the metrics
+    # of the worker serving it.
+    METRICS_DIR = environ.get("METRICS_DIR")
+    METRICS_FLUSH_INTERVAL = float(environ.get("METRICS_FLUSH_INTERVAL", 5))
+    METRICS_ACTIVE_SESSION_WINDOW = int(
+        environ.get("METRICS_ACTIVE_SESSION_WINDOW", 900)
+    )
+    # Bearer token required to read /metrics, if set
+    METRICS_TOKEN = environ.get("METRICS_TOKEN")
+
+    # Traces of requests, exported to stdout or to an OTLP/HTTP collector.
+    # Requests slower than TRACING_SLOW_THRESHOLD seconds or failed ones are
+    # always kept, TRACING_SAMPLE_RATE of the others.
+    TRACING_ENABLED = env_flag("TRACING_ENABLED")
+    TRACING_EXPORTER = environ.get("TRACING_EXPORTER", "stdout")
+    TRACING_OTLP_ENDPOINT = environ.get(
+        "TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces"
+    )
+    TRACING_SERVICE_NAME = environ.get("TRACING_SERVICE_NAME", "wizardchess")
+    TRACING_SAMPLE_RATE = float(environ.get("TRACING_SAMPLE_RATE", 0.01))
+    TRACING_SLOW_THRESHOLD = float(environ.get("TRACING_SLOW_THRESHOLD", 1))
+    TRACING_QUEUE_SIZE = int(environ.get("TRACING_QUEUE_SIZE", 1000))
+
+    # Requests with a token from `flask profile-token` in the X-Profile
+    # header are profiled, the PROFILE_MAX_FILES newest profiles are kept in
+    # PROFILE_DIR and listed at /admin/profiles. A PROFILE_SAMPLER_INTERVAL
+    # samples all threads all the time, at that many seconds per sample.
+    PROFILE_DIR = environ.get("PROFILE_DIR")  # IMG_DIR/profiles
+    PROFILE_MAX_FILES = int(environ.get("PROFILE_MAX_FILES", 100))
+    PROFILE_TOKEN_MAX_AGE = int(environ.get("PROFILE_TOKEN_MAX_AGE", 3600))
+    PROFILE_SAMPLE_INTERVAL = float(
+        environ.get("PROFILE_SAMPLE_INTERVAL", 0.001)
+    )
+    PROFILE_SAMPLER_INTERVAL = float(
+        environ.get("PROFILE_SAMPLER_INTERVAL", 0)
+    )
+    PROFILE_SAMPLER_FLUSH_INTERVAL = float(
+        environ.get("PROFILE_SAMPLER_FLUSH_INTERVAL", 60)
+    )
+    # Bearer token for the /admin endpoints, which are off without it
+    ADMIN_TOKEN = environ.get("ADMIN_TOKEN")
+
+    # Webhook requests and responses of CAPTURE_SAMPLE_RATE of sessions,
+    # anonymised, in gzipped JSON lines for benchmarks/replay_capture.py.
+    # Each worker appends to a file of its own per day, every
+    # CAPTURE_FLUSH_INTERVAL seconds, up to CAPTURE_MAX_FILE_BYTES.
+    CAPTURE_ENABLED = env_flag("CAPTURE_ENABLED")
+    CAPTURE_DIR = environ.get("CAPTURE_DIR")  # IMG_DIR/captures
+    CAPTURE_SAMPLE_RATE = float(environ.get("CAPTURE_SAMPLE_RATE", 0.01))
+    CAPTURE_FLUSH_INTERVAL = float(environ.get("CAPTURE_FLUSH_INTERVAL", 10))
+    CAPTURE_BATCH_SIZE = int(environ.get("CAPTURE_BATCH_SIZE", 200))
+    CAPTURE_MAX_FILE_BYTES = int(
+        environ.get("CAPTURE_MAX_FILE_BYTES", 256 * 1024 * 1024)
+    )
+
+    # Serialize webhook responses with orjson when it is installed
+    RESPONSE_JSON_ORJSON = env_flag("RESPONSE_JSON_ORJSON", True)
+
+    # Responses are kept for IDEMPOTENCY_TTL seconds by responseId, session
+    # and query, so that deliveries retried by Dialogflow get the same one.
+    # A retry of a turn still running waits up to IDEMPOTENCY_WAIT_TIMEOUT.
+    IDEMPOTENCY_TTL = float(environ.get("IDEMPOTENCY_TTL", 60))
+    IDEMPOTENCY_WAIT_TIMEOUT = float(
+        environ.get("IDEMPOTENCY_WAIT_TIMEOUT", 10)
+    )
+    IDEMPOTENCY_MAX_ENTRIES = int(
+        environ.get("IDEMPOTENCY_MAX_ENTRIES", 10000)
+    )
+    # "memory" keeps them in each worker, "db" shares them between workers
+    # through the database, with two writes per webhook. STATELESS_MODE
+    # always keeps them in memory.
+    IDEMPOTENCY_STORE = environ.get("IDEMPOTENCY_STORE", "memory")
+
+    # Turns which lose a compare-and-swap on the game row before saving
+    # anything are replayed up to this many times
+    CONCURRENCY_MAX_RETRIES = int(environ.get("CONCURRENCY_MAX_RETRIES", 2))
+    CONCURRENCY_BACKOFF = float(environ.get("CONCURRENCY_BACKOFF", 0.05))
+
+    # Sessions idle for longer than the TTL (seconds) are deleted along with
+    # their images and expired webhook responses, by `flask reap-sessions`
+    # from a scheduler or by a background reaper every REAPER_INTERVAL
+    # seconds, off by default.
+    # Processes with the reaper on take turns through REAPER_LOCK_FILE, so
+    # on several hosts it should only be turned on for one of them.
+    REAPER_INTERVAL = float(environ.get("REAPER_INTERVAL", 0))
+    REAPER_LOCK_FILE = environ.get("REAPER_LOCK_FILE")  # IMG_DIR/reaper.lock
+    REAPER_SESSION_TTL = float(environ.get("REAPER_SESSION_TTL", 86400))
+    REAPER_BATCH_SIZE = int(environ.get("REAPER_BATCH_SIZE", 500))
+    REAPER_MAX_BATCHES = int(environ.get("REAPER_MAX_BATCHES", 20))
+    REAPER_BATCH_DELAY = float(environ.get("REAPER_BATCH_DELAY", 0.5))
+
 
 class DevConfig(Config):
     DEBUG = True
@@ -64,3 +271,11 @@ class TestConfig(Config):
     )
 
     ENGINE_PATH = environ.get("ENGINE_PATH", "stockfish")
+
+    # Write archived games, captured requests and replays synchronously
+    ARCHIVE_FLUSH_INTERVAL = 0
+    CAPTURE_FLUSH_INTERVAL = 0
+    REPLAY_IN_BACKGROUND = False
+    REAPER_INTERVAL = 0
+    # Requests of the tests share a responseId
+    IDEMPOTENCY_TTL = 0
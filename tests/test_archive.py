@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import chess
+
+from chess_server import db
+from chess_server.archive import (
+    archive_game,
+    archive_writer,
+    get_archive_table,
+    load_archived_board,
+    pack_moves,
+    unpack_moves,
+)
+from chess_server.utils import create_user
+from tests.utils import get_random_session_id
+
+
+def test_pack_and_unpack_moves():
+    board = chess.Board("8/P7/8/8/8/8/k6p/4K3 w - - 0 1")
+    moves = [
+        chess.Move.from_uci("a7a8n"),
+        chess.Move.from_uci("h2h1q"),
+        chess.Move.from_uci("e1f2"),
+    ]
+
+    for move in moves:
+        board.push(move)
+
+    data = pack_moves(board.move_stack)
+
+    assert len(data) == 2 * len(moves)
+    assert unpack_moves(data) == moves
+
+
+def test_get_archive_table_from_threads(app, context):
+    def get_table(month):
+        with app.app_context():
+            return get_archive_table(month)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tables = list(executor.map(get_table, ["1999-12"] * 8))
+
+    assert len({id(table) for table in tables}) == 1
+    assert db.session.execute(tables[0].select()).fetchall() == []
+    tables[0].drop(db.engine)
+    db.metadata.remove(tables[0])
+
+
+class TestArchiveGame:
+    def setup_method(self):
+        self.session_id = get_random_session_id()
+        self.board = chess.Board()
+
+        for san in ["f3", "e5", "g4", "Qh4#"]:
+            self.board.push_san(san)
+
+    def get_rows(self):
+        table = get_archive_table(datetime.utcnow().strftime("%Y-%m"))
+        return db.session.execute(table.select()).fetchall()
+
+    def test_archive_game(self, context):
+        create_user(self.session_id, chess.Board(), chess.WHITE)
+
+        archive_game(self.session_id, self.board, chess.WHITE)
+
+        (row,) = self.get_rows()
+        assert row.session_id == self.session_id
+        assert row.result == "0-1"
+        assert row.plies == 4
+        assert row.start_fen is None
+        assert row.started_at is not None
+        assert load_archived_board(row).fen() == self.board.fen()
+
+    def test_archive_game_is_buffered(self, config, context, mocker):
+        config["ARCHIVE_FLUSH_INTERVAL"] = 60
+        config["ARCHIVE_BATCH_SIZE"] = 10
+        mock_thread = mocker.patch.object(archive_writer, "_ensure_thread")
+
+        for _ in range(3):
+            archive_game(get_random_session_id(), self.board, chess.BLACK)
+
+        mock_thread.assert_called()
+        assert self.get_rows() == []
+
+        assert archive_writer.flush() == 3
+        assert len(self.get_rows()) == 3
+
+    def test_archive_game_disabled(self, config, context, mocker):
+        config["ARCHIVE_ENABLED"] = False
+        mock_enqueue = mocker.patch.object(archive_writer, "enqueue")
+
+        archive_game(self.session_id, self.board, chess.WHITE)
+
+        mock_enqueue.assert_not_called()
+
+    def test_flush_error(self, context, mocker):
+        mocker.patch(
+            "chess_server.archive.get_archive_table",
+            side_effect=Exception("Example error"),
+        )
+        mock_logger = mocker.patch("chess_server.archive.logger.error")
+
+        archive_game(self.session_id, self.board, chess.WHITE)
+
+        mock_logger.assert_called_with(
+            "Unable to archive 1 games, will retry:\nExample error"
+        )
+
+        mocker.stopall()
+        assert archive_writer.flush() == 1
+        assert len(self.get_rows()) == 1
+
+    def test_close_logs_games_not_archived(self, context, mocker):
+        mocker.patch(
+            "chess_server.archive.get_archive_table",
+            side_effect=Exception("Example error"),
+        )
+        mock_logger = mocker.patch("chess_server.archive.logger.error")
+
+        archive_game(self.session_id, self.board, chess.WHITE)
+        archive_writer.close()
+
+        mock_logger.assert_called_with(
+            f"Dropping the game of {self.session_id}, which could not be "
+            "archived: startpos moves f2f3 e7e5 g2g4 d8h4 result 0-1"
+        )
+        assert archive_writer.buffer.empty()
+
+    def test_archive_game_stateless(self, config, context, mocker):
+        config["STATELESS_MODE"] = True
+        mock_enqueue = mocker.patch.object(archive_writer, "enqueue")
+
+        archive_game(self.session_id, self.board, chess.WHITE)
+
+        mock_enqueue.assert_not_called()
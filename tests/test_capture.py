@@ -0,0 +1,93 @@
+import gzip
+import json
+import os
+
+import chess
+import pytest
+
+from chess_server.capture import (
+    captures_dropped,
+    read_capture,
+    record_engine_move,
+    traffic_recorder,
+)
+from chess_server.intents import Handler
+from tests.utils import get_dummy_webhook_request_for_google
+
+SESSION_ID = "a2bc1a0d-7a3b-4c1f-9b54-4f4d3fd1d3c6"
+
+
+def engine_handler(req):
+    board = chess.Board()
+    record_engine_move(board, chess.Move.from_uci("e2e4"))
+
+    return {"fulfillmentText": f"Hello {SESSION_ID}"}
+
+
+def test_read_capture_stops_at_cut_batch(tmpdir):
+    path = str(tmpdir.join("capture.jsonl.gz"))
+    with open(path, "wb") as f:
+        f.write(gzip.compress(b'{"spam": 1}\n{"spam": 2}\n'))
+        batch = gzip.compress(b'{"spam": 3}\n{"spam": 4}\n')
+        f.write(batch[:20])
+
+    assert [record["spam"] for record in read_capture(path)] == [1, 2]
+
+
+class TestTrafficRecorder:
+    @pytest.fixture(autouse=True)
+    def setup_recorder(self, app, config, mocker):
+        config["CAPTURE_ENABLED"] = True
+        config["CAPTURE_SAMPLE_RATE"] = 1
+        traffic_recorder.init_app(app)
+        mocker.patch.dict(
+            "chess_server.intents.handlers",
+            {"spam": Handler("spam", engine_handler)},
+        )
+
+    def post(self, client):
+        req = get_dummy_webhook_request_for_google(
+            session_id=SESSION_ID, action="spam"
+        )
+        return client.post("/webhook", json=req)
+
+    def read(self):
+        return [
+            record
+            for name in sorted(os.listdir(traffic_recorder.path))
+            for record in read_capture(
+                os.path.join(traffic_recorder.path, name)
+            )
+        ]
+
+    def test_request_is_captured(self, client):
+        self.post(client)
+
+        (record,) = self.read()
+        pseudonym = traffic_recorder.pseudonym(SESSION_ID)
+        assert SESSION_ID not in json.dumps(record)
+        assert record["request"]["session"].endswith(f"/{pseudonym}")
+        assert "user" not in (
+            record["request"]["originalDetectIntentRequest"]["payload"]
+        )
+        assert record["response"] == {"fulfillmentText": f"Hello {pseudonym}"}
+        assert record["status"] == 200
+        assert record["duration"] > 0
+        assert record["engine_moves"] == [[chess.STARTING_FEN, "e2e4"]]
+
+    def test_sessions_are_sampled(self, client, config):
+        config["CAPTURE_SAMPLE_RATE"] = 0
+
+        self.post(client)
+
+        assert self.read() == []
+
+    def test_full_file(self, client, config):
+        config["CAPTURE_MAX_FILE_BYTES"] = 0
+        open(traffic_recorder.get_file_path(), "wb").close()
+        dropped = captures_dropped.get()
+
+        self.post(client)
+
+        assert self.read() == []
+        assert captures_dropped.get() == dropped + 1
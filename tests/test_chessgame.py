@@ -5,7 +5,7 @@ import chess.engine
 import pytest
 from flask import current_app
 
-from chess_server.chessgame import Mediator
+from chess_server.chessgame import Mediator, engine_search
 from chess_server.utils import User
 from tests.utils import get_random_session_id
 
@@ -82,6 +82,8 @@ class TestMediator(TestCase):
             move=move, ponder=None
         )
 
+        searches = engine_search.count()
+
         with mock.patch.object(self.board, "push") as mock_push:
             with mock.patch.object(self.board, "lan", return_value=lan):
                 value = self.mediator.play_engine_move_and_get_speech(
@@ -97,6 +99,7 @@ class TestMediator(TestCase):
             session_id, self.board
         )  # DB was updated
         self.assertEqual(value, "test reply")  # Correctly reply was given
+        self.assertEqual(engine_search.count(), searches + 1)
 
     @mock.patch("chess_server.chessgame.update_user")
     @mock.patch("chess_server.chessgame.get_user")
@@ -1,8 +1,11 @@
 import chess
 import pytest
+from flask import g
 
+from chess_server import db
 from chess_server.models import UserModel
 from chess_server.utils import (
+    ConcurrentUpdateError,
     User,
     create_user,
     get_user,
@@ -215,3 +218,61 @@ def test_delete_user_multiple_entries(context):
     # Verify that no other changes were made
     assert UserModel.query.count() == 1
     assert get_user(session_id2) == User(board2, color2)
+
+
+def bump_version_elsewhere(session_id):
+    """Simulate a write to the row by another worker"""
+    table = UserModel.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.session_id == session_id)
+        .values(version=table.c.version + 1)
+    )
+
+
+def get_user_from_fresh_request(session_id):
+    g.pop("user_versions")
+    return get_user(session_id)
+
+
+def test_update_user_bumps_version(context):
+    session_id = get_random_session_id()
+    board = chess.Board()
+
+    create_user(session_id, board, chess.WHITE)
+    assert UserModel.query.get(session_id).version == 1
+
+    board.push_san("e4")
+    update_user(session_id, board)
+
+    assert UserModel.query.get(session_id).version == 2
+
+
+def test_update_user_concurrent_write(context):
+    session_id = get_random_session_id()
+    board = chess.Board()
+
+    create_user(session_id, board, chess.WHITE)
+    user = get_user(session_id)
+
+    bump_version_elsewhere(session_id)
+
+    user.board.push_san("e4")
+    with pytest.raises(ConcurrentUpdateError):
+        update_user(session_id, user.board)
+
+    # The other write wins and our move is not saved
+    assert get_user_from_fresh_request(session_id).board == board
+
+
+def test_get_user_after_concurrent_write(context):
+    session_id = get_random_session_id()
+
+    create_user(session_id, chess.Board(), chess.WHITE)
+    get_user(session_id)
+
+    bump_version_elsewhere(session_id)
+    db.session.commit()
+
+    with pytest.raises(ConcurrentUpdateError):
+        get_user(session_id)
@@ -0,0 +1,192 @@
+import threading
+
+import pytest
+
+from chess_server.idempotency import (
+    IdempotencyCache,
+    delete_expired_responses,
+    duplicate_requests,
+    get_request_key,
+)
+from chess_server.models import WebhookResponseModel
+from tests.utils import get_dummy_webhook_request_for_google
+
+
+def test_get_request_key():
+    req = get_dummy_webhook_request_for_google(
+        session_id="spam", queryText="e4"
+    )
+
+    assert get_request_key(req) == (req["responseId"], req["session"], "e4")
+
+    del req["responseId"]
+    assert get_request_key(req) is None
+
+
+class TestIdempotencyCache:
+    @pytest.fixture(autouse=True)
+    def setup_cache(self, app, config):
+        config["IDEMPOTENCY_TTL"] = 60
+        config["IDEMPOTENCY_WAIT_TIMEOUT"] = 1
+        config["IDEMPOTENCY_STORE"] = "memory"
+        self.config = config
+        self.cache = IdempotencyCache()
+        self.cache.init_app(app)
+        self.key = ("spam", "eggs", "ham")
+
+    def test_duplicate_gets_response(self):
+        entry, first = self.cache.begin(self.key)
+        self.cache.finish(entry, {"spam": ["eggs"]})
+        duplicates = duplicate_requests.get(state="done")
+
+        duplicate, first_again = self.cache.begin(self.key)
+        res = self.cache.wait(duplicate)
+
+        assert first and not first_again
+        assert res == {"spam": ["eggs"]}
+        assert duplicate_requests.get(state="done") == duplicates + 1
+
+        # Callers get copies they are free to change
+        res["spam"].append("bacon")
+        assert self.cache.wait(duplicate) == {"spam": ["eggs"]}
+
+    def test_duplicate_waits_for_first(self):
+        entry, _ = self.cache.begin(self.key)
+        duplicate, _ = self.cache.begin(self.key)
+        results = []
+
+        waiter = threading.Thread(
+            target=lambda: results.append(self.cache.wait(duplicate))
+        )
+        waiter.start()
+        self.cache.finish(entry, {"spam": "eggs"})
+        waiter.join()
+
+        assert results == [{"spam": "eggs"}]
+
+    def test_wait_timeout(self):
+        self.config["IDEMPOTENCY_WAIT_TIMEOUT"] = 0.01
+        self.cache.begin(self.key)
+        duplicate, _ = self.cache.begin(self.key)
+
+        assert self.cache.wait(duplicate) is None
+
+    def test_abandoned(self):
+        entry, _ = self.cache.begin(self.key)
+        duplicate, _ = self.cache.begin(self.key)
+
+        self.cache.abandon(self.key, entry)
+
+        assert self.cache.wait(duplicate) is None
+        assert self.cache.begin(self.key)[1]
+
+    def test_expired(self, mocker):
+        mock_time = mocker.patch("chess_server.idempotency.time.monotonic")
+        mock_time.return_value = 100
+        entry, _ = self.cache.begin(self.key)
+        self.cache.finish(entry, {})
+
+        mock_time.return_value = 161
+
+        assert self.cache.begin(self.key)[1]
+
+    def test_expired_behind_running(self, mocker):
+        mock_time = mocker.patch("chess_server.idempotency.time.monotonic")
+        mock_time.return_value = 100
+        self.cache.begin(("running", "", ""))
+        entry, _ = self.cache.begin(self.key)
+        self.cache.finish(entry, {})
+
+        mock_time.return_value = 161
+
+        assert self.cache.begin(self.key)[1]
+        assert ("running", "", "") in self.cache.entries
+
+    def test_max_entries(self):
+        self.config["IDEMPOTENCY_MAX_ENTRIES"] = 2
+        running, _ = self.cache.begin(("running", "", ""))
+        for key in ("a", "b"):
+            entry, _ = self.cache.begin((key, "", ""))
+            self.cache.finish(entry, {})
+
+        assert list(self.cache.entries) == [("running", "", ""), ("b", "", "")]
+
+
+@pytest.mark.usefixtures("context")
+class TestSharedIdempotencyCache:
+    @pytest.fixture(autouse=True)
+    def setup_caches(self, app, config):
+        config["IDEMPOTENCY_TTL"] = 60
+        config["IDEMPOTENCY_WAIT_TIMEOUT"] = 1
+        config["IDEMPOTENCY_STORE"] = "db"
+        self.config = config
+        # Stand for two worker processes
+        self.first, self.other = IdempotencyCache(), IdempotencyCache()
+        self.first.init_app(app)
+        self.other.init_app(app)
+        self.key = ("spam", "eggs", "ham")
+
+    def test_other_worker_gets_response(self):
+        entry, first = self.first.begin(self.key)
+        self.first.finish(entry, {"spam": "eggs"})
+        duplicates = duplicate_requests.get(state="shared")
+
+        duplicate, first_again = self.other.begin(self.key)
+
+        assert first and not first_again
+        assert self.other.wait(duplicate) == {"spam": "eggs"}
+        assert duplicate_requests.get(state="shared") == duplicates + 1
+
+        # Kept in the other worker too
+        duplicate, _ = self.other.begin(self.key)
+        assert duplicate.done.is_set()
+        assert self.other.wait(duplicate) == {"spam": "eggs"}
+
+    def test_other_worker_waits_for_first(self, app):
+        entry, _ = self.first.begin(self.key)
+        duplicate, _ = self.other.begin(self.key)
+        results = []
+
+        def wait():
+            with app.app_context():
+                results.append(self.other.wait(duplicate))
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        self.first.finish(entry, {"spam": "eggs"})
+        waiter.join()
+
+        assert results == [{"spam": "eggs"}]
+
+    def test_abandoned(self):
+        entry, _ = self.first.begin(self.key)
+        duplicate, _ = self.other.begin(self.key)
+
+        self.first.abandon(self.key, entry)
+
+        assert self.other.wait(duplicate) is None
+        assert self.other.begin(self.key)[1]
+
+    def test_unfinished_delivery_expires(self):
+        self.config["IDEMPOTENCY_WAIT_TIMEOUT"] = 0
+        self.first.begin(self.key)
+
+        # The first worker may be gone, so a retry runs the turn
+        assert self.other.begin(self.key)[1]
+
+    def test_stateless_mode_keeps_memory(self):
+        self.config["STATELESS_MODE"] = True
+        entry, _ = self.first.begin(self.key)
+        self.first.finish(entry, {"spam": "eggs"})
+
+        assert WebhookResponseModel.query.count() == 0
+        assert self.other.begin(self.key)[1]
+
+    def test_delete_expired_responses(self):
+        self.config["IDEMPOTENCY_TTL"] = 0
+        entry, _ = self.first.begin(self.key)
+        self.first.finish(entry, {})
+        entry, _ = self.first.begin(("spam", "", ""))
+
+        assert delete_expired_responses() == 1
+        assert WebhookResponseModel.query.count() == 1
@@ -0,0 +1,178 @@
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from chess_server.intents import (
+    ERROR_RESPONSES,
+    dispatch,
+    handlers,
+    intent,
+    intent_duration,
+    intent_errors,
+    providers,
+    resource,
+)
+from chess_server.utils import get_image_variant
+from tests.utils import get_dummy_webhook_request_for_google
+
+
+@pytest.fixture
+def registry(mocker):
+    """Handlers and providers registered by a test are dropped after it"""
+    mocker.patch.dict(handlers)
+    mocker.patch.dict(providers)
+
+
+@pytest.mark.usefixtures("context", "registry")
+class TestDispatch:
+    def setup_method(self):
+        self.result = {"spam": "eggs"}
+
+    def test_intent_registers_handler(self):
+        @intent("spam", params=("eggs",), needs=("db",))
+        def spam(call):
+            return self.result
+
+        req = get_dummy_webhook_request_for_google(
+            action="spam", parameters={"eggs": "ham"}
+        )
+
+        assert handlers["spam"].params == ("eggs",)
+        assert handlers["spam"].needs == frozenset({"db"})
+        assert dispatch("spam", req) == self.result
+
+    def test_unknown_resource(self):
+        with pytest.raises(ValueError):
+            intent("spam", needs=("printer",))
+
+        with pytest.raises(ValueError):
+            resource("printer")
+
+    def test_unknown_action(self):
+        req = get_dummy_webhook_request_for_google(action="spam")
+
+        with pytest.raises(BadRequest):
+            dispatch("spam", req)
+
+    def test_missing_params(self, mocker):
+        handler = mocker.Mock()
+        intent("spam", params=("eggs", "ham"))(handler)
+        req = get_dummy_webhook_request_for_google(
+            action="spam", parameters={"eggs": "bacon"}
+        )
+
+        with pytest.raises(BadRequest, match="spam: ham"):
+            dispatch("spam", req)
+
+        handler.assert_not_called()
+
+    def test_per_action_middleware(self):
+        calls = []
+
+        def spam_middleware(call, call_next):
+            calls.append(call.action)
+            res = call_next(call)
+            res["wrapped"] = True
+            return res
+
+        @intent("spam", middleware=(spam_middleware,))
+        def spam(call):
+            return {}
+
+        @intent("eggs")
+        def eggs(req):
+            return {}
+
+        req = get_dummy_webhook_request_for_google(action="spam")
+
+        assert dispatch("spam", req) == {"wrapped": True}
+        assert dispatch("eggs", req) == {}
+        assert calls == ["spam"]
+
+    def test_timing(self):
+        intent("spam")(lambda call: self.result)
+        count = intent_duration.count(action="spam")
+
+        dispatch("spam", get_dummy_webhook_request_for_google(action="spam"))
+
+        assert intent_duration.count(action="spam") == count + 1
+
+    def test_resources_are_prepared_for_handlers_needing_them(self, mocker):
+        provider = mocker.Mock()
+        resource("engine")(provider)
+        intent("spam", needs=("engine",))(lambda call: self.result)
+        intent("eggs")(lambda call: self.result)
+
+        dispatch("eggs", get_dummy_webhook_request_for_google(action="eggs"))
+        provider.assert_not_called()
+
+        dispatch("spam", get_dummy_webhook_request_for_google(action="spam"))
+        provider.assert_called_once()
+
+    def test_renderer_negotiates_image_variant(self):
+        intent("spam", needs=("renderer",))(
+            lambda call: {"variant": get_image_variant()}
+        )
+        req = get_dummy_webhook_request_for_google(action="spam")
+
+        assert dispatch("spam", req)["variant"].size == "small"
+
+    def test_unavailable_resource(self, mocker):
+        resource("engine")(mocker.Mock(side_effect=FileNotFoundError()))
+        handler = mocker.Mock()
+        intent("spam", needs=("engine",))(handler)
+        errors = intent_errors.get(action="spam", error="unavailable")
+
+        res = dispatch(
+            "spam", get_dummy_webhook_request_for_google(action="spam")
+        )
+
+        assert ERROR_RESPONSES["unavailable"] in str(res)
+        assert intent_errors.get(action="spam", error="unavailable") == (
+            errors + 1
+        )
+        handler.assert_not_called()
+
+    def test_game_states_are_carried_for_db_handlers(self, config, mocker):
+        config["STATELESS_MODE"] = True
+        mock_load = mocker.patch(
+            "chess_server.intents.load_game_states_from_req"
+        )
+        intent("spam", needs=("db",))(lambda call: {})
+        intent("eggs")(lambda call: {})
+
+        res = dispatch(
+            "eggs", get_dummy_webhook_request_for_google(action="eggs")
+        )
+
+        assert "outputContexts" not in res
+        mock_load.assert_not_called()
+
+        res = dispatch(
+            "spam", get_dummy_webhook_request_for_google(action="spam")
+        )
+
+        assert res["outputContexts"] == []
+        mock_load.assert_called_once()
+
+    def test_duplicate_delivery_gets_first_response(self, config, mocker):
+        config["IDEMPOTENCY_TTL"] = 60
+        handler = mocker.Mock(side_effect=[{"move": 1}, {"move": 2}])
+        intent("spam")(handler)
+        req = get_dummy_webhook_request_for_google(action="spam")
+
+        assert dispatch("spam", req) == {"move": 1}
+        assert dispatch("spam", req) == {"move": 1}
+
+        req["responseId"] = "another"
+        assert dispatch("spam", req) == {"move": 2}
+
+    def test_failed_delivery_is_not_kept(self, config, mocker):
+        config["IDEMPOTENCY_TTL"] = 60
+        handler = mocker.Mock(side_effect=[RuntimeError(), {"move": 1}])
+        intent("spam")(handler)
+        req = get_dummy_webhook_request_for_google(action="spam")
+
+        with pytest.raises(RuntimeError):
+            dispatch("spam", req)
+
+        assert dispatch("spam", req) == {"move": 1}
@@ -0,0 +1,134 @@
+import json
+import logging
+import queue
+
+from chess_server import logconfig
+from chess_server.intents import Handler
+from chess_server.logconfig import (
+    REDACTED,
+    AsyncHandler,
+    JsonFormatter,
+    records_dropped,
+    redact,
+)
+from tests.utils import get_dummy_webhook_request_for_google
+
+
+def make_record(level=logging.INFO, msg="spam %s", args=("eggs",), **extra):
+    record = logging.makeLogRecord(
+        {"name": "chess_server.test", "levelno": level, "msg": msg}
+    )
+    record.levelname = logging.getLevelName(level)
+    record.args = args
+    record.__dict__.update(extra)
+    return record
+
+
+def test_redact():
+    value = {"user": {"userId": "1", "locale": "en"}, "list": [{"state": 2}]}
+
+    assert redact(value, {"userId", "state"}) == {
+        "user": {"userId": REDACTED, "locale": "en"},
+        "list": [{"state": REDACTED}],
+    }
+    assert value["user"]["userId"] == "1"
+
+
+class TestJsonFormatter:
+    def test_format(self):
+        record = make_record(action="welcome", payload={"userId": "1"})
+
+        entry = json.loads(JsonFormatter({"userId"}).format(record))
+
+        assert entry["level"] == "INFO"
+        assert entry["logger"] == "chess_server.test"
+        assert entry["message"] == "spam eggs"
+        assert entry["action"] == "welcome"
+        assert entry["payload"] == {"userId": REDACTED}
+        assert entry["ts"].endswith("Z")
+
+    def test_payload_is_capped(self):
+        record = make_record(payload={"spam": "x" * 100})
+
+        entry = json.loads(
+            JsonFormatter(max_payload_bytes=20).format(record)
+        )
+
+        assert entry["payload"] == '{"spam": "' + "x" * 10
+        assert entry["payload_truncated"] > 100
+
+    def test_exception(self):
+        try:
+            raise ValueError("spam")
+        except ValueError as exc:
+            record = make_record(exc_info=(ValueError, exc, exc.__traceback__))
+
+        entry = json.loads(JsonFormatter().format(record))
+
+        assert "ValueError: spam" in entry["exc"]
+
+
+class TestAsyncHandler:
+    def test_payload_sampling(self, mocker):
+        log_queue = queue.Queue()
+        handler = AsyncHandler(log_queue, {"INFO": 0.25})
+        mocker.patch(
+            "chess_server.logconfig.random.random", side_effect=[0.1, 0.5]
+        )
+
+        for level in (logging.INFO, logging.INFO, logging.ERROR):
+            handler.handle(make_record(level=level, payload={"spam": 1}))
+
+        kept = [hasattr(log_queue.get(), "payload") for _ in range(3)]
+        assert kept == [True, False, True]
+
+    def test_record_is_prepared_for_the_listener(self):
+        log_queue = queue.Queue()
+        handler = AsyncHandler(log_queue)
+        args = ["eggs"]
+        original = make_record(args=(args,))
+
+        handler.handle(original)
+        args.append("ham")
+
+        record = log_queue.get()
+        assert record.getMessage() == "spam ['eggs']"
+        assert original.args == (args,)
+
+    def test_full_queue_drops_records(self):
+        handler = AsyncHandler(queue.Queue(maxsize=1))
+        dropped = records_dropped.get()
+
+        handler.handle(make_record())
+        handler.handle(make_record())
+
+        assert records_dropped.get() == dropped + 1
+
+
+def test_webhook_is_logged_as_json(app, client, config, capsys, mocker):
+    config["LOG_PAYLOAD_SAMPLE_RATES"] = {"INFO": 1}
+    logconfig.init_app(app)
+    mock_handler = mocker.Mock(return_value={"spam": "eggs"})
+    mocker.patch(
+        "chess_server.intents.handlers",
+        {"spam": Handler(action="spam", func=mock_handler)},
+    )
+    req_data = get_dummy_webhook_request_for_google(action="spam")
+
+    client.post("/webhook", json=req_data)
+    logconfig.stop()
+
+    output = capsys.readouterr().out
+    entries = [json.loads(line) for line in output.splitlines()]
+    request, response = [
+        entry for entry in entries if entry["logger"] == "chess_server.routes"
+    ]
+    assert request["message"] == "Webhook request"
+    assert request["action"] == "spam"
+    assert (
+        request["payload"]["originalDetectIntentRequest"]["payload"]["user"][
+            "userId"
+        ]
+        == REDACTED
+    )
+    assert response["payload"] == {"spam": "eggs"}
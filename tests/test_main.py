@@ -2,6 +2,7 @@ import random
 from unittest import TestCase, mock
 
 import chess
+import pytest
 from flask import url_for
 
 from chess_server.main import (
@@ -17,11 +18,19 @@ from chess_server.main import (
     get_result_comment,
     start_game_and_get_response,
 )
-from chess_server.utils import User, Image, BasicCard, create_user, get_user
+from chess_server.utils import (
+    BasicCard,
+    ConcurrentUpdateError,
+    Image,
+    User,
+    create_user,
+    get_user,
+)
 from tests.utils import (
     GoogleOptionsList,
     GoogleWebhookResponse,
     get_dummy_webhook_request_for_google,
+    get_intent_call,
     get_random_session_id,
 )
 
@@ -303,7 +312,7 @@ class TestWelcome:
             action="welcome",
             parameters={"color": color},
         )
-        value = welcome(req_data)
+        value = welcome(get_intent_call(req_data))
 
         assert value == self.result
         mock_start_game.assert_called_once_with(self.session_id, color)
@@ -319,7 +328,7 @@ class TestWelcome:
             action="welcome",
             parameters={"color": ""},
         )
-        value = welcome(req_data)
+        value = welcome(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_response.assert_called()
@@ -348,7 +357,7 @@ class TestChooseColor:
             queryText="actions_intent_OPTION",
             option=("chosen_key", "title of that key"),
         )
-        value = choose_color(req_data)
+        value = choose_color(get_intent_call(req_data))
 
         assert value == self.result
         mock_start_game.assert_called_with(self.session_id, chosen_key)
@@ -395,7 +404,7 @@ class TestTwoSquares:
             queryText="rook from a1 to b5",
             parameters=params,
         )
-        value = two_squares(req_data)
+        value = two_squares(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_user.assert_called_with(self.session_id)
@@ -440,7 +449,7 @@ class TestTwoSquares:
             queryText="Pawn from e2 to e4",
             parameters=params,
         )
-        value = two_squares(req_data)
+        value = two_squares(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_user.assert_called_with(self.session_id)
@@ -468,6 +477,8 @@ class TestTwoSquares:
             "chess_server.main.get_user", return_value=user
         )
         mock_del_user = mocker.patch("chess_server.main.delete_user")
+        mock_archive_game = mocker.patch("chess_server.main.archive_game")
+        mocker.patch("chess_server.main.get_started_at", return_value=None)
         mock_two_squares_to_lan = mocker.patch(
             "chess_server.main.two_squares_and_piece_to_lan",
             return_value=move_lan,
@@ -497,10 +508,11 @@ class TestTwoSquares:
             queryText="Pawn from e2 to e4",
             parameters=params,
         )
-        value = two_squares(req_data)
+        value = two_squares(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_user.assert_called_with(self.session_id)
+        mock_archive_game.assert_called()
         mock_del_user.assert_called_with(self.session_id)
         mock_two_squares_to_lan.assert_called_with(
             board=user.board, squares=squares, piece=piece
@@ -510,7 +522,9 @@ class TestTwoSquares:
             session_id=self.session_id, lan=move_lan
         )
         mock_play_engine.assert_not_called()
-        mock_save_board_image.assert_called_with(self.session_id)
+        mock_save_board_image.assert_called_with(
+            self.session_id, replay=True
+        )
         mock_get_response.assert_called_with(
             textToSpeech=self.result_win,
             expectUserResponse=False,
@@ -528,6 +542,8 @@ class TestTwoSquares:
             "chess_server.main.get_user", return_value=user
         )
         mock_del_user = mocker.patch("chess_server.main.delete_user")
+        mock_archive_game = mocker.patch("chess_server.main.archive_game")
+        mocker.patch("chess_server.main.get_started_at", return_value=None)
         mock_two_squares_to_lan = mocker.patch(
             "chess_server.main.two_squares_and_piece_to_lan",
             return_value=move_lan,
@@ -557,10 +573,11 @@ class TestTwoSquares:
             queryText="Pawn from e2 to e4",
             parameters=params,
         )
-        value = two_squares(req_data)
+        value = two_squares(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_user.assert_called_with(self.session_id)
+        mock_archive_game.assert_called()
         mock_del_user.assert_called_with(self.session_id)
         mock_two_squares_to_lan.assert_called_with(
             board=user.board, squares=squares, piece=piece
@@ -570,7 +587,9 @@ class TestTwoSquares:
             session_id=self.session_id, lan=move_lan
         )
         mock_play_engine.assert_called_with(self.session_id)
-        mock_save_board_image.assert_called_with(self.session_id)
+        mock_save_board_image.assert_called_with(
+            self.session_id, replay=True
+        )
         mock_get_response.assert_called_with(
             textToSpeech=f"spam ham and eggs. {self.result_lose}",
             expectUserResponse=False,
@@ -614,7 +633,7 @@ class TestTwoSquares:
             queryText="Pawn from D2 to D4",
             parameters=params,
         )
-        value = two_squares(req_data)
+        value = two_squares(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_user.assert_called_with(self.session_id)
@@ -673,7 +692,7 @@ class TestCastle:
             queryText=queryText,
             parameters={},
         )
-        value = castle(req_data)
+        value = castle(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_user.assert_called_with(self.session_id)
@@ -718,7 +737,7 @@ class TestCastle:
             queryText=queryText,
             parameters={},
         )
-        value = castle(req_data)
+        value = castle(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_user.assert_called_with(self.session_id)
@@ -744,6 +763,8 @@ class TestCastle:
             "chess_server.main.get_user", return_value=user
         )
         mock_del_user = mocker.patch("chess_server.main.delete_user")
+        mock_archive_game = mocker.patch("chess_server.main.archive_game")
+        mocker.patch("chess_server.main.get_started_at", return_value=None)
         mock_process_castle = mocker.patch(
             "chess_server.main.process_castle_by_querytext",
             return_value=move_lan,
@@ -773,10 +794,11 @@ class TestCastle:
             queryText=queryText,
             parameters={},
         )
-        value = castle(req_data)
+        value = castle(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_user.assert_called_with(self.session_id)
+        mock_archive_game.assert_called()
         mock_del_user.assert_called_with(self.session_id)
         mock_process_castle.assert_called_with(
             board=user.board, queryText=queryText
@@ -786,7 +808,9 @@ class TestCastle:
             session_id=self.session_id, lan=move_lan
         )
         mock_play_engine.assert_not_called()
-        mock_save_board_image.assert_called_with(self.session_id)
+        mock_save_board_image.assert_called_with(
+            self.session_id, replay=True
+        )
         mock_get_response.assert_called_with(
             textToSpeech=self.result_win,
             expectUserResponse=False,
@@ -802,6 +826,8 @@ class TestCastle:
             "chess_server.main.get_user", return_value=user
         )
         mock_del_user = mocker.patch("chess_server.main.delete_user")
+        mock_archive_game = mocker.patch("chess_server.main.archive_game")
+        mocker.patch("chess_server.main.get_started_at", return_value=None)
         mock_process_castle = mocker.patch(
             "chess_server.main.process_castle_by_querytext",
             return_value=move_lan,
@@ -831,10 +857,11 @@ class TestCastle:
             queryText=queryText,
             parameters={},
         )
-        value = castle(req_data)
+        value = castle(get_intent_call(req_data))
 
         assert value == self.result
         mock_get_user.assert_called_with(self.session_id)
+        mock_archive_game.assert_called()
         mock_del_user.assert_called_with(self.session_id)
         mock_process_castle.assert_called_with(
             board=user.board, queryText=queryText
@@ -844,7 +871,9 @@ class TestCastle:
             session_id=self.session_id, lan=move_lan
         )
         mock_play_engine.assert_called_with(self.session_id)
-        mock_save_board_image.assert_called_with(self.session_id)
+        mock_save_board_image.assert_called_with(
+            self.session_id, replay=True
+        )
         mock_get_response.assert_called_with(
             textToSpeech=f"spam ham and eggs. {self.result_lose}",
             expectUserResponse=False,
@@ -879,7 +908,7 @@ class TestSimplySAN:
             queryText=san,
             parameters={"san": san},
         )
-        value = simply_san(req_data)
+        value = simply_san(get_intent_call(req_data))
 
         assert value == self.result
         assert "ambiguous" in mock_get_response.call_args[1]["textToSpeech"]
@@ -904,7 +933,7 @@ class TestSimplySAN:
             queryText=san,
             parameters={"san": san},
         )
-        value = simply_san(req_data)
+        value = simply_san(get_intent_call(req_data))
 
         assert value == self.result
         assert "not legal" in mock_get_response.call_args[1]["textToSpeech"]
@@ -929,7 +958,7 @@ class TestSimplySAN:
             queryText=san,
             parameters={"san": san},
         )
-        value = simply_san(req_data)
+        value = simply_san(get_intent_call(req_data))
 
         assert value == self.result
         assert "not valid" in mock_get_response.call_args[1]["textToSpeech"]
@@ -960,7 +989,7 @@ class TestSimplySAN:
             queryText=san,
             parameters={"san": san},
         )
-        value = simply_san(req_data)
+        value = simply_san(get_intent_call(req_data))
 
         assert value == self.result
         assert mock_get_response.call_args[1]["textToSpeech"].startswith(
@@ -993,7 +1022,7 @@ class TestSimplySAN:
             queryText=san,
             parameters={"san": san},
         )
-        value = simply_san(req_data)
+        value = simply_san(get_intent_call(req_data))
 
         assert value == self.result
         assert mock_get_response.call_args[1]["textToSpeech"].startswith(
@@ -1031,7 +1060,7 @@ class TestPieceAndSquare:
             queryText=querytext,
             parameters=params,
         )
-        value = piece_and_square(req_data)
+        value = piece_and_square(get_intent_call(req_data))
 
         assert value == self.result
         assert "ambiguous" in mock_get_response.call_args[1]["textToSpeech"]
@@ -1057,7 +1086,7 @@ class TestPieceAndSquare:
             queryText=querytext,
             parameters=params,
         )
-        value = piece_and_square(req_data)
+        value = piece_and_square(get_intent_call(req_data))
 
         assert value == self.result
         assert "not legal" in mock_get_response.call_args[1]["textToSpeech"]
@@ -1090,7 +1119,7 @@ class TestPieceAndSquare:
             queryText=querytext,
             parameters=params,
         )
-        value = piece_and_square(req_data)
+        value = piece_and_square(get_intent_call(req_data))
 
         assert value == self.result
         assert mock_get_response.call_args[1]["textToSpeech"].startswith(
@@ -1124,7 +1153,7 @@ class TestPieceAndSquare:
             queryText=querytext,
             parameters=params,
         )
-        value = piece_and_square(req_data)
+        value = piece_and_square(get_intent_call(req_data))
 
         assert value == self.result
         assert mock_get_response.call_args[1]["textToSpeech"]
@@ -1158,7 +1187,7 @@ class TestPieceAndSquare:
             queryText=querytext,
             parameters=params,
         )
-        value = piece_and_square(req_data)
+        value = piece_and_square(get_intent_call(req_data))
 
         assert value == self.result
         assert mock_get_response.call_args[1]["textToSpeech"].startswith(
@@ -1189,7 +1218,7 @@ class TestPieceAndSquare:
             queryText=querytext,
             parameters=params,
         )
-        value = piece_and_square(req_data)
+        value = piece_and_square(get_intent_call(req_data))
 
         assert value == self.result
         assert (
@@ -1214,6 +1243,8 @@ class TestResign:
 
     def test_resign(self, context, mocker):
         mock_del_user = mocker.patch("chess_server.main.delete_user")
+        mock_archive_game = mocker.patch("chess_server.main.archive_game")
+        mocker.patch("chess_server.main.get_started_at", return_value=None)
         mock_get_response = mocker.patch(
             "chess_server.main.get_response_for_google",
             return_value=self.result,
@@ -1227,17 +1258,49 @@ class TestResign:
         req_data = get_dummy_webhook_request_for_google(
             session_id=self.session_id, action="resign", intent="resign"
         )
-        value = resign(req_data)
+        value = resign(get_intent_call(req_data))
 
         assert value == self.result
+        mock_archive_game.assert_called_with(
+            self.session_id,
+            self.user.board,
+            self.user.color,
+            result="0-1",
+            started_at=None,
+        )
         mock_del_user.assert_called_with(self.session_id)
-        mock_save_board_image.assert_called_with(self.session_id)
+        mock_save_board_image.assert_called_with(
+            self.session_id, replay=True
+        )
         mock_get_response.assert_called_with(
             textToSpeech=mocker.ANY,
             expectUserResponse=False,
             basicCard=self.card,
         )
 
+    def test_resign_conflict_does_not_archive(self, context, mocker):
+        mocker.patch(
+            "chess_server.main.delete_user",
+            side_effect=ConcurrentUpdateError,
+        )
+        mock_archive_game = mocker.patch("chess_server.main.archive_game")
+        mocker.patch("chess_server.main.get_started_at", return_value=None)
+        mocker.patch("chess_server.main.get_user", return_value=self.user)
+        mocker.patch(
+            "chess_server.main.save_board_as_png_and_get_image_card",
+            return_value=self.card,
+        )
+
+        req_data = get_dummy_webhook_request_for_google(
+            session_id=self.session_id, action="resign", intent="resign"
+        )
+
+        with pytest.raises(ConcurrentUpdateError):
+            resign(get_intent_call(req_data))
+
+        # Archived by the retry once the delete succeeds
+        mock_archive_game.assert_not_called()
+
 
 class TestShowBoard:
     def setup_method(self):
@@ -1263,7 +1326,7 @@ class TestShowBoard:
         req_data = get_dummy_webhook_request_for_google(
             session_id=self.session_id, action="show_board"
         )
-        value = show_board(req_data)
+        value = show_board(get_intent_call(req_data))
 
         assert value == self.result
         mock_save_board_and_get_card.assert_called_with(self.session_id)
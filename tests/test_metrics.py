@@ -0,0 +1,210 @@
+import json
+import os
+
+import pytest
+
+from chess_server.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsDir,
+    collect,
+    counter,
+    gauge,
+    get_process_id,
+    is_process_alive,
+    merge_snapshots,
+    registry,
+    render_text,
+)
+
+
+def test_counter():
+    c = Counter("test_total", "Test counter", ("action",))
+
+    c.inc(action="undo")
+    c.inc(2, action="undo")
+    c.inc(action="resign")
+
+    assert c.get(action="undo") == 3
+    assert c.get(action="resign") == 1
+    assert c.get(action="welcome") == 0
+
+
+def test_counter_wrong_labels():
+    c = Counter("test_total", "Test counter", ("action",))
+
+    with pytest.raises(ValueError):
+        c.inc(session="spam")
+
+
+def test_gauge():
+    g = Gauge("test_gauge", "Test gauge")
+
+    g.set(5)
+    g.dec(2)
+
+    assert g.get() == 3
+
+
+def test_histogram():
+    h = Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.0))
+
+    for value in (0.05, 0.5, 0.7, 3.0):
+        h.observe(value)
+
+    assert h.values[()] == ([1, 2, 1], pytest.approx(4.25))
+    assert h.count() == 4
+
+    with h.time():
+        pass
+
+    assert h.count() == 5
+
+
+def test_registry_returns_same_metric():
+    assert counter("spam_total", "Spam") is counter("spam_total", "Spam")
+
+
+def test_render_text():
+    c = Counter("spam_total", "Spam", ("action",))
+    c.inc(action='say "hi"')
+    h = Histogram("spam_seconds", "Spam time", buckets=(0.1, 1.0))
+    h.observe(0.05)
+    h.observe(0.5)
+    h.observe(3)
+
+    text = render_text(
+        {"spam_total": c.snapshot(), "spam_seconds": h.snapshot()}
+    )
+
+    assert text.splitlines() == [
+        "# HELP spam_seconds Spam time",
+        "# TYPE spam_seconds histogram",
+        'spam_seconds_bucket{le="0.1"} 1',
+        'spam_seconds_bucket{le="1"} 2',
+        'spam_seconds_bucket{le="+Inf"} 3',
+        "spam_seconds_sum 3.55",
+        "spam_seconds_count 3",
+        "# HELP spam_total Spam",
+        "# TYPE spam_total counter",
+        'spam_total{action="say \\"hi\\""} 1',
+    ]
+
+
+def test_merge_snapshots():
+    first = Histogram("spam_seconds", "Spam", ("action",), buckets=(1.0,))
+    second = Histogram("spam_seconds", "Spam", ("action",), buckets=(1.0,))
+    first.observe(0.5, action="undo")
+    second.observe(2, action="undo")
+    second.observe(2, action="resign")
+
+    merged = merge_snapshots(
+        [
+            {"spam_seconds": first.snapshot()},
+            {"spam_seconds": second.snapshot()},
+        ]
+    )
+
+    assert sorted(merged["spam_seconds"]["values"]) == [
+        [["resign"], [[0, 1], 2]],
+        [["undo"], [[1, 1], 2.5]],
+    ]
+
+
+def test_collected_gauge(mocker):
+    mocker.patch.dict(registry, clear=True)
+    gauge("spam_sessions", "Spam", collect=lambda: 7)
+    gauge("eggs_sessions", "Eggs", collect=mocker.Mock(side_effect=OSError))
+
+    assert collect()["spam_sessions"]["values"] == [[[], 7]]
+    assert "eggs_sessions" not in collect()
+
+
+class TestMetricsDir:
+    @pytest.fixture(autouse=True)
+    def setup_dir(self, app, config, tmpdir, mocker):
+        config["METRICS_DIR"] = str(tmpdir)
+        config["METRICS_FLUSH_INTERVAL"] = 0
+        mocker.patch.dict(registry, clear=True)
+        self.path = str(tmpdir)
+        self.metrics_dir = MetricsDir()
+        self.metrics_dir.init_app(app)
+
+    def write_snapshot(self, pid, value):
+        c = Counter("spam_total", "Spam")
+        g = Gauge("spam_pending", "Spam")
+        c.inc(value)
+        g.set(value)
+        snapshot = {"spam_total": c.snapshot(), "spam_pending": g.snapshot()}
+
+        with open(os.path.join(self.path, f"{pid}.json"), "w") as f:
+            json.dump(snapshot, f)
+
+    def test_render_adds_up_workers(self, mocker):
+        counter("spam_total", "Spam").inc(1)
+        gauge("spam_pending", "Spam").set(1)
+        self.write_snapshot("101-1", 10)
+        self.write_snapshot("102-1", 100)
+        mocker.patch("chess_server.metrics.get_start_time", return_value="1")
+        mocker.patch(
+            "chess_server.metrics.is_alive", side_effect=lambda pid: pid == 101
+        )
+
+        text = self.metrics_dir.render()
+
+        # Gauges of workers which exited are dropped, counters are kept
+        assert "spam_total 111" in text
+        assert "spam_pending 11" in text
+        assert os.path.exists(
+            os.path.join(self.path, f"{get_process_id(os.getpid())}.json")
+        )
+
+        # Also on later scrapes, once the worker is in dead.json
+        text = self.metrics_dir.render()
+        assert "spam_total 111" in text
+        assert "spam_pending 11" in text
+
+    def test_exited_workers_are_aggregated(self, mocker):
+        self.write_snapshot(101, 10)
+        self.write_snapshot(102, 100)
+        mocker.patch("chess_server.metrics.is_alive", return_value=False)
+
+        self.metrics_dir.read()
+        self.write_snapshot(103, 1000)
+        snapshots = self.metrics_dir.read()
+
+        assert sorted(os.listdir(self.path)) == [".lock", "dead.json"]
+        (dead,) = snapshots
+        assert dead["spam_total"]["values"] == [[[], 1110]]
+        assert "spam_pending" not in dead
+
+    def test_reused_pid(self, mocker):
+        # An exited worker which had the pid of this process
+        self.write_snapshot(f"{os.getpid()}-1", 10)
+        mocker.patch("chess_server.metrics.get_start_time", return_value="2")
+
+        text = self.metrics_dir.render()
+
+        assert "spam_total 10" in text
+        assert "spam_pending" not in text
+        assert not os.path.exists(
+            os.path.join(self.path, f"{os.getpid()}-1.json")
+        )
+
+    def test_snapshot_without_start_time(self, mocker):
+        mocker.patch("chess_server.metrics.is_alive", return_value=True)
+        get_start_time = mocker.patch("chess_server.metrics.get_start_time")
+
+        # Written where /proc is missing
+        get_start_time.return_value = None
+        assert is_process_alive("101")
+
+        get_start_time.return_value = "1"
+        assert not is_process_alive("101")
+
+    def test_unreadable_snapshot_is_skipped(self):
+        with open(os.path.join(self.path, "101.json"), "w") as f:
+            f.write("{")
+
+        assert self.metrics_dir.read() == []
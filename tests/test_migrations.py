@@ -0,0 +1,40 @@
+import pickle
+
+import chess
+
+from chess_server import db
+from chess_server.migrations import upgrade_user_table
+from chess_server.models import UserModel
+
+
+def test_upgrade_user_table(context):
+    # The table as it was before sessions were timestamped and versioned
+    db.drop_all()
+    db.engine.execute(
+        "CREATE TABLE user_model (session_id VARCHAR(128) PRIMARY KEY, "
+        "board BLOB NOT NULL, color BOOLEAN NOT NULL)"
+    )
+    db.engine.execute(
+        "INSERT INTO user_model VALUES (?, ?, ?)",
+        "spam",
+        pickle.dumps(chess.Board()),
+        True,
+    )
+
+    steps = upgrade_user_table()
+
+    assert len(steps) == 5
+    user = UserModel.query.get("spam")
+    assert user.version == 1
+    assert user.last_active_at is not None
+    assert user.created_at is None
+
+    user.color = False
+    db.session.commit()
+    assert user.version == 2
+
+    assert upgrade_user_table() == []
+
+
+def test_upgrade_current_table(context):
+    assert upgrade_user_table() == []
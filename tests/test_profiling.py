@@ -0,0 +1,147 @@
+import os
+import pstats
+import sys
+import time
+
+import pytest
+
+from chess_server.intents import Handler
+from chess_server.profiling import (
+    Profiler,
+    ProfileStore,
+    StackSampler,
+    collapse_stack,
+    make_profile_token,
+    profiler,
+    read_profile_token,
+)
+from tests.utils import get_dummy_webhook_request_for_google
+
+
+def slow_handler(req):
+    deadline = time.perf_counter() + 0.05
+    while time.perf_counter() < deadline:
+        pass
+
+    return {}
+
+
+@pytest.mark.usefixtures("context")
+class TestProfileToken:
+    def test_token(self):
+        assert read_profile_token(make_profile_token("sample")) == "sample"
+        assert read_profile_token("spam") is None
+
+        with pytest.raises(ValueError):
+            make_profile_token("spam")
+
+    def test_expired_token(self, config):
+        token = make_profile_token()
+        config["PROFILE_TOKEN_MAX_AGE"] = -1
+
+        assert read_profile_token(token) is None
+
+
+def test_collapse_stack():
+    stack = collapse_stack(sys._getframe())
+
+    assert stack.endswith(";test_profiling.py:test_collapse_stack")
+
+
+def test_stack_sampler():
+    sampler = StackSampler(0.001)
+    sampler.start()
+    slow_handler(None)
+    sampler.stop()
+
+    stacks = sampler.take()
+    assert any("slow_handler" in stack for stack in stacks)
+    assert sampler.take() == {}
+
+
+def test_profile_store_keeps_newest(tmpdir):
+    store = ProfileStore(str(tmpdir), max_files=2)
+
+    names = [store.save(f"{i}.pstats", b"spam") for i in range(3)]
+
+    assert [p["name"] for p in store.list()] == names[:0:-1]
+    assert store.get_path(names[0]) is None
+    assert store.get_path("../spam.pstats") is None
+
+
+class TestProfiledRequests:
+    @pytest.fixture(autouse=True)
+    def setup_handler(self, app, mocker):
+        mocker.patch.dict(
+            "chess_server.intents.handlers",
+            {"spam": Handler("spam", slow_handler)},
+        )
+
+    def post(self, client, token):
+        req = get_dummy_webhook_request_for_google(action="spam")
+        return client.post("/webhook", json=req, headers={"X-Profile": token})
+
+    def test_cprofile(self, client):
+        resp = self.post(client, make_profile_token("cprofile"))
+
+        name = resp.headers["X-Profile-Name"]
+        assert name.endswith("-webhook_bp.webhook.pstats")
+        stats = pstats.Stats(profiler.store.get_path(name))
+        assert any(func[2] == "slow_handler" for func in stats.stats)
+
+    def test_sample(self, client, config):
+        config["PROFILE_SAMPLE_INTERVAL"] = 0.001
+
+        resp = self.post(client, make_profile_token("sample"))
+
+        name = resp.headers["X-Profile-Name"]
+        with open(profiler.store.get_path(name)) as f:
+            assert "test_profiling.py:slow_handler" in f.read()
+
+    def test_invalid_token(self, client):
+        resp = self.post(client, "spam")
+
+        assert "X-Profile-Name" not in resp.headers
+
+
+def test_always_on_sampler(app, config):
+    config["PROFILE_SAMPLER_INTERVAL"] = 0.001
+    config["PROFILE_SAMPLER_FLUSH_INTERVAL"] = 60
+    always_on = Profiler()
+    always_on.init_app(app)
+
+    slow_handler(None)
+    always_on.stop()
+
+    (profile,) = always_on.store.list()
+    assert profile["name"].endswith(f"-{os.getpid()}-sampler.collapsed")
+
+
+class TestAdminProfiles:
+    @pytest.fixture(autouse=True)
+    def setup_profiles(self, app, config):
+        config["ADMIN_TOKEN"] = "spam"
+        self.headers = {"Authorization": "Bearer spam"}
+        self.name = profiler.store.save("eggs.collapsed", b"a;b 1\n")
+
+    def test_list_profiles(self, client):
+        resp = client.get("/admin/profiles", headers=self.headers)
+
+        (profile,) = resp.get_json()["profiles"]
+        assert profile["name"] == self.name
+        assert profile["size"] == 6
+
+    def test_get_profile(self, client):
+        resp = client.get(f"/admin/profiles/{self.name}", headers=self.headers)
+
+        assert resp.data == b"a;b 1\n"
+
+        resp = client.get("/admin/profiles/ham.pstats", headers=self.headers)
+        assert resp.status_code == 404
+
+    def test_admin_token(self, client, config):
+        assert client.get("/admin/profiles").status_code == 401
+
+        config["ADMIN_TOKEN"] = None
+        resp = client.get("/admin/profiles", headers=self.headers)
+        assert resp.status_code == 404
@@ -0,0 +1,113 @@
+import fcntl
+import os
+import time
+from datetime import datetime, timedelta
+
+import chess
+
+from chess_server import db
+from chess_server.models import UserModel
+from chess_server.reaper import (
+    ReapResult,
+    bytes_reaped,
+    reap_expired_sessions,
+    session_reaper,
+    sweep_stale_images,
+)
+from chess_server.storage import atomic_write, image_path, iter_files
+from chess_server.utils import create_user, exists_in_db
+from tests.utils import get_random_session_id
+
+
+def list_images(img_dir):
+    return [
+        entry.name
+        for entry in iter_files(img_dir)
+        if entry.name.endswith(".png")
+    ]
+
+
+class TestReapExpiredSessions:
+    def setup_method(self):
+        self.expired = [get_random_session_id() for _ in range(5)]
+        self.active = get_random_session_id()
+
+    def create_sessions(self):
+        for session_id in self.expired + [self.active]:
+            create_user(session_id, chess.Board(), chess.WHITE)
+
+        UserModel.query.filter(
+            UserModel.session_id.in_(self.expired)
+        ).update(
+            {"last_active_at": datetime.utcnow() - timedelta(days=2)},
+            synchronize_session=False,
+        )
+        db.session.commit()
+
+    def test_reap_expired_sessions(self, config, context):
+        self.create_sessions()
+        stale = image_path(config["IMG_DIR"], "stale", "png")
+        atomic_write(stale, b"0123456789")
+        two_days_ago = time.time() - 2 * 86400
+        os.utime(stale, (two_days_ago, two_days_ago))
+        reclaimed = bytes_reaped.get()
+
+        result = reap_expired_sessions(ttl=3600, batch_size=2, batch_delay=0)
+
+        assert result == ReapResult(rows=5, files=1, bytes=10)
+        assert bytes_reaped.get() == reclaimed + 10
+        assert exists_in_db(self.active)
+        assert list_images(config["IMG_DIR"]) == []
+
+        for session_id in self.expired:
+            assert not exists_in_db(session_id)
+
+    def test_reap_expired_sessions_max_batches(self, context):
+        self.create_sessions()
+
+        result = reap_expired_sessions(
+            ttl=3600, batch_size=2, max_batches=2, batch_delay=0
+        )
+
+        assert result.rows == 4
+        assert UserModel.query.count() == 2
+
+
+def test_sweep_stale_images(config, context):
+    img_dir = config["IMG_DIR"]
+    old = image_path(img_dir, "old", "png")
+    new = image_path(img_dir, "new", "png")
+    flat = os.path.join(img_dir, "flat.png")
+    tmp = os.path.join(os.path.dirname(old), ".abc.tmp")
+
+    for path in (old, new, flat, tmp):
+        atomic_write(path, b"spam")
+
+    an_hour_ago = time.time() - 3600
+    for path in (old, flat, tmp):
+        os.utime(path, (an_hour_ago, an_hour_ago))
+
+    assert sweep_stale_images(ttl=60, limit=10) == ReapResult(
+        files=3, bytes=12
+    )
+    assert list_images(img_dir) == ["new.png"]
+    assert not os.path.exists(tmp)
+
+
+def test_reaper_takes_turns(context):
+    assert session_reaper.run_once() == ReapResult()
+
+    with open(session_reaper.lock_path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        assert session_reaper.run_once() is None
+
+
+def test_sweep_keeps_reaper_lock(context):
+    with open(session_reaper.lock_path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        an_hour_ago = time.time() - 3600
+        os.utime(session_reaper.lock_path, (an_hour_ago, an_hour_ago))
+
+        assert sweep_stale_images(ttl=60, limit=10) == ReapResult()
+        assert os.path.samefile(session_reaper.lock_path, lock.fileno())
@@ -0,0 +1,346 @@
+import io
+import os
+
+import chess
+import chess.svg
+import pytest
+from PIL import Image, ImageChops
+
+from chess_server.render import (
+    BoardSpec,
+    RenderCache,
+    SpriteRenderer,
+    cache_bytes_saved,
+    cache_lookups,
+    convert_png,
+    render_image,
+    render_png,
+)
+
+
+class TestBoardSpec:
+    def test_from_board(self):
+        board = chess.Board()
+        board.push_san("Nf3")
+
+        spec = BoardSpec.from_board(board, flipped=True, size=200)
+
+        assert spec == BoardSpec(board.board_fen(), "g1f3", True, 200, None)
+
+    def test_key_depends_on_every_field(self):
+        spec = BoardSpec(chess.STARTING_BOARD_FEN)
+        variants = [
+            spec._replace(lastmove="e2e4"),
+            spec._replace(flipped=True),
+            spec._replace(size=200),
+            spec._replace(style="rect { fill: red; }"),
+            spec._replace(format="webp"),
+        ]
+
+        keys = {spec.key} | {variant.key for variant in variants}
+
+        assert len(keys) == 6
+        assert BoardSpec(chess.STARTING_BOARD_FEN).key == spec.key
+
+    def test_to_svg(self):
+        board = chess.Board()
+        board.push_san("e4")
+
+        spec = BoardSpec.from_board(board, flipped=True)
+
+        assert spec.to_svg() == str(
+            chess.svg.board(board, lastmove=board.peek(), flipped=True)
+        )
+
+
+class TestRenderCache:
+    def setup_method(self):
+        self.specs = [
+            BoardSpec(chess.STARTING_BOARD_FEN, size=size)
+            for size in (100, 200, 300)
+        ]
+
+    def get_cache(self, app, memory_bytes=1024, disk_bytes=1024):
+        app.config["RENDER_CACHE_MEMORY_BYTES"] = memory_bytes
+        app.config["RENDER_CACHE_DISK_BYTES"] = disk_bytes
+
+        cache = RenderCache()
+        cache.init_app(app)
+        return cache
+
+    def test_memory_hit(self, app, mocker):
+        mock_render = mocker.patch(
+            "chess_server.render.render_png", return_value=b"x" * 10
+        )
+        cache = self.get_cache(app)
+        hits = cache_lookups.get(tier="memory")
+        saved = cache_bytes_saved.get()
+
+        assert cache.get_image(self.specs[0]) == b"x" * 10
+        assert cache.get_image(self.specs[0]) == b"x" * 10
+
+        mock_render.assert_called_once_with(self.specs[0], "svg")
+        assert cache_lookups.get(tier="memory") == hits + 1
+        assert cache_bytes_saved.get() == saved + 10
+
+    def test_disk_hit(self, app, mocker):
+        mock_render = mocker.patch(
+            "chess_server.render.render_png", return_value=b"x" * 10
+        )
+        cache = self.get_cache(app)
+        cache.get_image(self.specs[0])
+
+        # Another worker process has an empty memory tier
+        cache.memory.clear()
+        hits = cache_lookups.get(tier="disk")
+
+        assert cache.get_image(self.specs[0]) == b"x" * 10
+        mock_render.assert_called_once()
+        assert cache_lookups.get(tier="disk") == hits + 1
+
+    def test_memory_eviction(self, app, mocker):
+        mocker.patch("chess_server.render.render_png", return_value=b"x" * 10)
+        cache = self.get_cache(app, memory_bytes=25, disk_bytes=0)
+
+        for spec in self.specs:
+            cache.get_image(spec)
+
+        assert list(cache.memory) == [spec.key for spec in self.specs[1:]]
+        assert cache.memory_bytes == 20
+
+    def test_disk_eviction(self, app, mocker):
+        mocker.patch("chess_server.render.render_png", return_value=b"x" * 10)
+        cache = self.get_cache(app, disk_bytes=25)
+
+        for i, spec in enumerate(self.specs):
+            cache.get_image(spec)
+            os.utime(cache.disk_path(spec.key), (i, i))
+
+        assert not os.path.exists(cache.disk_path(self.specs[0].key))
+        assert os.path.exists(cache.disk_path(self.specs[2].key))
+        assert cache.disk_bytes == 20
+
+    def test_disk_path_has_format(self, app, mocker):
+        mocker.patch("chess_server.render.render_png", return_value=b"png")
+        mocker.patch("chess_server.render.convert_png", return_value=b"webp")
+        cache = self.get_cache(app)
+        spec = self.specs[0]._replace(format="webp")
+
+        cache.get_image(spec)
+        cache.memory.clear()
+
+        assert cache.disk_path(spec.key, "webp").endswith(".webp")
+        assert os.path.exists(cache.disk_path(spec.key, "webp"))
+        assert cache.lookup(spec) == b"webp"
+
+    def test_lookups_do_not_wait_for_disk_eviction(self, app, mocker):
+        mocker.patch("chess_server.render.render_png", return_value=b"x" * 10)
+        cache = self.get_cache(app)
+        cache.get_image(self.specs[0])
+
+        # Held while another thread scans and evicts the disk tier
+        with cache._disk_lock:
+            assert cache.lookup(self.specs[0]) == b"x" * 10
+
+    def test_sprite_backend_is_warmed_up(self, app, mocker):
+        mock_get_renderer = mocker.patch(
+            "chess_server.render.get_sprite_renderer"
+        )
+        app.config["BOARD_RENDERER"] = "sprite"
+        app.config["BOARD_IMAGE_SIZE"] = 200
+        mocker.patch.dict(
+            app.config["IMAGE_SIZES"],
+            {"small": 120, "medium": 200, "large": 200},
+        )
+
+        cache = self.get_cache(app)
+
+        assert cache.backend == "sprite"
+        # Every variant size too, only once each
+        assert mock_get_renderer.call_args_list == [
+            mocker.call(120, None),
+            mocker.call(200, None),
+        ]
+
+
+BACKGROUND = (10, 10, 10, 255)
+HIGHLIGHT = (0, 200, 0, 255)
+WHITE_PAWN = (255, 255, 255, 255)
+BLACK_KING = (0, 0, 255, 255)
+
+
+def fake_rasterise(svg):
+    """Solid image standing in for each layer rasterised by cairosvg"""
+    if "<rect" not in svg:
+        color = WHITE_PAWN if "#white-pawn" in svg else BLACK_KING
+    elif "lastmove" in svg:
+        color = HIGHLIGHT
+    else:
+        color = BACKGROUND
+
+    return Image.new("RGBA", (390, 390), color)
+
+
+class TestSpriteRenderer:
+    @pytest.fixture
+    def renderer(self, mocker):
+        mocker.patch.object(
+            SpriteRenderer, "_rasterise", side_effect=fake_rasterise
+        )
+        return SpriteRenderer()
+
+    def color_at(self, renderer, image, square, flipped=False):
+        left, upper, right, lower = renderer.square_box(square, flipped)
+        return image.getpixel(((left + right) // 2, (upper + lower) // 2))
+
+    def test_layers(self, renderer):
+        assert set(renderer.backgrounds) == {False, True}
+        assert set(renderer.highlights) == {False, True}
+        assert set(renderer.pieces) == set("PNBRQKpnbrqk")
+
+    def test_square_box(self, renderer):
+        assert renderer.square_box(chess.A8, False) == (15, 15, 60, 60)
+        assert renderer.square_box(chess.H1, False) == (330, 330, 375, 375)
+        assert renderer.square_box(chess.A8, True) == (330, 330, 375, 375)
+
+    def test_square_box_scaled(self, mocker):
+        mocker.patch.object(
+            SpriteRenderer, "_rasterise", side_effect=fake_rasterise
+        )
+        renderer = SpriteRenderer(size=195)
+
+        assert renderer.square_box(chess.A8, False) == (8, 8, 30, 30)
+        assert renderer.edges[-1] == 188
+
+    def test_render(self, renderer):
+        spec = BoardSpec("8/8/8/8/4P3/8/8/k7", lastmove="e2e4")
+
+        image = Image.open(io.BytesIO(renderer.render(spec)))
+
+        assert image.size == (390, 390)
+        assert self.color_at(renderer, image, chess.E4) == WHITE_PAWN
+        assert self.color_at(renderer, image, chess.A1) == BLACK_KING
+        assert self.color_at(renderer, image, chess.E2) == HIGHLIGHT
+        assert self.color_at(renderer, image, chess.E3) == BACKGROUND
+        assert image.getpixel((5, 5)) == BACKGROUND
+
+    def test_render_flipped(self, renderer):
+        spec = BoardSpec("8/8/8/8/8/8/8/k7", flipped=True)
+
+        image = Image.open(io.BytesIO(renderer.render(spec)))
+
+        # a1 is drawn in the top right corner when flipped
+        assert image.getpixel((350, 20)) == BLACK_KING
+        assert image.getpixel((20, 350)) == BACKGROUND
+
+    def test_highlight(self):
+        svg = str(chess.svg.board(chess.BaseBoard.empty()))
+
+        highlighted = SpriteRenderer._highlight(svg)
+
+        assert highlighted.count("lastmove") == 64
+        assert chess.svg.DEFAULT_COLORS["square light"] not in highlighted
+
+
+def test_render_png_backends(mocker):
+    mock_svg2png = mocker.patch(
+        "chess_server.render.svg2png", return_value=b"png"
+    )
+    mock_get_renderer = mocker.patch(
+        "chess_server.render.get_sprite_renderer"
+    )
+    mock_get_renderer.return_value.render.return_value = b"sprite"
+    spec = BoardSpec(chess.STARTING_BOARD_FEN, size=200)
+
+    assert render_png(spec) == b"png"
+    mock_svg2png.assert_called_once_with(bytestring=spec.to_svg())
+
+    assert render_png(spec, "sprite") == b"sprite"
+    mock_get_renderer.assert_called_once_with(200, None)
+    mock_get_renderer.return_value.render.assert_called_once_with(spec)
+
+
+def has_cairo() -> bool:
+    try:
+        png = render_png(BoardSpec(chess.STARTING_BOARD_FEN, size=40))
+        Image.open(io.BytesIO(png)).load()
+    except Exception:
+        return False
+
+    return True
+
+
+@pytest.mark.skipif(not has_cairo(), reason="cairo is not available")
+@pytest.mark.parametrize(
+    "spec",
+    [
+        BoardSpec(chess.STARTING_BOARD_FEN),
+        BoardSpec(
+            "r3k2r/pP3ppp/8/3pP3/8/8/PPP2PPP/R3K2R", lastmove="d7d5"
+        ),
+        BoardSpec(
+            "r3k2r/pP3ppp/8/3pP3/8/8/PPP2PPP/R3K2R",
+            lastmove="d7d5",
+            flipped=True,
+        ),
+        BoardSpec("4k3/8/8/8/8/8/8/R3K3", lastmove="e1c1", size=240),
+        BoardSpec("4k3/8/8/8/8/8/8/R3K3", flipped=True, size=1000),
+    ],
+)
+def test_sprite_matches_svg(spec):
+    """The sprite renderer draws what cairosvg does, but for anti-aliasing
+    along the edges of the squares"""
+    svg = Image.open(io.BytesIO(render_png(spec, "svg"))).convert("RGBA")
+    sprite = Image.open(io.BytesIO(render_png(spec, "sprite"))).convert(
+        "RGBA"
+    )
+
+    assert sprite.size == svg.size
+
+    difference = ImageChops.difference(svg, sprite).convert("L")
+    histogram = difference.histogram()
+    pixels = svg.size[0] * svg.size[1]
+    off = sum(histogram[32:])
+
+    assert off / pixels < 0.005
+    assert sum(i * n for i, n in enumerate(histogram)) / pixels < 1
+
+
+class TestConvertPNG:
+    def setup_method(self):
+        # Gradient with more colours than a palette can hold
+        image = Image.new("RGB", (64, 64))
+        image.putdata(
+            [(x * 4, y * 4, 128) for y in range(64) for x in range(64)]
+        )
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+        self.png = output.getvalue()
+
+    def test_png(self):
+        assert convert_png(self.png, "png") is self.png
+
+    def test_png8(self):
+        image = Image.open(io.BytesIO(convert_png(self.png, "png8")))
+
+        assert image.format == "PNG"
+        assert image.mode == "P"
+        assert image.size == (64, 64)
+
+    def test_webp(self):
+        image = Image.open(io.BytesIO(convert_png(self.png, "webp")))
+
+        assert image.format == "WEBP"
+        assert image.size == (64, 64)
+
+    def test_unknown_format(self):
+        with pytest.raises(ValueError):
+            convert_png(self.png, "gif")
+
+    def test_render_image(self, mocker):
+        mocker.patch("chess_server.render.render_png", return_value=self.png)
+        spec = BoardSpec(chess.STARTING_BOARD_FEN, format="webp")
+
+        assert render_image(spec)[8:12] == b"WEBP"
+        assert spec.mimetype == "image/webp"
+        assert spec.extension == "webp"
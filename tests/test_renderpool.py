@@ -0,0 +1,270 @@
+import io
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import chess
+import pytest
+from flask import url_for
+from PIL import Image
+
+from chess_server.render import BoardSpec, render_cache, render_duration
+from chess_server.renderpool import inline_renders, render_pool
+from chess_server.utils import create_user, save_board_as_png
+from tests.utils import get_random_session_id
+
+
+@pytest.fixture
+def pool(app, mocker):
+    app.config["RENDER_WORKERS"] = 2
+    app.config["RENDER_QUEUE_SIZE"] = 8
+    # Threads keep the mocks visible to the "workers"
+    mocker.patch(
+        "chess_server.renderpool.ProcessPoolExecutor",
+        lambda max_workers, mp_context, **kwargs: ThreadPoolExecutor(
+            max_workers, **kwargs
+        ),
+    )
+
+    yield render_pool
+
+    render_pool.close()
+    render_pool.pending.clear()
+    render_pool._placeholders.clear()
+
+
+class GatedRender:
+    """Stands in for render_image and blocks until released"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.calls = []
+
+    def __call__(self, spec, backend="svg"):
+        self.calls.append(spec)
+        self.gate.wait(5)
+        return f"PNG {spec.board_fen}".encode()
+
+
+@pytest.mark.usefixtures("context")
+class TestRenderPool:
+    def setup_method(self):
+        self.session_id = get_random_session_id()
+        self.spec = BoardSpec(chess.STARTING_BOARD_FEN)
+
+    def test_submit(self, pool, config, mocker):
+        render = GatedRender()
+        mocker.patch("chess_server.renderpool.render_image", render)
+
+        pending = pool.submit(self.session_id, self.spec)
+
+        assert pool.get_pending(self.session_id) is pending
+        assert pool.get_pending_by_spec_key(self.spec.key) is pending
+        assert render_cache.lookup(self.spec) is None
+
+        render.gate.set()
+
+        assert pending.wait(5)
+        assert pool.get_pending(self.session_id) is None
+        assert render_cache.lookup(self.spec) == (
+            f"PNG {self.spec.board_fen}".encode()
+        )
+
+    def test_superseded_render_is_cached(self, pool, config, mocker):
+        render = GatedRender()
+        mocker.patch("chess_server.renderpool.render_image", render)
+        board = chess.Board()
+        board.push_san("e4")
+        newer = BoardSpec.from_board(board)
+
+        older_render = pool.submit(self.session_id, self.spec)
+        newer_render = pool.submit(self.session_id, newer)
+
+        assert pool.get_pending(self.session_id) is newer_render
+
+        render.gate.set()
+
+        assert older_render.wait(5) and newer_render.wait(5)
+        assert pool.get_pending(self.session_id) is None
+        assert render_cache.lookup(self.spec) is not None
+        assert render_cache.lookup(newer) is not None
+
+    def test_failed_render(self, pool, config, mocker):
+        mocker.patch(
+            "chess_server.renderpool.render_image",
+            side_effect=Exception("spam"),
+        )
+
+        pending = pool.submit(self.session_id, self.spec)
+
+        assert pending.wait(5)
+        assert pool.get_pending(self.session_id) is None
+        assert render_cache.lookup(self.spec) is None
+
+    def test_cached_position_is_done_right_away(self, pool, config, mocker):
+        mock_render = mocker.patch("chess_server.renderpool.render_image")
+        render_cache.put(self.spec, b"cached")
+
+        pending = pool.submit(self.session_id, self.spec)
+
+        assert pending.done.is_set()
+        assert pool.get_pending(self.session_id) is None
+        mock_render.assert_not_called()
+
+    def test_full_queue_renders_inline(self, pool, config, mocker):
+        config["RENDER_QUEUE_SIZE"] = 1
+        render = GatedRender()
+        mocker.patch("chess_server.renderpool.render_image", render)
+        mock_render_inline = mocker.patch(
+            "chess_server.render.render_png", return_value=b"inline"
+        )
+        inline = inline_renders.get()
+
+        queued = pool.submit(get_random_session_id(), self.spec)
+        board = chess.Board()
+        board.push_san("d4")
+        spec = BoardSpec.from_board(board)
+        pending = pool.submit(self.session_id, spec)
+
+        assert pending.done.is_set()
+        mock_render_inline.assert_called_once_with(spec, "svg")
+        assert inline_renders.get() == inline + 1
+        assert render_cache.lookup(spec) == b"inline"
+        render.gate.set()
+        assert queued.wait(5)
+
+    def test_get_image(self, pool, mocker):
+        mock_render = mocker.patch(
+            "chess_server.renderpool.render_image", return_value=b"png"
+        )
+
+        assert pool.get_image(self.spec) == b"png"
+        assert pool.get_image(self.spec) == b"png"
+        mock_render.assert_called_once_with(self.spec, "svg")
+
+    def test_get_image_full_queue_renders_inline(self, pool, config, mocker):
+        config["RENDER_QUEUE_SIZE"] = 1
+        render = GatedRender()
+        mocker.patch("chess_server.renderpool.render_image", render)
+        mocker.patch("chess_server.render.render_png", return_value=b"inline")
+        inline = inline_renders.get()
+
+        queued = pool.submit(self.session_id, self.spec)
+        board = chess.Board()
+        board.push_san("d4")
+        spec = BoardSpec.from_board(board)
+
+        assert pool.get_image(spec) == b"inline"
+        assert inline_renders.get() == inline + 1
+        assert render.calls == [self.spec]
+        render.gate.set()
+        assert queued.wait(5)
+
+    def test_broken_pool_is_replaced(self, pool, mocker):
+        mocker.patch(
+            "chess_server.renderpool.render_image", return_value=b"png"
+        )
+        broken = mocker.Mock()
+        broken.submit.side_effect = BrokenProcessPool()
+        pool._executor = broken
+
+        pending = pool.submit(self.session_id, self.spec)
+
+        assert pending.wait(5)
+        assert render_cache.lookup(self.spec) == b"png"
+        broken.shutdown.assert_called_once_with(wait=False)
+        assert pool._executor is not broken
+
+    def test_get_image_renders_inline_if_process_dies(self, pool, mocker):
+        future = Future()
+        future.set_exception(BrokenProcessPool())
+        mocker.patch.object(pool, "_submit", return_value=future)
+        mocker.patch("chess_server.render.render_png", return_value=b"inline")
+
+        assert pool.get_image(self.spec) == b"inline"
+        assert pool.waiting == 0
+
+    def test_placeholder(self, pool, config):
+        config["BOARD_IMAGE_SIZE"] = 120
+
+        image = Image.open(io.BytesIO(pool.get_placeholder()))
+        assert image.size == (120, 120)
+
+        # In the size of the variant requested
+        image = Image.open(io.BytesIO(pool.get_placeholder(64)))
+        assert image.size == (64, 64)
+
+    def test_save_board_as_png_submits_to_pool(self, pool, config, mocker):
+        mock_submit = mocker.patch.object(pool, "submit")
+        board = chess.Board()
+        spec = BoardSpec.from_board(board)
+
+        value = save_board_as_png(imgkey=self.session_id, board=board)
+
+        assert value == spec.key
+        mock_submit.assert_called_once_with(self.session_id, spec)
+
+    def test_process_pool(self, app, config):
+        config["RENDER_WORKERS"] = 1
+        renders = render_duration.count()
+
+        try:
+            pending = render_pool.submit(self.session_id, self.spec)
+            assert pending.wait(30)
+        finally:
+            render_pool.close()
+
+        assert render_cache.lookup(self.spec).startswith(b"\x89PNG")
+        # Timed in the render process, recorded here
+        assert render_duration.count() == renders + 1
+
+
+@pytest.mark.usefixtures("client_class")
+class TestPNGImagePending:
+    def setup_method(self):
+        self.session_id = get_random_session_id()
+        self.spec = BoardSpec(chess.STARTING_BOARD_FEN)
+
+    def get_url(self):
+        return url_for(
+            "webhook_bp.png_image", session_id=self.session_id, move_number=1
+        )
+
+    def test_waits_for_pending_render(self, pool, config, mocker):
+        create_user(self.session_id, chess.Board(), chess.WHITE)
+        render = GatedRender()
+        mocker.patch("chess_server.renderpool.render_image", render)
+        pool.submit(self.session_id, self.spec)
+
+        threading.Timer(0.05, render.gate.set).start()
+        r = self.client.get(self.get_url())
+
+        assert r.get_data() == f"PNG {self.spec.board_fen}".encode()
+
+    def test_placeholder_while_rendering(self, pool, config, mocker):
+        config["RENDER_WAIT_TIMEOUT"] = 0.01
+        create_user(self.session_id, chess.Board(), chess.WHITE)
+        render = GatedRender()
+        mocker.patch("chess_server.renderpool.render_image", render)
+        pending = pool.submit(self.session_id, self.spec)
+
+        r = self.client.get(self.get_url())
+        render.gate.set()
+        assert pending.wait(5)
+
+        assert r.status_code == 200
+        assert r.get_data() == pool.get_placeholder()
+        assert r.headers["Cache-Control"] == "no-store"
+
+    def test_board_image_waits_for_pending_render(self, pool, config, mocker):
+        render = GatedRender()
+        mocker.patch("chess_server.renderpool.render_image", render)
+        pool.submit(self.session_id, self.spec)
+
+        threading.Timer(0.05, render.gate.set).start()
+        r = self.client.get(
+            url_for("webhook_bp.board_image", key=self.spec.key, ext="png")
+        )
+
+        assert r.get_data() == f"PNG {self.spec.board_fen}".encode()
+        assert "immutable" in r.headers["Cache-Control"]
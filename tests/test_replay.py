@@ -0,0 +1,273 @@
+import hashlib
+import io
+import os
+import time
+
+import chess
+import pytest
+from flask import url_for
+from PIL import Image, ImageSequence
+
+from chess_server.replay import gif_frame, gif_header, replay_recorder
+from chess_server.reaper import sweep_stale_images
+from chess_server.utils import (
+    create_user,
+    save_board_as_png_and_get_image_card,
+    undo_users_last_move,
+    update_user,
+)
+from tests.utils import get_random_session_id
+
+
+def fake_render(spec, backend="svg"):
+    """Solid image with a colour of its own for every board"""
+    digest = hashlib.sha1(spec.key.encode()).digest()
+    output = io.BytesIO()
+    Image.new("RGB", (spec.size or 390,) * 2, tuple(digest[:3])).save(
+        output, "PNG"
+    )
+    return output.getvalue()
+
+
+def get_colour(spec):
+    return tuple(hashlib.sha1(spec.key.encode()).digest()[:3])
+
+
+def read_frames(data):
+    """Colour and duration of the frames of a GIF"""
+    frames = []
+    with Image.open(io.BytesIO(data)) as image:
+        for frame in ImageSequence.Iterator(image):
+            colour = frame.convert("RGB").getpixel((0, 0))
+            frames.append((colour, frame.info["duration"]))
+
+    return frames
+
+
+@pytest.fixture
+def replays(app, config, mocker):
+    config["REPLAY_ENABLED"] = True
+    config["REPLAY_IMAGE_SIZE"] = 16
+    config["REPLAY_FRAME_DURATION"] = 0.5
+    config["REPLAY_FINAL_FRAME_DURATION"] = 2
+    mocker.patch("chess_server.render.render_image", fake_render)
+
+    return replay_recorder
+
+
+def test_gif_frames_can_be_concatenated():
+    colours = ["red", "green", "blue"]
+    frames = [
+        gif_frame(Image.new("RGB", (8, 8), colour), delay=10)
+        for colour in colours
+    ]
+
+    data = gif_header(8, 8) + b"".join(frames) + b";"
+
+    assert read_frames(data) == [
+        ((255, 0, 0), 100),
+        ((0, 128, 0), 100),
+        ((0, 0, 255), 100),
+    ]
+
+
+@pytest.mark.usefixtures("context")
+class TestReplayRecorder:
+    def setup_method(self):
+        self.session_id = get_random_session_id()
+
+    def get_frames(self):
+        return read_frames(replay_recorder.read(self.session_id))
+
+    def get_colours(self, board, flipped=False):
+        specs = replay_recorder._get_specs(board, flipped)
+        return [get_colour(spec) for spec in specs]
+
+    def test_appends_frame_per_ply(self, replays, mocker):
+        board = chess.Board()
+        create_user(self.session_id, board, chess.WHITE)
+        spy = mocker.spy(replays, "_get_image")
+
+        for san in ("e4", "e5", "Nf3"):
+            board.push_san(san)
+            update_user(self.session_id, board)
+
+        frames = self.get_frames()
+        assert [colour for colour, _ in frames] == self.get_colours(board)
+        assert [duration for _, duration in frames] == [500] * 3 + [2000]
+        assert spy.call_count == 3
+
+    def test_undo_truncates(self, replays):
+        board = chess.Board()
+        create_user(self.session_id, board, chess.WHITE)
+        for san in ("e4", "e5", "Nf3", "Nc6"):
+            board.push_san(san)
+            update_user(self.session_id, board)
+        size = os.path.getsize(replays.path(self.session_id))
+
+        undo_users_last_move(self.session_id)
+        board.pop()
+        board.pop()
+
+        frames = self.get_frames()
+        assert [colour for colour, _ in frames] == self.get_colours(board)
+        assert frames[-1][1] == 2000
+        assert os.path.getsize(replays.path(self.session_id)) < size
+
+        board.push_san("d4")
+        update_user(self.session_id, board)
+
+        frames = self.get_frames()
+        assert [colour for colour, _ in frames] == self.get_colours(board)
+        assert [duration for _, duration in frames] == [500] * 3 + [2000]
+
+    def test_flipped_for_black(self, replays):
+        board = chess.Board()
+        create_user(self.session_id, board, chess.BLACK)
+
+        assert [colour for colour, _ in self.get_frames()] == (
+            self.get_colours(board, flipped=True)
+        )
+
+    def test_board_with_recent_history_only(self, replays):
+        board = chess.Board()
+        for san in ("e4", "e5", "Nf3"):
+            board.push_san(san)
+        replays.record(self.session_id, board, flipped=False)
+
+        # Like a board of STATELESS_MODE, which carries the last plies only
+        recent = chess.Board(board.fen())
+        recent.push_san("Nc6")
+        replays.record(self.session_id, recent, flipped=False)
+
+        board.push_san("Nc6")
+        assert [colour for colour, _ in self.get_frames()] == (
+            self.get_colours(board)
+        )
+
+    def test_missing_sidecar_starts_over(self, replays):
+        board = chess.Board()
+        board.push_san("e4")
+        replays.record(self.session_id, board, flipped=False)
+        os.unlink(replays.index_path(self.session_id))
+
+        board.push_san("e5")
+        replays.record(self.session_id, board, flipped=False)
+
+        assert len(self.get_frames()) == 3
+
+    def test_older_board_is_skipped(self, replays):
+        board = chess.Board()
+        board.push_san("e4")
+        older = board.copy()
+        board.push_san("e5")
+
+        replays.record(self.session_id, board, flipped=False, revision=2)
+        replays.record(self.session_id, older, flipped=False, revision=1)
+
+        assert [colour for colour, _ in self.get_frames()] == (
+            self.get_colours(board)
+        )
+
+    def test_in_background(self, replays, config, mocker):
+        config["REPLAY_IN_BACKGROUND"] = True
+        mocker.patch.object(replays, "_ensure_thread")
+        board = chess.Board()
+        create_user(self.session_id, board, chess.WHITE)
+
+        for san in ("e4", "e5"):
+            board.push_san(san)
+            update_user(self.session_id, board)
+
+        assert replays.read(self.session_id) is None
+        assert list(replays.pending) == [self.session_id]
+
+        assert replays.flush() == 1
+        assert [colour for colour, _ in self.get_frames()] == (
+            self.get_colours(board)
+        )
+
+    def test_background_thread(self, replays, config):
+        config["REPLAY_IN_BACKGROUND"] = True
+        board = chess.Board()
+        board.push_san("e4")
+
+        replays.submit(self.session_id, board, flipped=False)
+
+        for _ in range(50):
+            if not replays.pending and replays.read(self.session_id):
+                break
+            time.sleep(0.1)
+
+        assert len(self.get_frames()) == 2
+
+    def test_disabled(self, app, config):
+        config["REPLAY_ENABLED"] = False
+
+        create_user(self.session_id, chess.Board(), chess.WHITE)
+
+        assert replay_recorder.read(self.session_id) is None
+
+    def test_failure_does_not_fail_turn(self, replays, mocker):
+        mocker.patch.object(
+            replays, "record", side_effect=OSError("No space left")
+        )
+
+        create_user(self.session_id, chess.Board(), chess.WHITE)
+
+    def test_card_links_replay(self, replays):
+        create_user(self.session_id, chess.Board(), chess.WHITE)
+
+        card = save_board_as_png_and_get_image_card(
+            self.session_id, replay=True
+        )
+
+        assert card.make_dict()["buttons"] == [
+            {
+                "title": "Watch the replay",
+                "openUrlAction": {
+                    "url": url_for(
+                        "webhook_bp.replay_image",
+                        session_id=self.session_id,
+                        _external=True,
+                    )
+                },
+            }
+        ]
+
+    def test_sweep(self, replays):
+        replays.record(self.session_id, chess.Board(), flipped=False)
+        an_hour_ago = time.time() - 3600
+        for path in (
+            replays.path(self.session_id),
+            replays.index_path(self.session_id),
+        ):
+            os.utime(path, (an_hour_ago, an_hour_ago))
+
+        assert sweep_stale_images(ttl=60, limit=10).files == 2
+        assert replays.read(self.session_id) is None
+
+
+@pytest.mark.usefixtures("client_class")
+class TestReplayImage:
+    def test_replay_image(self, replays):
+        session_id = get_random_session_id()
+        board = chess.Board()
+        board.push_san("e4")
+        replays.record(session_id, board, flipped=False)
+        url = url_for("webhook_bp.replay_image", session_id=session_id)
+
+        r = self.client.get(url)
+
+        assert r.status_code == 200
+        assert r.content_type == "image/gif"
+        assert len(read_frames(r.get_data())) == 2
+
+        r = self.client.get(url, headers={"If-None-Match": r.headers["ETag"]})
+
+        assert r.status_code == 304
+
+    def test_replay_not_found(self):
+        url = url_for("webhook_bp.replay_image", session_id="unknown")
+
+        assert self.client.get(url).status_code == 404
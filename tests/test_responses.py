@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from chess_server import responses
+from chess_server.responses import dumps, json_response
+from tests import data
+
+
+@pytest.fixture
+def no_orjson(mocker):
+    mocker.patch("chess_server.responses.orjson", None)
+
+
+@pytest.mark.usefixtures("context")
+class TestDumps:
+    def test_stdlib(self, no_orjson):
+        result = dumps({"spam": "é", "eggs": [1, True, None]})
+
+        assert result == '{"spam":"é","eggs":[1,true,null]}'.encode()
+
+    def test_orjson(self, mocker):
+        mock_orjson = mocker.patch("chess_server.responses.orjson")
+        mock_orjson.dumps.return_value = b"{}"
+
+        assert dumps({"spam": "eggs"}) == b"{}"
+        mock_orjson.dumps.assert_called_once_with({"spam": "eggs"})
+
+    def test_orjson_disabled(self, config, mocker):
+        config["RESPONSE_JSON_ORJSON"] = False
+        mock_orjson = mocker.patch("chess_server.responses.orjson")
+
+        assert json.loads(dumps({"spam": "eggs"})) == {"spam": "eggs"}
+        mock_orjson.dumps.assert_not_called()
+
+    @pytest.mark.skipif(responses.orjson is None, reason="needs orjson")
+    def test_orjson_matches_stdlib(self, mocker):
+        res = data.sample_response_for_google_assistant
+
+        fast = dumps(res)
+        mocker.patch("chess_server.responses.orjson", None)
+
+        assert json.loads(fast) == json.loads(dumps(res))
+
+
+def test_json_response(context, no_orjson):
+    response = json_response({"spam": "eggs"}, status=201)
+
+    assert response.status_code == 201
+    assert response.mimetype == "application/json"
+    assert response.get_json() == {"spam": "eggs"}
@@ -1,8 +1,16 @@
-import os
 
+import chess
 import pytest
 from flask import url_for
 
+from chess_server.intents import ERROR_RESPONSES, handlers
+from chess_server.main import mediator
+from chess_server.render import BoardSpec, render_cache
+from chess_server.utils import (
+    ConcurrentUpdateError,
+    create_user,
+    encode_board_image_token,
+)
 from tests.utils import (
     get_dummy_webhook_request_for_google,
     get_random_session_id,
@@ -10,108 +18,116 @@ from tests.utils import (
 
 
 class TestWebhookForGoogle:
-    def setup_method(self):
+    @pytest.fixture(autouse=True)
+    def setup(self, mocker):
         self.result = {"spam": "eggs"}
+        mocker.patch.object(mediator, "engine", mocker.Mock())
+        self.mocker = mocker
 
-    def test_webhook_welcome(self, client, mocker):
-        mock_welcome = mocker.patch(
-            "chess_server.routes.welcome", return_value=self.result
+    def mock_handler(self, action, **kwargs):
+        mock = self.mocker.Mock(**kwargs)
+        self.mocker.patch.dict(
+            handlers, {action: handlers[action]._replace(func=mock)}
         )
+        return mock
+
+    @pytest.mark.parametrize(
+        "action,parameters",
+        [
+            ("welcome", {"color": ""}),
+            ("choose_color", {}),
+            ("two_squares", {"squares": ["e2", "e4"], "piece": ""}),
+            ("castle", {}),
+            ("resign", {}),
+            ("simply_san", {"san": "e4"}),
+            ("piece_and_square", {"piece": "", "pawn": "", "square": "e4"}),
+            ("show_board", {}),
+            ("undo", {}),
+        ],
+    )
+    def test_webhook_dispatches_action(self, client, action, parameters):
+        mock_handler = self.mock_handler(action, return_value=self.result)
 
-        req_data = get_dummy_webhook_request_for_google(action="welcome")
-
-        resp = client.post("/webhook", json=req_data)
-
-        assert resp.get_json() == self.result
-        mock_welcome.assert_called_with(req_data)
-
-    def test_webhook_choose_color(self, client, mocker):
-        mock_choose_color = mocker.patch(
-            "chess_server.routes.choose_color", return_value=self.result
+        req_data = get_dummy_webhook_request_for_google(
+            action=action, parameters=parameters
         )
 
-        req_data = get_dummy_webhook_request_for_google(action="choose_color")
-
         resp = client.post("/webhook", json=req_data)
 
         assert resp.get_json() == self.result
-        mock_choose_color.assert_called_with(req_data)
+        (call,), _ = mock_handler.call_args
+        assert call.req == req_data
+        assert call.action == action
 
-    def test_webhook_two_squares(self, client, mocker):
-        mock_two_squares = mocker.patch(
-            "chess_server.routes.two_squares", return_value=self.result
-        )
+    def test_webhook_missing_parameters(self, client):
+        mock_handler = self.mock_handler("simply_san")
 
-        req_data = get_dummy_webhook_request_for_google(action="two_squares")
+        req_data = get_dummy_webhook_request_for_google(action="simply_san")
 
         resp = client.post("/webhook", json=req_data)
 
-        assert resp.get_json() == self.result
-        mock_two_squares.assert_called_with(req_data)
-
-    def test_webhook_castle(self, client, mocker):
-        mock_castle = mocker.patch(
-            "chess_server.routes.castle", return_value=self.result
+        assert resp.status_code == 400
+        assert "Missing parameters for simply_san: san" in str(
+            resp.get_data()
         )
+        mock_handler.assert_not_called()
 
-        req_data = get_dummy_webhook_request_for_google(action="castle")
-
-        resp = client.post("/webhook", json=req_data)
-
-        assert resp.get_json() == self.result
-        mock_castle.assert_called_with(req_data)
-
-    def test_webhook_resign(self, client, mocker):
-        mock_resign = mocker.patch(
-            "chess_server.routes.resign", return_value=self.result
+    def test_webhook_concurrent_update_is_retried(self, client):
+        mock_undo = self.mock_handler(
+            "undo", side_effect=[ConcurrentUpdateError(), self.result]
         )
 
-        req_data = get_dummy_webhook_request_for_google(action="resign")
+        req_data = get_dummy_webhook_request_for_google(action="undo")
 
         resp = client.post("/webhook", json=req_data)
 
         assert resp.get_json() == self.result
-        mock_resign.assert_called_with(req_data)
+        assert mock_undo.call_count == 2
 
-    def test_webhook_show_board(self, client, mocker):
-        mock_show_board = mocker.patch(
-            "chess_server.routes.show_board", return_value=self.result
+    def test_webhook_concurrent_update_after_write(self, client):
+        mock_undo = self.mock_handler(
+            "undo", side_effect=ConcurrentUpdateError()
+        )
+        self.mocker.patch(
+            "chess_server.intents.has_written_users", return_value=True
         )
 
-        req_data = get_dummy_webhook_request_for_google(action="show_board")
+        req_data = get_dummy_webhook_request_for_google(action="undo")
 
         resp = client.post("/webhook", json=req_data)
 
-        assert resp.get_json() == self.result
-        mock_show_board.assert_called_with(req_data)
-
-    def test_webhook_piece_and_square(self, client, mocker):
-        mock_piece_and_square = mocker.patch(
-            "chess_server.routes.piece_and_square", return_value=self.result
+        assert ERROR_RESPONSES["concurrent_update"] in str(resp.get_json())
+        mock_undo.assert_called_once()
+
+    def test_webhook_concurrent_update_after_users_move(self, client):
+        # The user's move was saved, the engine's move was not
+        session_id = get_random_session_id()
+        board = chess.Board()
+        board.push_san("e4")
+        create_user(session_id, board, chess.WHITE)
+        mock_san = self.mock_handler(
+            "simply_san", side_effect=ConcurrentUpdateError()
         )
-
-        req_data = get_dummy_webhook_request_for_google(
-            action="piece_and_square"
+        self.mocker.patch(
+            "chess_server.intents.has_written_users", return_value=True
         )
-
-        resp = client.post("/webhook", json=req_data)
-
-        assert resp.get_json() == self.result
-        mock_piece_and_square.assert_called_with(req_data)
-
-    def test_webhook_undo(self, client, mocker):
-        mock_undo = mocker.patch(
-            "chess_server.routes.undo", return_value=self.result
+        mock_play_engine = self.mocker.patch.object(
+            mediator, "play_engine_move_and_get_speech", return_value="e5"
         )
 
-        req_data = get_dummy_webhook_request_for_google(action="undo")
+        req_data = get_dummy_webhook_request_for_google(
+            session_id=session_id,
+            action="simply_san",
+            parameters={"san": "e4"},
+        )
 
         resp = client.post("/webhook", json=req_data)
 
-        assert resp.get_json() == self.result
-        mock_undo.assert_called_with(req_data)
+        assert "e5. " in str(resp.get_json())
+        mock_san.assert_called_once()
+        mock_play_engine.assert_called_once_with(session_id)
 
-    def test_webhook_unknown_intent(self, client, mocker):
+    def test_webhook_unknown_intent(self, client):
         req_data = get_dummy_webhook_request_for_google(action="unknown")
 
         resp = client.post("/webhook", json=req_data)
@@ -126,22 +142,64 @@ class TestPNGImage:
         self.session_id = get_random_session_id()
         self.file_content = b"file content"
 
-    def test_png_image_success(self, client, config, mocker):
+    def test_png_image_is_rendered(self, client, mocker):
+        mock_svg2png = mocker.patch(
+            "chess_server.render.svg2png", return_value=self.file_content
+        )
+        board = chess.Board()
+        board.push_san("e4")
+        create_user(self.session_id, board, chess.BLACK)
         url = url_for(
-            "webhook_bp.png_image",
-            session_id=self.session_id,
-            move_number=1,
-            _external=True,
+            "webhook_bp.png_image", session_id=self.session_id, move_number=1
         )
 
-        imgpath = os.path.join(config["IMG_DIR"], f"{self.session_id}.png")
+        r = client.get(url)
 
-        with open(imgpath, "wb") as fw:
-            fw.write(self.file_content)
+        assert r.get_data() == self.file_content
+        spec = BoardSpec(board.board_fen(), "e2e4", True)
+        mock_svg2png.assert_called_once_with(bytestring=spec.to_svg())
+
+    def test_png_image_not_modified(self, client, mocker):
+        mocker.patch("chess_server.render.svg2png", return_value=b"PNG")
+        create_user(self.session_id, chess.Board(), chess.WHITE)
+        url = url_for(
+            "webhook_bp.png_image", session_id=self.session_id, move_number=1
+        )
+
+        etag = client.get(url).headers["ETag"]
+        r = client.get(url, headers={"If-None-Match": etag})
+
+        assert r.status_code == 304
+
+    def test_png_image_webp(self, client, config, mocker):
+        config["IMAGE_FORMAT"] = "webp"
+        board = chess.Board()
+        create_user(self.session_id, board, chess.WHITE)
+        spec = BoardSpec(board.board_fen(), format="webp")
+        render_cache.put(spec, b"WebP data")
+        url = url_for(
+            "webhook_bp.png_image", session_id=self.session_id, move_number=1
+        )
 
         r = client.get(url)
 
-        assert r.get_data() == self.file_content
+        assert r.get_data() == b"WebP data"
+        assert r.mimetype == "image/webp"
+        assert r.headers["Cache-Control"] == "no-cache"
+
+    def test_png_image_x_sendfile(self, client, config):
+        config["USE_X_SENDFILE"] = True
+        board = chess.Board()
+        create_user(self.session_id, board, chess.WHITE)
+        spec = BoardSpec(board.board_fen())
+        render_cache.put(spec, self.file_content)
+        url = url_for(
+            "webhook_bp.png_image", session_id=self.session_id, move_number=1
+        )
+
+        r = client.get(url)
+
+        assert r.headers["X-Sendfile"] == render_cache.disk_path(spec.key)
 
     def test_png_image_file_not_found(self, client, config, mocker):
         url = url_for(
@@ -154,3 +212,210 @@ class TestPNGImage:
         r = client.get(url)
 
         assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("client_class")
+class TestPositionImage:
+    def setup_method(self):
+        self.spec = BoardSpec(chess.STARTING_BOARD_FEN, "e2e4", True)
+        self.png = b"PNG data"
+
+    def test_position_image_is_rendered_once(self, mocker):
+        mock_svg2png = mocker.patch(
+            "chess_server.render.svg2png", return_value=self.png
+        )
+        url = url_for(
+            "webhook_bp.position_image",
+            token=encode_board_image_token(self.spec),
+        )
+
+        r1 = self.client.get(url)
+        r2 = self.client.get(url)
+
+        assert r1.get_data() == r2.get_data() == self.png
+        assert r1.mimetype == "image/png"
+        mock_svg2png.assert_called_once_with(bytestring=self.spec.to_svg())
+
+    def test_position_image_bad_token(self, mocker):
+        mock_svg2png = mocker.patch("chess_server.render.svg2png")
+        token = encode_board_image_token(self.spec)
+
+        r = self.client.get(
+            url_for("webhook_bp.position_image", token=token[:-3] + "abc")
+        )
+
+        assert r.status_code == 404
+        mock_svg2png.assert_not_called()
+
+
+@pytest.mark.usefixtures("client_class")
+class TestBoardImage:
+    def setup_method(self):
+        self.spec = BoardSpec(chess.STARTING_BOARD_FEN, "e2e4")
+        self.png = b"PNG data"
+
+    def get_url(self, key=None, ext="png"):
+        return url_for(
+            "webhook_bp.board_image", key=key or self.spec.key, ext=ext
+        )
+
+    def test_board_image(self):
+        render_cache.put(self.spec, self.png)
+
+        r = self.client.get(self.get_url())
+
+        assert r.status_code == 200
+        assert r.get_data() == self.png
+        assert r.mimetype == "image/png"
+        assert r.headers["ETag"] == f'"{self.spec.key}"'
+        assert r.headers["Cache-Control"] == (
+            "public, max-age=31536000, immutable"
+        )
+
+    def test_board_image_not_modified(self, mocker):
+        mock_lookup = mocker.patch.object(render_cache, "lookup_key")
+
+        r = self.client.get(
+            self.get_url(), headers={"If-None-Match": f'"{self.spec.key}"'}
+        )
+
+        assert r.status_code == 304
+        assert r.get_data() == b""
+        mock_lookup.assert_not_called()
+
+    def test_board_image_not_found(self):
+        render_cache.put(self.spec, self.png)
+
+        assert self.client.get(self.get_url("a" * 40)).status_code == 404
+        assert self.client.get(self.get_url("abc")).status_code == 404
+        assert self.client.get(self.get_url(ext="gif")).status_code == 404
+
+    def test_board_image_is_rendered(self, mocker):
+        mock_svg2png = mocker.patch(
+            "chess_server.render.svg2png", return_value=self.png
+        )
+        token = encode_board_image_token(self.spec)
+
+        r = self.client.get(self.get_url() + f"?position={token}")
+
+        assert r.get_data() == self.png
+        assert "immutable" in r.headers["Cache-Control"]
+        mock_svg2png.assert_called_once_with(bytestring=self.spec.to_svg())
+
+    def test_board_image_other_position(self, mocker):
+        mock_svg2png = mocker.patch("chess_server.render.svg2png")
+        token = encode_board_image_token(self.spec._replace(flipped=True))
+
+        r = self.client.get(self.get_url() + f"?position={token}")
+
+        assert r.status_code == 404
+        mock_svg2png.assert_not_called()
+
+    def test_board_image_webp(self):
+        spec = self.spec._replace(format="webp")
+        render_cache.put(spec, b"WebP data")
+
+        r = self.client.get(self.get_url(spec.key, ext="webp"))
+
+        assert r.get_data() == b"WebP data"
+        assert r.mimetype == "image/webp"
+
+    def test_board_image_x_sendfile(self, config):
+        config["USE_X_SENDFILE"] = True
+        render_cache.put(self.spec, self.png)
+
+        r = self.client.get(self.get_url())
+
+        assert r.headers["X-Sendfile"] == render_cache.disk_path(
+            self.spec.key
+        )
+        assert r.get_data() == b""
+        assert r.headers["ETag"] == f'"{self.spec.key}"'
+
+    def test_board_image_x_accel_redirect(self, config):
+        config["IMAGE_ACCEL_REDIRECT_PREFIX"] = "/internal/boards/"
+        render_cache.put(self.spec, self.png)
+
+        r = self.client.get(self.get_url())
+
+        key = self.spec.key
+        assert r.headers["X-Accel-Redirect"] == (
+            f"/internal/boards/{key[:2]}/{key[2:4]}/{key}.png"
+        )
+        assert r.get_data() == b""
+        assert r.mimetype == "image/png"
+
+    def test_position_image_not_modified(self, mocker):
+        mock_get_image = mocker.patch(
+            "chess_server.routes.render_pool.get_image"
+        )
+        url = url_for(
+            "webhook_bp.position_image",
+            token=encode_board_image_token(self.spec),
+        )
+
+        r = self.client.get(url, headers={"If-None-Match": self.spec.key})
+
+        assert r.status_code == 304
+        mock_get_image.assert_not_called()
+
+
+class TestMetrics:
+    def test_metrics(self, client):
+        resp = client.get("/metrics")
+
+        assert resp.status_code == 200
+        assert resp.content_type.startswith("text/plain; version=0.0.4")
+        assert b"# TYPE webhook_intent_duration_seconds histogram" in (
+            resp.data
+        )
+        assert b"\nactive_sessions " in resp.data
+
+    def test_metrics_token(self, client, config):
+        config["METRICS_TOKEN"] = "spam"
+
+        assert client.get("/metrics").status_code == 401
+
+        resp = client.get(
+            "/metrics", headers={"Authorization": "Bearer spam"}
+        )
+        assert resp.status_code == 200
+
+
+class TestStatelessWebhook:
+    def setup_method(self):
+        self.session_id = get_random_session_id()
+
+    def test_game_state_is_carried_in_contexts(self, client, config, mocker):
+        config["STATELESS_MODE"] = True
+        mock_db_session = mocker.patch("chess_server.utils.db.session")
+        mocker.patch.object(mediator, "engine", mocker.Mock())
+
+        req_data = get_dummy_webhook_request_for_google(
+            session_id=self.session_id,
+            action="welcome",
+            parameters={"color": "white"},
+        )
+        resp = client.post("/webhook", json=req_data).get_json()
+
+        (context,) = resp["outputContexts"]
+        assert context["lifespanCount"] > 0
+
+        mocker.patch(
+            "chess_server.main.Mediator.play_engine_move_and_get_speech",
+            return_value="Pawn from e7 to e5",
+        )
+        req_data = get_dummy_webhook_request_for_google(
+            session_id=self.session_id,
+            action="simply_san",
+            parameters={"san": "e4"},
+        )
+        req_data["queryResult"]["outputContexts"] = [context]
+        resp = client.post("/webhook", json=req_data).get_json()
+
+        assert "Your last move was e2-e4" in str(resp["payload"])
+        assert resp["outputContexts"][0]["parameters"]["state"] != (
+            context["parameters"]["state"]
+        )
+        mock_db_session.add.assert_not_called()
+        mock_db_session.commit.assert_not_called()
@@ -0,0 +1,359 @@
+import hashlib
+import io
+import os
+import stat
+import time
+from datetime import datetime, timedelta, timezone
+
+import chess
+import pytest
+
+from chess_server.render import BoardSpec, RenderCache, render_cache
+from chess_server.storage import (
+    BlobStore,
+    LocalBlobStore,
+    MemoryBlobStore,
+    S3BlobStore,
+    SharedDirBlobStore,
+    atomic_write,
+    create_blob_store,
+    image_path,
+    iter_files,
+    migrate_flat_files,
+    shard_path,
+)
+
+
+def test_shard_path():
+    digest = hashlib.sha1(b"spam.png").hexdigest()
+
+    assert shard_path("/img", "spam.png") == os.path.join(
+        "/img", digest[:2], digest[2:4], "spam.png"
+    )
+    assert shard_path("/img", "spam.png", "abcdef") == os.path.join(
+        "/img", "ab", "cd", "spam.png"
+    )
+
+
+def test_image_path_shares_directory_between_formats():
+    png = image_path("/img", "session", "png")
+    webp = image_path("/img", "session", "webp")
+
+    assert os.path.dirname(png) == os.path.dirname(webp)
+    assert os.path.basename(webp) == "session.webp"
+
+
+class TestAtomicWrite:
+    def test_atomic_write(self, tmp_path):
+        path = os.path.join(tmp_path, "ab", "cd", "file.png")
+
+        atomic_write(path, b"old")
+        atomic_write(path, b"new")
+
+        with open(path, "rb") as f:
+            assert f.read() == b"new"
+        assert os.listdir(os.path.dirname(path)) == ["file.png"]
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+    def test_atomic_write_failure_keeps_old_file(self, tmp_path, mocker):
+        path = os.path.join(tmp_path, "file.png")
+        atomic_write(path, b"old")
+        mocker.patch(
+            "chess_server.storage.os.replace", side_effect=OSError("full")
+        )
+
+        with pytest.raises(OSError):
+            atomic_write(path, b"new")
+
+        with open(path, "rb") as f:
+            assert f.read() == b"old"
+        assert os.listdir(tmp_path) == ["file.png"]
+
+
+def test_iter_files(tmp_path):
+    root = str(tmp_path)
+    paths = [
+        os.path.join(root, "flat.png"),
+        image_path(root, "one", "png"),
+        image_path(root, "two", "png"),
+        os.path.join(root, "cache", "ab", "cd", "cached.png"),
+    ]
+    for path in paths:
+        atomic_write(path, b"spam")
+
+    names = sorted(entry.name for entry in iter_files(root))
+
+    assert names == ["flat.png", "one.png", "two.png"]
+
+
+def test_migrate_flat_files(tmp_path):
+    root = str(tmp_path)
+    for name in ("one.png", "two.webp", "three.png", ".x.tmp", "reaper.lock"):
+        with open(os.path.join(root, name), "wb") as f:
+            f.write(b"old")
+    # Written in the new layout since the upgrade
+    atomic_write(image_path(root, "three", "png"), b"new")
+
+    migrated = migrate_flat_files(
+        root, lambda stem, ext: image_path(root, stem, ext)
+    )
+
+    assert migrated == 3
+    assert os.path.exists(image_path(root, "one", "png"))
+    assert os.path.exists(image_path(root, "two", "webp"))
+    with open(image_path(root, "three", "png"), "rb") as f:
+        assert f.read() == b"new"
+    assert sorted(
+        entry.name for entry in os.scandir(root) if entry.is_file()
+    ) == [".x.tmp", "reaper.lock"]
+
+
+def test_migrate_images_command(app, config):
+    img_dir = config["IMG_DIR"]
+    key = "a" * 40
+    with open(os.path.join(img_dir, "session.png"), "wb") as f:
+        f.write(b"spam")
+    with open(os.path.join(render_cache.disk_dir, f"{key}.png"), "wb") as f:
+        f.write(b"eggs")
+
+    result = app.test_cli_runner().invoke(args=["migrate-images"])
+
+    assert "Migrated 2 images." in result.output
+    assert os.path.exists(image_path(img_dir, "session", "png"))
+    assert render_cache.lookup_key(key) == b"eggs"
+
+
+class TestLocalBlobStore:
+    @pytest.fixture
+    def store(self, tmp_path):
+        return LocalBlobStore(str(tmp_path))
+
+    def test_put_and_get(self, store):
+        store.put("session.png", b"spam")
+
+        assert store.get("session.png") == b"spam"
+        assert store.local_path("session.png") == image_path(
+            store.root, "session", "png"
+        )
+        assert store.get("other.png") is None
+        assert store.local_path("other.png") is None
+
+    def test_prefixed_key(self, store):
+        store.put("boards/abcdef", b"spam")
+
+        assert store.path("boards/abcdef").startswith(
+            os.path.join(store.root, "boards", "")
+        )
+        assert store.get("boards/abcdef") == b"spam"
+
+    def test_flat_layout_fallback(self, store):
+        with open(os.path.join(store.root, "session.png"), "wb") as f:
+            f.write(b"spam")
+
+        assert store.get("session.png") == b"spam"
+        assert store.delete("session.png") == 4
+        assert store.get("session.png") is None
+
+    def test_delete(self, store):
+        store.put("session.png", b"spam")
+
+        assert store.delete("session.png") == 4
+        assert store.delete("session.png") == 0
+
+    def test_sweep(self, store):
+        store.put("old.png", b"spam")
+        store.put("new.png", b"spam")
+        store.put("boards/abcdef", b"eggs")
+        store.put("reaper.lock", b"")
+        an_hour_ago = time.time() - 3600
+        for key in ("old.png", "boards/abcdef", "reaper.lock"):
+            os.utime(store.path(key), (an_hour_ago, an_hour_ago))
+
+        assert store.sweep(time.time() - 60, limit=10) == (2, 8)
+        assert store.get("reaper.lock") == b""
+        assert store.get("new.png") == b"spam"
+        assert store.get("old.png") is None
+
+    def test_shared_dir_store_syncs(self, tmp_path, mocker):
+        mock_fsync = mocker.patch("chess_server.storage.os.fsync")
+        store = SharedDirBlobStore(str(tmp_path))
+
+        store.put("session.png", b"spam")
+
+        assert store.shared
+        mock_fsync.assert_called_once()
+
+
+def test_blob_store_is_abstract():
+    class PartialStore(BlobStore):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialStore()
+
+
+def test_memory_blob_store():
+    store = MemoryBlobStore()
+    store.put("old.png", b"spam")
+    store.put("new.png", b"eggs!")
+    store.blobs["old.png"] = (b"spam", time.time() - 3600)
+
+    assert store.get("new.png") == b"eggs!"
+    assert store.sweep(time.time() - 60, limit=10) == (1, 4)
+    assert store.delete("new.png") == 5
+    assert store.get("new.png") is None
+
+
+class FakeS3Error(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3Client:
+    """Stand-in for the calls made to a boto3 S3 client"""
+
+    def __init__(self, page_size=1000):
+        self.objects = {}
+        self.page_size = page_size
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[Bucket, Key] = (
+            Body,
+            ContentType,
+            datetime.now(timezone.utc),
+        )
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error("NoSuchKey")
+
+        return {"Body": io.BytesIO(self.objects[Bucket, Key][0])}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error("404")
+
+        return {"ContentLength": len(self.objects[Bucket, Key][0])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            self.delete_object(Bucket, obj["Key"])
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        keys = sorted(
+            key
+            for bucket, key in self.objects
+            if bucket == Bucket and key.startswith(Prefix)
+        )
+        start = int(ContinuationToken or 0)
+        end = start + self.page_size
+        page = {
+            "Contents": [
+                {
+                    "Key": key,
+                    "Size": len(self.objects[Bucket, key][0]),
+                    "LastModified": self.objects[Bucket, key][2],
+                }
+                for key in keys[start:end]
+            ],
+            "IsTruncated": end < len(keys),
+        }
+        if page["IsTruncated"]:
+            page["NextContinuationToken"] = str(end)
+
+        return page
+
+
+class TestS3BlobStore:
+    def setup_method(self):
+        self.client = FakeS3Client(page_size=2)
+        self.store = S3BlobStore("bucket", prefix="img/", client=self.client)
+
+    def test_put_and_get(self):
+        self.store.put("session.webp", b"spam", "image/webp")
+
+        assert self.client.objects["bucket", "img/session.webp"][:2] == (
+            b"spam",
+            "image/webp",
+        )
+        assert self.store.get("session.webp") == b"spam"
+        assert self.store.get("other.png") is None
+        assert self.store.local_path("session.webp") is None
+
+    def test_delete(self):
+        self.store.put("session.png", b"spam")
+
+        assert self.store.delete("session.png") == 4
+        assert self.store.delete("session.png") == 0
+
+    def test_sweep(self):
+        for i in range(5):
+            self.store.put(f"{i}.png", b"spam")
+        an_hour_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+        for i in (0, 2, 3, 4):
+            key = ("bucket", f"img/{i}.png")
+            body, content_type, _ = self.client.objects[key]
+            self.client.objects[key] = (body, content_type, an_hour_ago)
+
+        assert self.store.sweep(time.time() - 60, limit=3) == (3, 12)
+        assert sorted(key for _, key in self.client.objects) == [
+            "img/1.png",
+            "img/4.png",
+        ]
+
+    def test_other_errors_are_raised(self, mocker):
+        mocker.patch.object(
+            self.client, "get_object", side_effect=FakeS3Error("AccessDenied")
+        )
+
+        with pytest.raises(FakeS3Error):
+            self.store.get("session.png")
+
+
+def test_create_blob_store(tmp_path):
+    config = {
+        "IMAGE_STORE": "shared",
+        "IMG_DIR": "/img",
+        "IMAGE_STORE_DIR": str(tmp_path),
+        "IMAGE_STORE_BUCKET": "bucket",
+        "IMAGE_STORE_PREFIX": "img/",
+        "IMAGE_STORE_ENDPOINT_URL": "http://localhost:9000",
+    }
+
+    assert create_blob_store(config).root == str(tmp_path)
+    assert type(create_blob_store({**config, "IMAGE_STORE": "local"})) is (
+        LocalBlobStore
+    )
+
+    store = create_blob_store({**config, "IMAGE_STORE": "s3"})
+    assert (store.bucket, store.prefix, store.endpoint_url) == (
+        "bucket",
+        "img/",
+        "http://localhost:9000",
+    )
+
+    with pytest.raises(ValueError):
+        create_blob_store({**config, "IMAGE_STORE": "ftp"})
+
+
+def test_render_cache_shares_boards_through_store(app, tmp_path, mocker):
+    mock_render = mocker.patch(
+        "chess_server.render.render_image", return_value=b"png"
+    )
+    app.extensions["image_store"] = SharedDirBlobStore(str(tmp_path / "s"))
+    spec = BoardSpec(chess.STARTING_BOARD_FEN)
+
+    node_a = RenderCache()
+    node_a.init_app(app)
+    app.config["RENDER_CACHE_DIR"] = str(tmp_path / "b")
+    node_b = RenderCache()
+    node_b.init_app(app)
+
+    assert node_a.get_image(spec) == b"png"
+    assert node_b.lookup_key(spec.key) == b"png"
+    mock_render.assert_called_once()
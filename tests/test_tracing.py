@@ -0,0 +1,156 @@
+import json
+
+import pytest
+
+from chess_server.intents import Handler
+from chess_server.tracing import (
+    OTLPExporter,
+    Span,
+    Trace,
+    current_span,
+    parse_traceparent,
+    span,
+    tracer,
+    traces_exported,
+)
+from tests.utils import get_dummy_webhook_request_for_google
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+
+@pytest.fixture
+def root():
+    trace = Trace(TRACE_ID)
+    root = Span(trace, "POST /webhook", None, {})
+    trace.spans.append(root)
+    token = current_span.set(root)
+    yield root
+    current_span.reset(token)
+
+
+def test_span_outside_of_request():
+    with span("spam") as child:
+        assert child is None
+
+
+def test_span(root):
+    @span("eggs")
+    def eggs():
+        raise ValueError("ham")
+
+    with span("spam", size=240) as child:
+        assert current_span.get() is child
+        with pytest.raises(ValueError):
+            eggs()
+
+    assert current_span.get() is root
+    spam, failed = root.trace.spans[1:]
+    assert spam.parent_id == root.span_id
+    assert spam.attributes == {"size": 240}
+    assert spam.end_ns >= spam.start_ns
+    assert failed.parent_id == spam.span_id
+    assert failed.error == "ValueError: ham"
+
+
+def test_parse_traceparent():
+    header = f"00-{TRACE_ID}-00f067aa0ba902b7-01"
+
+    assert parse_traceparent(header) == (TRACE_ID, "00f067aa0ba902b7")
+    assert parse_traceparent("spam") == (None, None)
+
+
+def test_otlp_exporter(root, mocker):
+    with span("spam", size=240):
+        pass
+    root.end_ns = root.start_ns + 1000
+    mock_urlopen = mocker.patch("chess_server.tracing.urllib.request.urlopen")
+    exporter = OTLPExporter("http://collector/v1/traces", "wizardchess")
+
+    exporter.export([root.trace])
+
+    (req,), _ = mock_urlopen.call_args
+    body = json.loads(req.data)
+    (resource_spans,) = body["resourceSpans"]
+    spans = resource_spans["scopeSpans"][0]["spans"]
+    assert req.full_url == "http://collector/v1/traces"
+    assert [s["name"] for s in spans] == ["POST /webhook", "spam"]
+    assert {s["traceId"] for s in spans} == {TRACE_ID}
+    assert spans[1]["parentSpanId"] == root.span_id
+    assert spans[1]["attributes"] == [
+        {"key": "size", "value": {"stringValue": "240"}}
+    ]
+
+
+class TestTracer:
+    @pytest.fixture(autouse=True)
+    def setup_tracer(self, app, config, mocker):
+        config["TRACING_ENABLED"] = True
+        config["TRACING_SAMPLE_RATE"] = 0
+        tracer.init_app(app)
+        self.exporter = mocker.patch.object(tracer, "exporter")
+        mocker.patch.dict(
+            "chess_server.intents.handlers",
+            {"spam": Handler("spam", self.handler)},
+        )
+        yield
+        tracer.stop()
+
+    def handler(self, req):
+        with span("engine.play"):
+            pass
+        return {}
+
+    def post(self, client, **headers):
+        req = get_dummy_webhook_request_for_google(action="spam")
+        return client.post("/webhook", json=req, headers=headers)
+
+    def get_exported(self):
+        tracer.stop()
+        return [
+            trace
+            for (traces,), _ in self.exporter.export.call_args_list
+            for trace in traces
+        ]
+
+    def test_slow_request_is_kept(self, client, config):
+        config["TRACING_SLOW_THRESHOLD"] = 0
+        kept = traces_exported.get(reason="slow")
+
+        resp = self.post(
+            client, traceparent=f"00-{TRACE_ID}-00f067aa0ba902b7-01"
+        )
+
+        (trace,) = self.get_exported()
+        assert resp.headers["X-Trace-Id"] == TRACE_ID
+        assert trace.trace_id == TRACE_ID
+        assert trace.parent_id == "00f067aa0ba902b7"
+        assert [s.name for s in trace.spans] == [
+            "POST /webhook",
+            "handler",
+            "engine.play",
+        ]
+        assert trace.root.attributes["http.status_code"] == 200
+        assert traces_exported.get(reason="slow") == kept + 1
+
+    def test_fast_request_is_dropped(self, client):
+        resp = self.post(client)
+
+        assert len(resp.headers["X-Trace-Id"]) == 32
+        assert self.get_exported() == []
+
+    def test_failed_request_is_kept(self, client, mocker):
+        mocker.patch.dict(
+            "chess_server.intents.handlers",
+            {"spam": Handler("spam", mocker.Mock(side_effect=OSError()))},
+        )
+
+        with pytest.raises(OSError) as excinfo:
+            self.post(client)
+
+        # The test client keeps the context of a failed request, which
+        # would be torn down at the end of a real one
+        tracer.end_request(excinfo.value)
+
+        (trace,) = self.get_exported()
+        assert trace.root.error == "OSError: "
+        assert trace.spans[1].error == "OSError: "
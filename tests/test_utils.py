@@ -1,31 +1,55 @@
-import os
+import math
+from datetime import datetime, timedelta
 
 import chess
 import chess.svg
 import pytest
 from flask import current_app, url_for
 
+from chess_server import db
+from chess_server.models import UserModel
+from chess_server.render import BoardSpec, render_cache
+from chess_server.storage import get_image_store
 from chess_server.utils import (
     User,
     BasicCard,
     Image,
+    ImageVariant,
+    count_active_sessions,
     create_user,
-    get_session_by_req,
+    decode_board_image_token,
+    decode_game_state,
+    delete_user,
+    encode_board_image_token,
+    encode_game_state,
+    exists_in_db,
+    get_board_image_serializer,
+    get_board_spec,
+    get_game_states,
+    get_output_contexts_for_game_states,
     get_params_by_req,
     get_piece_symbol,
     get_response_for_google,
     get_response_template_for_google,
     get_san_description,
+    get_session_by_req,
     get_user,
     lan_to_speech,
+    load_game_states_from_req,
+    load_image_variant_from_req,
+    negotiate_image_variant,
     process_castle_by_querytext,
     save_board_as_png,
     save_board_as_png_and_get_image_card,
     two_squares_and_piece_to_lan,
     undo_users_last_move,
+    update_user,
 )
 from tests import data
-from tests.utils import get_random_session_id
+from tests.utils import (
+    get_dummy_webhook_request_for_google,
+    get_random_session_id,
+)
 
 
 def test_get_session_by_req():
@@ -48,6 +72,37 @@ def test_get_response_for_google():
     assert result == data.sample_response_for_google_assistant
 
 
+def test_get_response_for_google_with_card():
+
+    card = BasicCard(formattedText="spam", title="eggs")
+
+    result = get_response_for_google(
+        textToSpeech="ham",
+        displayText="bacon",
+        expectUserResponse=False,
+        basicCard=card,
+    )
+
+    assert result == {
+        "payload": {
+            "google": {
+                "expectUserResponse": False,
+                "richResponse": {
+                    "items": [
+                        {
+                            "simpleResponse": {
+                                "textToSpeech": "ham",
+                                "displayText": "bacon",
+                            }
+                        },
+                        {"basicCard": card.make_dict()},
+                    ]
+                },
+            }
+        }
+    }
+
+
 def test_get_response_template_for_google():
 
     result = get_response_template_for_google()
@@ -655,30 +710,30 @@ class TestSaveBoardAsPNG:
     def setup_method(self):
         self.session_id = get_random_session_id()
         self.error_msg = "Example error"
+        self.png = b"PNG data"
 
     def test_save_board_as_png_success(self, mocker, context):
-        mock_svg2png = mocker.patch("chess_server.utils.svg2png")
-
-        expected_pngfile = os.path.join(
-            current_app.config["IMG_DIR"], f"{self.session_id}.png"
+        mock_svg2png = mocker.patch(
+            "chess_server.render.svg2png", return_value=self.png
         )
 
         # With an empty board (lastmove=None)
         board = chess.Board()
         svg = str(chess.svg.board(board))
+        spec = BoardSpec.from_board(board)
 
         value = save_board_as_png(imgkey=self.session_id, board=board)
 
-        assert value == expected_pngfile
-        mock_svg2png.assert_called_with(
-            bytestring=str(svg), write_to=expected_pngfile
-        )
+        assert value == spec.key
+        mock_svg2png.assert_called_with(bytestring=str(svg))
 
-    def test_save_board_as_png_flip(self, mocker, context):
-        mock_svg2png = mocker.patch("chess_server.utils.svg2png")
+        assert render_cache.lookup(spec) == self.png
+        # Only the position is kept, not a copy per game
+        assert get_image_store().get(f"{self.session_id}.png") is None
 
-        expected_pngfile = os.path.join(
-            current_app.config["IMG_DIR"], f"{self.session_id}.png"
+    def test_save_board_as_png_flip(self, mocker, context):
+        mock_svg2png = mocker.patch(
+            "chess_server.render.svg2png", return_value=self.png
         )
 
         # With an empty board (lastmove=None)
@@ -689,16 +744,12 @@ class TestSaveBoardAsPNG:
             imgkey=self.session_id, board=board, flipped=True
         )
 
-        assert value == expected_pngfile
-        mock_svg2png.assert_called_with(
-            bytestring=str(svg), write_to=expected_pngfile
-        )
+        assert value == BoardSpec.from_board(board, flipped=True).key
+        mock_svg2png.assert_called_with(bytestring=str(svg))
 
     def test_save_board_as_png_success_lastmove(self, config, context, mocker):
-        mock_svg2png = mocker.patch("chess_server.utils.svg2png")
-
-        expected_pngfile = os.path.join(
-            config["IMG_DIR"], f"{self.session_id}.png"
+        mock_svg2png = mocker.patch(
+            "chess_server.render.svg2png", return_value=self.png
         )
 
         # With a move played (lastmove must be highlighted on board)
@@ -709,33 +760,48 @@ class TestSaveBoardAsPNG:
 
         value = save_board_as_png(imgkey=self.session_id, board=board)
 
-        assert value == expected_pngfile
-        mock_svg2png.assert_called_with(
-            bytestring=str(svg), write_to=expected_pngfile
+        assert value == BoardSpec.from_board(board).key
+        mock_svg2png.assert_called_with(bytestring=str(svg))
+
+    def test_save_board_as_png_same_position_is_rendered_once(
+        self, config, context, mocker
+    ):
+        mock_svg2png = mocker.patch(
+            "chess_server.render.svg2png", return_value=self.png
         )
+        session_id2 = get_random_session_id()
+
+        board = chess.Board()
+        board.push_san("e4")
+
+        save_board_as_png(imgkey=self.session_id, board=board)
+        value = save_board_as_png(imgkey=session_id2, board=board.copy())
+
+        mock_svg2png.assert_called_once()
+        assert render_cache.lookup_key(value) == self.png
+
+        # A flipped board is a different image
+        save_board_as_png(imgkey=session_id2, board=board, flipped=True)
+
+        assert mock_svg2png.call_count == 2
 
     def test_save_board_as_png_error(self, config, context, mocker):
         mock_logger = mocker.patch.object(current_app.logger, "error")
         mock_svg2png = mocker.patch(
-            "chess_server.utils.svg2png",
+            "chess_server.render.svg2png",
             side_effect=Exception(self.error_msg),
         )
-        expected_pngfile = os.path.join(
-            config["IMG_DIR"], f"{self.session_id}.png"
-        )
-
         board = chess.Board()
         svg = str(chess.svg.board(board))
 
         with pytest.raises(Exception, match=self.error_msg):
             save_board_as_png(imgkey=self.session_id, board=board)
 
-        mock_svg2png.assert_called_with(
-            bytestring=svg, write_to=expected_pngfile
-        )
+        mock_svg2png.assert_called_with(bytestring=svg)
         mock_logger.assert_called_with(
             f"Unable to process image. Failed with error:\n{self.error_msg}"
         )
+        assert render_cache.lookup(BoardSpec.from_board(board)) is None
 
 
 class TestSaveBoardAsPngAndGetCard:
@@ -748,19 +814,108 @@ class TestSaveBoardAsPngAndGetCard:
 
     def test_save_board_as_png_and_get_card(self, client, mocker):
         mocker.patch("chess_server.utils.get_user", return_value=self.user)
-        mocker.patch("chess_server.utils.save_board_as_png")
+        mock_save_board = mocker.patch("chess_server.utils.save_board_as_png")
 
-        move_number = self.user.board.fullmove_number
+        spec = BoardSpec.from_board(
+            self.user.board, flipped=self.user.color is chess.BLACK
+        )
         url = url_for(
-            "webhook_bp.png_image",
-            session_id=self.session_id,
-            move_number=move_number,
+            "webhook_bp.board_image",
+            key=spec.key,
+            ext="png",
+            position=encode_board_image_token(spec),
             _external=True,
         )
 
         card = save_board_as_png_and_get_image_card(self.session_id)
 
         assert card.image.url == url
+        mock_save_board.assert_called_once()
+
+    def test_save_board_as_png_and_get_card_lazy(self, client, mocker):
+        client.application.config["LAZY_BOARD_IMAGES"] = True
+        mocker.patch("chess_server.utils.get_user", return_value=self.user)
+        mock_save_board = mocker.patch("chess_server.utils.save_board_as_png")
+
+        card = save_board_as_png_and_get_image_card(self.session_id)
+
+        mock_save_board.assert_not_called()
+
+        token = card.image.url.split("/")[-1]
+        spec = decode_board_image_token(token)
+
+        assert spec.board_fen == self.user.board.board_fen()
+        assert spec.lastmove == "e7e5"
+        assert spec.flipped is False
+
+
+def test_decode_board_image_token_invalid(context):
+    assert decode_board_image_token("spam") is None
+
+
+class TestImageVariant:
+    def get_req(self, *capabilities):
+        req = get_dummy_webhook_request_for_google()
+        req["originalDetectIntentRequest"]["payload"]["surface"] = {
+            "capabilities": [{"name": name} for name in capabilities]
+        }
+        return req
+
+    def test_phone(self, context):
+        req = self.get_req(
+            "actions.capability.SCREEN_OUTPUT",
+            "actions.capability.WEB_BROWSER",
+        )
+
+        assert negotiate_image_variant(req) == ImageVariant("small", "png8")
+
+    def test_smart_display(self, context):
+        req = self.get_req("actions.capability.SCREEN_OUTPUT")
+
+        assert negotiate_image_variant(req) == ImageVariant("large", "png")
+
+    def test_no_surface(self, context):
+        req = get_dummy_webhook_request_for_google()
+        del req["originalDetectIntentRequest"]
+
+        assert negotiate_image_variant(req) == ImageVariant("medium", "png")
+
+    def test_board_spec_uses_request_variant(self, context, config):
+        config["IMAGE_FORMAT_SMALL"] = "webp"
+        load_image_variant_from_req(
+            self.get_req("actions.capability.WEB_BROWSER")
+        )
+
+        spec = get_board_spec(chess.Board())
+
+        assert spec.size == config["IMAGE_SIZES"]["small"]
+        assert spec.format == "webp"
+        assert get_board_spec(chess.Board(), variant=ImageVariant()) == (
+            BoardSpec(chess.STARTING_BOARD_FEN)
+        )
+
+    def test_token_carries_variant(self, context, config):
+        variant = ImageVariant("large", "png8")
+        spec = get_board_spec(chess.Board(), flipped=True, variant=variant)
+
+        token = encode_board_image_token(spec, variant)
+
+        assert decode_board_image_token(token) == spec
+        assert spec.size == config["IMAGE_SIZES"]["large"]
+
+    def test_token_without_variant(self, context):
+        serializer = get_board_image_serializer()
+        token = serializer.dumps([chess.STARTING_BOARD_FEN, None, False])
+
+        assert decode_board_image_token(token) is None
+
+    def test_token_with_unknown_variant(self, context):
+        serializer = get_board_image_serializer()
+        token = serializer.dumps(
+            [chess.STARTING_BOARD_FEN, None, False, "huge", "png"]
+        )
+
+        assert decode_board_image_token(token) is None
 
 
 class TestUndoUsersLastMove:
@@ -889,3 +1044,92 @@ class TestBasicCard:
         )
 
         assert card.make_dict() == expected_card_dict
+
+
+class TestGameState:
+    def setup_method(self):
+        self.session_id = get_random_session_id()
+        self.board = chess.Board()
+
+        for san in ["e4", "e5", "Nf3", "Nc6", "Bb5"]:
+            self.board.push_san(san)
+
+    def test_encode_and_decode_game_state(self, context):
+        token = encode_game_state(User(self.board, chess.BLACK))
+
+        user = decode_game_state(token)
+
+        assert user.color == chess.BLACK
+        assert user.board.fen() == self.board.fen()
+        assert user.board.move_stack == self.board.move_stack
+
+    def test_encode_game_state_keeps_recent_moves(self, config, context):
+        config["STATELESS_HISTORY_PLIES"] = 2
+
+        token = encode_game_state(User(self.board, chess.WHITE))
+        user = decode_game_state(token)
+
+        assert user.board.fen() == self.board.fen()
+        assert user.board.move_stack == self.board.move_stack[-2:]
+
+    def test_decode_game_state_tampered(self, context):
+        token = encode_game_state(User(self.board, chess.WHITE))
+
+        assert decode_game_state(token[:-2] + "xx") is None
+
+    def test_decode_game_state_expired(self, config, context, mocker):
+        config["REAPER_SESSION_TTL"] = 60
+        token = encode_game_state(User(self.board, chess.WHITE))
+        mocker.patch("itsdangerous.timed.time.time", return_value=2e9)
+
+        assert decode_game_state(token) is None
+
+    def test_stateless_user_lifecycle(self, config, context):
+        config["STATELESS_MODE"] = True
+
+        create_user(self.session_id, chess.Board(), chess.WHITE)
+        update_user(self.session_id, self.board)
+
+        assert get_user(self.session_id) == User(self.board, chess.WHITE)
+
+        delete_user(self.session_id)
+
+        assert exists_in_db(self.session_id) is False
+        assert get_game_states() == {self.session_id: None}
+
+    def test_output_contexts_round_trip(self, config, context):
+        config["STATELESS_MODE"] = True
+        req = get_dummy_webhook_request_for_google(session_id=self.session_id)
+
+        create_user(self.session_id, self.board, chess.BLACK)
+        contexts = get_output_contexts_for_game_states(req)
+
+        assert len(contexts) == 1
+        assert contexts[0]["name"].startswith(req["session"])
+
+        # Next turn, possibly served by another node
+        get_game_states().clear()
+        req["queryResult"]["outputContexts"] = contexts
+        load_game_states_from_req(req)
+
+        assert get_user(self.session_id) == User(self.board, chess.BLACK)
+
+
+def test_count_active_sessions(context):
+    before = count_active_sessions()
+    idle, active = get_random_session_id(), get_random_session_id()
+    for session_id in (idle, active):
+        create_user(session_id, chess.Board(), chess.WHITE)
+
+    UserModel.query.filter_by(session_id=idle).update(
+        {"last_active_at": datetime.utcnow() - timedelta(hours=1)}
+    )
+    db.session.commit()
+
+    assert count_active_sessions() == before + 1
+
+
+def test_count_active_sessions_stateless(context, config):
+    config["STATELESS_MODE"] = True
+
+    assert math.isnan(count_active_sessions())
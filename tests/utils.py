@@ -2,6 +2,7 @@ import random
 import string
 from typing import Any, Dict, List, Optional, NamedTuple, Tuple
 
+from chess_server.intents import IntentCall, handlers
 from chess_server.utils import BasicCard, Image
 
 
@@ -347,3 +348,8 @@ def get_dummy_webhook_request_for_google(
     request["originalDetectIntentRequest"] = original_google_request
 
     return request
+
+
+def get_intent_call(req: Dict[str, Any]) -> IntentCall:
+    """Call of the handler of the action of `req`, as made by dispatch"""
+    return IntentCall(handlers[req["queryResult"]["action"]], req)